@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure requests per second without an access log, with twisted's own
+synchronous log file and with the buffered L{mcs.accesslog.AccessLog}.
+
+Usage: PYTHONPATH=. python benchmarks/accesslog.py [seconds [clients]]
+
+Each client fetches a small playlist on a keep-alive connection.  Set
+C{LOG_DIRECTORY} to put the log files on the disk to be measured, or
+C{WRITE_DELAY} to the seconds every write to them should take, to pretend
+a slow one.
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PLAYLIST = 'live/channel/index.m3u8'
+
+class SlowFile(object):
+    """A file taking C{delay} seconds for every write."""
+
+    def __init__(self, f, delay):
+        self.f = f
+        self.delay = delay
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.f.write(data)
+
+def serve(mode, path, logPath, port):
+    delay = float(os.environ.get('WRITE_DELAY', 0))
+
+    from twisted.internet import reactor
+    from twisted.web import server
+
+    from mcs import accesslog, static
+
+    root = static.File(path)
+    if mode == 'off':
+        site = server.Site(root)
+    elif mode == 'sync':
+        site = server.Site(root, logPath=logPath)
+        site._openLogFile = lambda path: SlowFile(open(path, 'ab', 1), delay)
+    else:
+        accessLog = accesslog.AccessLog(logPath, format=mode)
+        accessLog.startService()
+        accessLog.logFile = SlowFile(accessLog.logFile, delay)
+        site = accesslog.AccessLogSite(root, accessLog)
+    protocol = site.protocol
+
+    def noDelay(*a, **kw):
+        # headers and body are written separately, don't wait for acks
+        channel = protocol(*a, **kw)
+        makeConnection = channel.makeConnection
+        channel.makeConnection = lambda transport: (
+            transport.setTcpNoDelay(True), makeConnection(transport))
+        return channel
+
+    site.protocol = noDelay
+    reactor.listenTCP(port, site, interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def response(sock, buffered):
+    """Read a response, returning its head and the bytes read beyond it."""
+    data = buffered
+    while b'\r\n\r\n' not in data:
+        received = sock.recv(65536)
+        if not received:
+            raise IOError('connection closed')
+        data += received
+    head, rest = data.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    while len(rest) < length:
+        rest += sock.recv(65536)
+    return head, rest[length:]
+
+def client(port, deadline, counts):
+    sock = socket.create_connection(('127.0.0.1', port))
+    request = ('GET /%s HTTP/1.1\r\nHost: localhost\r\n'
+               'User-Agent: benchmark\r\n\r\n' % PLAYLIST).encode('ascii')
+    buffered = b''
+    answered = 0
+    while time.time() < deadline:
+        sock.sendall(request)
+        head, buffered = response(sock, buffered)
+        if b' 200 ' not in head.split(b'\r\n', 1)[0]:
+            raise AssertionError(head)
+        answered += 1
+    sock.close()
+    counts.append(answered)
+
+def run(mode, path, logPath, seconds, clients, port=18187):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', mode, path,
+                               logPath, str(port)], stdout=subprocess.PIPE)
+    server.stdout.readline()
+    counts = []
+    try:
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=client,
+                                    args=(port, deadline, counts))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return {'mode': mode,
+            'clients': clients,
+            'requests/s': sum(counts) / float(seconds)}
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    clients = int(argv[1]) if len(argv) > 1 else 8
+
+    path = tempfile.mkdtemp()
+    logDirectory = tempfile.mkdtemp(dir=os.environ.get('LOG_DIRECTORY'))
+    os.makedirs(os.path.join(path, os.path.dirname(PLAYLIST)))
+    with open(os.path.join(path, PLAYLIST), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:10\n')
+        for i in range(6):
+            f.write('#EXTINF:10,\nsegment%05d.ts\n' % i)
+    try:
+        for mode in ('off', 'sync', 'combined', 'json'):
+            logPath = os.path.join(logDirectory, '%s.log' % mode)
+            print(json.dumps(run(mode, path, logPath, seconds, clients),
+                             sort_keys=True))
+    finally:
+        shutil.rmtree(path)
+        shutil.rmtree(logDirectory)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Compare the per-request cost of resolving C{--alias} paths with the
+L{mcs.alias.AliasTable} trie against the chain of L{mcs.alias.rewrite}
+closures applied by twisted's C{RewriterResource}, with 10, 100 and 1000
+aliases defined.
+
+Usage: PYTHONPATH=. python benchmarks/alias.py [requests]
+"""
+
+import json
+import sys
+import time
+
+from twisted.web import resource, rewrite
+
+from mcs import alias
+
+class Leaf(resource.Resource):
+    isLeaf = True
+
+    def getChild(self, path, request):
+        return self
+
+class Request(object):
+    """The parts of a request the rewriting looks at."""
+
+    def __init__(self, path):
+        self.prepath = []
+        self.postpath = path.split('/')[1:]
+        self.path = path
+
+def aliases(count):
+    return [('live/channel%d/hd' % n, 'media/%d/1080p' % n)
+            for n in range(count)]
+
+def paths(count):
+    """Paths hitting the first, middle and last alias and none at all."""
+    return ['/live/channel0/hd/segment1.ts',
+            '/live/channel%d/hd/segment1.ts' % (count // 2),
+            '/live/channel%d/hd/segment1.ts' % (count - 1),
+            '/vod/movie/segment1.ts']
+
+def traverse(root, path):
+    request = Request(path)
+    res = root
+    while request.postpath and not res.isLeaf:
+        segment = request.postpath.pop(0)
+        request.prepath.append(segment)
+        res = res.getChildWithDefault(segment, request)
+    return request.prepath
+
+def run(name, root, count, requests):
+    targets = paths(count)
+    start = time.time()
+    for n in range(requests // len(targets)):
+        for path in targets:
+            traverse(root, path)
+    elapsed = time.time() - start
+    return {'aliases': count,
+            'engine': name,
+            'microseconds/request': elapsed * 1e6 / requests}
+
+def main(argv):
+    requests = int(argv[0]) if argv else 40000
+    leaf = Leaf()
+    for count in (10, 100, 1000):
+        chain = rewrite.RewriterResource(
+            leaf, *[alias.rewrite(a, d) for a, d in aliases(count)])
+        table = alias.AliasResource(leaf, alias.AliasTable(aliases(count)))
+        # both must resolve to the very same paths
+        for path in paths(count):
+            assert traverse(chain, path) == traverse(table, path), path
+        for name, root in (('chain', chain), ('trie', table)):
+            print(json.dumps(run(name, root, count, requests),
+                             sort_keys=True))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
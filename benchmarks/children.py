@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Profile how request paths are resolved to the resources of files by
+L{mcs.static.File}, by twisted alone, with the stat cache and with the
+child cache of L{mcs.statcache}.
+
+Usage: PYTHONPATH=. python benchmarks/children.py [lookups]
+
+A segment a few directories deep is looked up by its name and, with
+C{--ignore-ext=.ts}, without its extension.  Reported are lookups per
+second and, with python 3, the memory blocks and bytes allocated per lookup
+and still held by the resources looked up, which are all kept alive.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from twisted.web import resource
+from twisted.web.test.requesthelper import DummyRequest
+
+from mcs import server, static
+
+SEGMENT = 'live/channel/720p/segment00042.ts'
+MODES = {'plain': [],
+         'stat-cache': ['--stat-cache=60'],
+         'child-cache': ['--stat-cache=60', '--child-cache=4096']}
+
+def root(path, mode):
+    config = server.Options()
+    config.parseOptions(['--port=tcp:0', '--path=%s' % path,
+                         '--ignore-ext=.ts'] + MODES[mode])
+    server.makeService(config)
+    return config['hosts'][0]['root']
+
+def segments(name):
+    return [segment.encode('ascii') for segment in name.split('/')]
+
+def lookup(top, name):
+    request = DummyRequest(segments(name))
+    return resource.getChildForRequest(top, request)
+
+def profile(top, name, lookups):
+    # resolved once, as a warmed up server would have
+    child = lookup(top, name)
+    if not isinstance(child, static.File):
+        raise AssertionError('%s not found: %r' % (name, child))
+    started = time.time()
+    for i in range(lookups):
+        lookup(top, name)
+    result = {'lookups/s': lookups / (time.time() - started)}
+    if tracemalloc is not None:
+        count = min(lookups, 10000)
+        kept = []
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for i in range(count):
+            kept.append(lookup(top, name))
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = [stat for stat in after.compare_to(before, 'filename')
+                     if stat.count_diff > 0]
+        result['blocks/lookup'] = sum(stat.count_diff
+                                      for stat in allocated) / float(count)
+        result['bytes/lookup'] = sum(stat.size_diff
+                                     for stat in allocated) / float(count)
+    return result
+
+def main(argv):
+    lookups = int(argv[0]) if argv else 100000
+
+    path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(path, os.path.dirname(SEGMENT)))
+    with open(os.path.join(path, SEGMENT), 'wb') as f:
+        f.write(b'\0' * 188)
+    try:
+        for mode in ('plain', 'stat-cache', 'child-cache'):
+            top = root(path, mode)
+            for kind, name in (('name', SEGMENT),
+                               ('ignored-ext', SEGMENT[:-3])):
+                result = profile(top, name, lookups)
+                result.update({'mode': mode, 'path': kind})
+                print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
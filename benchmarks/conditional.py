@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure how many conditional requests per second are answered with 304 Not
+Modified, with and without the stat cache of L{mcs.statcache}.
+
+Usage: PYTHONPATH=. python benchmarks/conditional.py [seconds [clients]]
+
+Each client revalidates a segment a few directories deep on a keep-alive
+connection, with If-Modified-Since for twisted's own handling and with
+If-None-Match against the ETags of the stat cache.
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SEGMENT = 'live/channel/720p/segment00042.ts'
+
+def serve(mode, path, port):
+    from twisted.internet import reactor
+    from twisted.web import server
+
+    from mcs import static, statcache
+
+    root = static.File(path)
+    if mode != 'plain':
+        root.statCache = statcache.StatCache(60.0)
+        root.statCache.addRoot(path)
+        root.statCache.startService()
+    reactor.listenTCP(port, server.Site(root), interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def response(sock, buffered):
+    """Read a response, returning its head and the bytes read beyond it."""
+    data = buffered
+    while b'\r\n\r\n' not in data:
+        received = sock.recv(65536)
+        if not received:
+            raise IOError('connection closed')
+        data += received
+    head, rest = data.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    while len(rest) < length:
+        rest += sock.recv(65536)
+    return head, rest[length:]
+
+def condition(port, mode):
+    """Return the header revalidating the segment."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(('GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n' % SEGMENT)
+                 .encode('ascii'))
+    head = response(sock, b'')[0]
+    sock.close()
+    headers = dict(line.split(b': ', 1)
+                   for line in head.split(b'\r\n')[1:])
+    if mode == 'etag':
+        return b'If-None-Match: ' + headers[b'ETag']
+    return b'If-Modified-Since: ' + headers[b'Last-Modified']
+
+def client(port, header, deadline, counts):
+    sock = socket.create_connection(('127.0.0.1', port))
+    request = (('GET /%s HTTP/1.1\r\nHost: localhost\r\n' % SEGMENT)
+               .encode('ascii') + header + b'\r\n\r\n')
+    buffered = b''
+    answered = 0
+    while time.time() < deadline:
+        sock.sendall(request)
+        head, buffered = response(sock, buffered)
+        if b' 304 ' not in head.split(b'\r\n', 1)[0]:
+            raise AssertionError(head)
+        answered += 1
+    sock.close()
+    counts.append(answered)
+
+def run(mode, path, seconds, clients, port=18186):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', mode, path,
+                               str(port)], stdout=subprocess.PIPE)
+    server.stdout.readline()
+    counts = []
+    try:
+        header = condition(port, mode)
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=client,
+                                    args=(port, header, deadline, counts))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return {'mode': mode,
+            'clients': clients,
+            '304/s': sum(counts) / float(seconds)}
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    clients = int(argv[1]) if len(argv) > 1 else 8
+
+    path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(path, os.path.dirname(SEGMENT)))
+    with open(os.path.join(path, SEGMENT), 'wb') as f:
+        f.write(os.urandom(2 ** 20))
+    try:
+        for mode in ('plain', 'stat-cache', 'etag'):
+            print(json.dumps(run(mode, path, seconds, clients),
+                             sort_keys=True))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
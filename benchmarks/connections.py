@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure how a server built by L{mcs.server.makeService} copes with 1k to
+20k keep-alive clients under the default reactor, twisted's asyncio
+reactor and the asyncio reactor running on uvloop.
+
+Usage: PYTHONPATH=. python benchmarks/connections.py [seconds [interval]]
+
+Every client opens a connection and requests a small playlist on it every
+interval seconds, spread evenly over the interval.  Reported are the time
+taken to open all connections, requests per second, the 50th and 99th
+percentile latencies, the errors and the processor time and peak memory of
+the server.  Set C{CONNECTIONS} and C{REACTORS} to comma-separated
+selections; reactors which can not be installed, like asyncio with python
+2, are skipped.  Both processes raise their open files limit to the hard
+limit, which has to be above the number of connections plus a few.
+"""
+
+import heapq
+import json
+import os
+import resource
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+CONNECTIONS = (1000, 2000, 5000, 10000, 20000)
+REACTORS = ('default', 'asyncio', 'uvloop')
+PLAYLIST = '/live/index.m3u8'
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def prepare(path):
+    directory = os.path.join(path, 'live')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'index.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:0\n')
+        for segment in range(10):
+            f.write('#EXTINF:2,\nsegment%05d.ts\n' % segment)
+
+def install(name):
+    if name == 'asyncio':
+        from twisted.internet import asyncioreactor
+        asyncioreactor.install()
+    elif name == 'uvloop':
+        from mcs import uvloopreactor
+        uvloopreactor.install()
+    else:
+        from twisted.internet import default
+        default.install()
+
+def report():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    sys.stdout.write(json.dumps({'cpu': usage.ru_utime + usage.ru_stime,
+                                 # kilobytes on linux
+                                 'rss': usage.ru_maxrss * 1024}) + '\n')
+    sys.stdout.flush()
+
+def serve(name, path, port):
+    raiseFileLimit()
+    try:
+        install(name)
+    except Exception as e:
+        sys.stdout.write('unavailable: %s\n' % e)
+        sys.stdout.flush()
+        return
+    from twisted.internet import reactor
+
+    from mcs import server
+
+    config = server.Options()
+    config.parseOptions(['--port=tcp:%d:interface=127.0.0.1:backlog=4096' %
+                         port, '--path=%s' % path, '--stat-cache=30'])
+    multiService = server.makeService(config)
+    multiService.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  multiService.stopService)
+    reactor.addSystemEventTrigger('after', 'shutdown', report)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+class Client(object):
+    """A keep-alive connection requesting the playlist over and over."""
+
+    request = ('GET %s HTTP/1.1\r\nHost: localhost\r\n'
+               'User-Agent: benchmark\r\n\r\n' % PLAYLIST).encode('ascii')
+
+    def __init__(self, number, port):
+        # spread over source addresses, the ephemeral ports would not do
+        source = ('127.0.%d.%d' % (number // 250 + 1, number % 250 + 2), 0)
+        self.sock = socket.create_connection(('127.0.0.1', port),
+                                             source_address=source)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.number = number
+        self.buffer = b''
+        self.started = None
+
+    def send(self):
+        self.started = time.time()
+        self.buffer = b''
+        self.sock.sendall(self.request)
+
+    def complete(self):
+        """Return the status once the whole response has been received."""
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            return None
+        head = self.buffer[:end].split(b'\r\n')
+        headers = dict(line.lower().split(b':', 1) for line in head[1:])
+        length = int(headers.get(b'content-length', 0))
+        if len(self.buffer) - end - 4 < length:
+            return None
+        return int(head[0].split()[1])
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def drive(port, connections, seconds, interval):
+    """
+    Open C{connections} and let them request for C{seconds}, returning the
+    time it took to open them, the latencies and the errors.
+    """
+    started = time.time()
+    clients = {}
+    for number in range(connections):
+        client = Client(number, port)
+        clients[client.sock.fileno()] = client
+    connected = time.time() - started
+
+    poller = select.epoll()
+    for fd in clients:
+        poller.register(fd, select.EPOLLIN)
+    waiting = []
+    started = time.time()
+    for client in clients.values():
+        heapq.heappush(waiting, (started + interval * client.number /
+                                 connections, client.number, client))
+    latencies = []
+    errors = 0
+    deadline = started + seconds
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        while waiting and waiting[0][0] <= now:
+            heapq.heappop(waiting)[2].send()
+        timeout = deadline - now
+        if waiting:
+            timeout = min(timeout, waiting[0][0] - now)
+        for fd, event in poller.poll(max(0.001, timeout)):
+            client = clients[fd]
+            try:
+                data = client.sock.recv(65536)
+            except socket.error:
+                data = b''
+            if not data:
+                # counted, but not replaced
+                errors += 1
+                poller.unregister(fd)
+                del clients[fd]
+                client.sock.close()
+                continue
+            client.buffer += data
+            status = client.complete()
+            if status is None:
+                continue
+            now = time.time()
+            latencies.append(now - client.started)
+            if status != 200:
+                errors += 1
+            heapq.heappush(waiting, (client.started + interval,
+                                     client.number, client))
+    poller.close()
+    for client in clients.values():
+        client.sock.close()
+    return connected, latencies, errors
+
+def spawn(*argv):
+    process = subprocess.Popen([sys.executable, __file__] + list(argv),
+                               stdout=subprocess.PIPE)
+    line = process.stdout.readline().decode('utf-8').strip()
+    if line != 'ready':
+        process.wait()
+        return None, line
+    return process, None
+
+def run(reactor, connections, path, seconds, interval, port=18193):
+    server, reason = spawn('serve', reactor, path, str(port))
+    if server is None:
+        return {'reactor': reactor, 'connections': connections,
+                'skipped': reason}
+    try:
+        connected, latencies, errors = drive(port, connections, seconds,
+                                             interval)
+    finally:
+        server.terminate()
+        usage = json.loads(server.stdout.readline().decode('utf-8'))
+        server.wait()
+    return {'reactor': reactor,
+            'connections': connections,
+            'interval': interval,
+            'connect-seconds': connected,
+            'requests/s': len(latencies) / float(seconds),
+            'errors': errors,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'server-cpu-seconds/s': usage['cpu'] / seconds,
+            'server-rss-bytes': usage['rss']}
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    interval = float(argv[1]) if len(argv) > 1 else 5.0
+    connections = os.environ.get('CONNECTIONS')
+    connections = ([int(count) for count in connections.split(',')]
+                   if connections else CONNECTIONS)
+    reactors = os.environ.get('REACTORS')
+    reactors = reactors.split(',') if reactors else REACTORS
+    raiseFileLimit()
+
+    path = tempfile.mkdtemp()
+    try:
+        prepare(path)
+        for reactor in reactors:
+            for count in connections:
+                print(json.dumps(run(reactor, count, path, seconds,
+                                     interval), sort_keys=True))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure requests per second for playlist-sized responses over a new
+connection per request, persistent connections and pipelined requests on
+persistent connections, against a server built by L{mcs.server.makeService}
+with each of the C{--tcp-send} modes.
+
+Usage: PYTHONPATH=. python benchmarks/keepalive.py [seconds [clients]]
+
+Every client keeps one request in flight, or C{DEPTH} when pipelining,
+and sends the next one as soon as a response is complete.  Persistent
+connections are closed by the server after C{--keep-alive=60,100}
+requests and opened again; requests pipelined behind the last one are
+lost and counted as errors.  Reported are requests per second, the 50th and
+99th percentile latencies, the connections opened and the errors.
+"""
+
+import json
+import os
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+DEPTH = 8
+PLAYLIST = '/live/index.m3u8'
+MODES = ('close', 'keep-alive', 'pipelined')
+TCP_SEND = ('default', 'nodelay', 'nagle', 'cork')
+
+def prepare(path):
+    directory = os.path.join(path, 'live')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'index.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:0\n')
+        for segment in range(20):
+            f.write('#EXTINF:2,\nsegment%05d.ts\n' % segment)
+
+def serve(path, port, tcpSend):
+    from twisted.internet import reactor
+
+    from mcs import server
+
+    options = ['--port=tcp:%d:interface=127.0.0.1:backlog=1024' % port,
+               '--path=%s' % path, '--stat-cache=30', '--keep-alive=60,100']
+    if tcpSend != 'default':
+        options.append('--tcp-send=%s' % tcpSend)
+    config = server.Options()
+    config.parseOptions(options)
+    multiService = server.makeService(config)
+    multiService.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  multiService.stopService)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+class Client(object):
+    """A connection with its requests in flight."""
+
+    def __init__(self, port, mode):
+        self.port = port
+        self.mode = mode
+        self.request = ('GET %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' %
+                        (PLAYLIST, 'Connection: close\r\n'
+                         if mode == 'close' else '')).encode('ascii')
+        self.sock = None
+        self.sent = []
+        self.buffer = b''
+
+    def connect(self):
+        self.sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.sent = []
+
+    def send(self):
+        depth = DEPTH if self.mode == 'pipelined' else 1
+        count = depth - len(self.sent)
+        now = time.time()
+        self.sent.extend([now] * count)
+        self.sock.sendall(self.request * count)
+
+    def responses(self):
+        """
+        Return the statuses and close flags of the complete responses,
+        raising C{ValueError} for one which is not a response at all.
+        """
+        complete = []
+        while True:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                break
+            head = self.buffer[:end].split(b'\r\n')
+            headers = dict(line.lower().split(b': ', 1) for line in head[1:])
+            length = int(headers.get(b'content-length', 0))
+            if len(self.buffer) - end - 4 < length:
+                break
+            self.buffer = self.buffer[end + 4 + length:]
+            complete.append((int(head[0].split()[1]),
+                             headers.get(b'connection') == b'close'))
+        return complete
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def drive(port, mode, clients, seconds):
+    poller = select.epoll()
+    byFd = {}
+
+    def connect(client):
+        client.connect()
+        byFd[client.sock.fileno()] = client
+        poller.register(client.sock.fileno(), select.EPOLLIN)
+        client.send()
+
+    def disconnect(client):
+        fd = client.sock.fileno()
+        poller.unregister(fd)
+        del byFd[fd]
+        client.sock.close()
+
+    latencies = []
+    errors = 0
+    connections = 0
+    for number in range(clients):
+        connect(Client(port, mode))
+        connections += 1
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for fd, event in poller.poll(0.1):
+            client = byFd[fd]
+            try:
+                data = client.sock.recv(65536)
+            except socket.error:
+                data = b''
+            client.buffer += data
+            now = time.time()
+            closed = not data
+            try:
+                responses = client.responses()
+            except ValueError:
+                # like the bodies older twisted releases lose when pipelining
+                responses, closed = [], True
+            for status, close in responses:
+                latencies.append(now - client.sent.pop(0))
+                if status != 200:
+                    errors += 1
+                closed = closed or close
+            if closed:
+                # requests in flight on the closed connection are lost
+                errors += len(client.sent)
+                disconnect(client)
+                connect(client)
+                connections += 1
+            elif not client.sent or mode == 'pipelined':
+                client.send()
+    for client in list(byFd.values()):
+        disconnect(client)
+    poller.close()
+    return latencies, errors, connections
+
+def run(path, tcpSend, mode, clients, seconds, port=18195):
+    process = subprocess.Popen([sys.executable, __file__, 'serve', path,
+                                str(port), tcpSend], stdout=subprocess.PIPE)
+    try:
+        if process.stdout.readline().decode('utf-8').strip() != 'ready':
+            raise AssertionError('the server did not start')
+        latencies, errors, connections = drive(port, mode, clients, seconds)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'tcp-send': tcpSend,
+            'mode': mode,
+            'clients': clients,
+            'requests/s': len(latencies) / float(seconds),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'connections': connections,
+            'errors': errors}
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 5
+    clients = int(argv[1]) if len(argv) > 1 else 32
+    path = tempfile.mkdtemp()
+    try:
+        prepare(path)
+        for tcpSend in TCP_SEND:
+            if tcpSend == 'cork' and not hasattr(socket, 'TCP_CORK'):
+                continue
+            for mode in MODES:
+                print(json.dumps(run(path, tcpSend, mode, clients, seconds),
+                                 sort_keys=True))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        main(sys.argv[1:])
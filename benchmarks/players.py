@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Simulate HLS players against servers built by L{mcs.server.makeService}, in
+a plain, a shaped, a vhost, an alias and a reverse proxy configuration, the
+latter in front of a local stand-in origin.
+
+Usage: PYTHONPATH=. python benchmarks/players.py [seconds [players [interval]]]
+
+Every player polls the playlist of one of a few live channels each interval
+seconds on a keep-alive connection, and fetches the next segment it lists
+right away.  Reported are requests and bytes per second, the 50th and 99th
+percentile latencies of playlists and segments, the processor time and
+peak memory of the server and, when shaped, the rates delivered against
+the configured ones.  Set C{SCENARIOS} to a comma-separated selection of
+them, C{RATE} and C{CLIENT_RATE} to the --shape in bytes per second and
+C{SEGMENT_SIZE} to the size of the segments.  More than 500 players need
+C{ulimit -n} above their number times two.
+"""
+
+import heapq
+import json
+import os
+import resource
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = ('plain', 'shaped', 'vhosts', 'aliases', 'reverse')
+CHANNELS = 4
+SEGMENTS = 10
+VHOSTS = 100
+# per-client burst of the shaped scenario, small enough for every download
+# to run at the client rate
+CLIENT_BURST = 16384
+
+def prepare(path, size):
+    """Write the live channels below C{path}."""
+    for channel in range(CHANNELS):
+        directory = os.path.join(path, 'live', 'channel%d' % channel)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'index.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n#EXT-X-TARGETDURATION:2\n'
+                    '#EXT-X-MEDIA-SEQUENCE:0\n')
+            for segment in range(SEGMENTS):
+                f.write('#EXTINF:2,\nsegment%05d.ts\n' % segment)
+        for segment in range(SEGMENTS):
+            with open(os.path.join(directory, 'segment%05d.ts' % segment),
+                      'wb') as f:
+                f.write(os.urandom(size))
+
+def arguments(scenario, path, port, originPort, rate, clientRate):
+    """Return the command line of the server of C{scenario}."""
+    argv = ['--port=tcp:%d:interface=127.0.0.1' % port]
+    if scenario == 'reverse':
+        return argv + ['--reverse=127.0.0.1,%d' % originPort]
+    argv.append('--path=%s' % path)
+    if scenario == 'shaped':
+        argv.append('--shape=%d,%d,%d,%d' % (rate, clientRate, rate,
+                                             CLIENT_BURST))
+    elif scenario == 'vhosts':
+        for number in range(VHOSTS):
+            argv.extend(['--vhost=tenant%d.example' % number,
+                         '--path=%s' % path])
+    elif scenario == 'aliases':
+        for channel in range(CHANNELS):
+            argv.append('--alias=tv/%d,live/channel%d' % (channel, channel))
+    return argv
+
+def report():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    sys.stdout.write(json.dumps({'cpu': usage.ru_utime + usage.ru_stime,
+                                 # kilobytes on linux
+                                 'rss': usage.ru_maxrss * 1024}) + '\n')
+    sys.stdout.flush()
+
+def origin(path, port):
+    from twisted.internet import reactor
+    from twisted.web import server, static
+
+    reactor.listenTCP(port, server.Site(static.File(path)),
+                      interface='127.0.0.1', backlog=1024)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def serve(argv):
+    from twisted.internet import reactor
+
+    from mcs import server
+
+    config = server.Options()
+    config.parseOptions(argv)
+    multiService = server.makeService(config)
+    multiService.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  multiService.stopService)
+    reactor.addSystemEventTrigger('after', 'shutdown', report)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+class Player(object):
+    """A player polling the playlist of a channel on its own connection."""
+
+    def __init__(self, number, scenario, interval):
+        self.number = number
+        self.interval = interval
+        channel = number % CHANNELS
+        self.host = 'localhost'
+        self.playlist = '/live/channel%d/index.m3u8' % channel
+        if scenario == 'vhosts':
+            self.host = 'tenant%d.example' % (number % VHOSTS)
+        elif scenario == 'aliases':
+            self.playlist = '/tv/%d/index.m3u8' % channel
+        self.directory = self.playlist.rsplit('/', 1)[0]
+        self.sock = None
+        self.buffer = b''
+        self.kind = None
+        self.started = None
+        self.segments = []
+        self.next = 0
+
+    def connect(self, port):
+        # every player gets its own address, as it would have its own bucket
+        source = ('127.0.%d.%d' % (self.number // 250,
+                                   self.number % 250 + 2), 0)
+        self.sock = socket.create_connection(('127.0.0.1', port),
+                                             source_address=source)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+
+    def request(self, kind, path):
+        self.kind = kind
+        self.started = time.time()
+        self.sock.sendall(('GET %s HTTP/1.1\r\nHost: %s\r\n'
+                           'User-Agent: benchmark\r\n\r\n' %
+                           (path, self.host)).encode('ascii'))
+
+    def requestPlaylist(self):
+        self.request('playlist', self.playlist)
+
+    def requestSegment(self):
+        name = self.segments[self.next % len(self.segments)]
+        self.next += 1
+        self.request('segment', '%s/%s' % (self.directory, name))
+
+    def response(self):
+        """
+        Return the status and body of the response received so far, or
+        C{None} while it is incomplete.
+        """
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            return None
+        head = self.buffer[:end].split(b'\r\n')
+        status = int(head[0].split()[1])
+        headers = dict(line.lower().split(b':', 1) for line in head[1:])
+        body = self.buffer[end + 4:]
+        if b'content-length' in headers:
+            length = int(headers[b'content-length'])
+            if len(body) < length:
+                return None
+            self.buffer = body[length:]
+            return status, body[:length]
+        if b'chunked' in headers.get(b'transfer-encoding', b''):
+            if not body.endswith(b'0\r\n\r\n'):
+                return None
+            self.buffer = b''
+            chunks = []
+            while True:
+                line, body = body.split(b'\r\n', 1)
+                size = int(line.split(b';')[0], 16)
+                if not size:
+                    return status, b''.join(chunks)
+                chunks.append(body[:size])
+                body = body[size + 2:]
+        self.buffer = body
+        return status, b''
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def drive(port, scenario, players, seconds, interval):
+    """
+    Let C{players} play for C{seconds}, returning the latencies of their
+    playlist and segment requests, the durations and sizes of their segment
+    downloads, the bytes received and the errors.
+    """
+    poller = select.poll()
+    sockets = {}
+    waiting = []
+    started = time.time()
+    for number in range(players):
+        player = Player(number, scenario, interval)
+        player.connect(port)
+        sockets[player.sock.fileno()] = player
+        poller.register(player.sock.fileno(), select.POLLIN)
+        # spread evenly over the first interval
+        heapq.heappush(waiting, (started + interval * number / players,
+                                 number, player))
+
+    latencies = {'playlist': [], 'segment': []}
+    downloads = []
+    received = 0
+    errors = 0
+    deadline = started + seconds
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        while waiting and waiting[0][0] <= now:
+            player = heapq.heappop(waiting)[2]
+            player.requestPlaylist()
+        timeout = deadline - now
+        if waiting:
+            timeout = min(timeout, waiting[0][0] - now)
+        for fd, event in poller.poll(max(1, int(timeout * 1000))):
+            player = sockets[fd]
+            try:
+                data = player.sock.recv(65536)
+            except socket.error:
+                data = b''
+            if not data:
+                # reconnect and start over with the playlist
+                errors += 1
+                poller.unregister(fd)
+                del sockets[fd]
+                player.sock.close()
+                player.connect(port)
+                sockets[player.sock.fileno()] = player
+                poller.register(player.sock.fileno(), select.POLLIN)
+                heapq.heappush(waiting, (time.time(), player.number, player))
+                continue
+            received += len(data)
+            player.buffer += data
+            result = player.response()
+            if result is None:
+                continue
+            status, body = result
+            now = time.time()
+            latency = now - player.started
+            if status != 200:
+                errors += 1
+            latencies[player.kind].append(latency)
+            if player.kind == 'playlist' and status == 200:
+                player.segments = [line for line in body.decode('ascii')
+                                   .splitlines()
+                                   if line and not line.startswith('#')]
+                player.requestSegment()
+                continue
+            if player.kind == 'segment':
+                downloads.append((latency, len(body)))
+            # the next poll is due an interval after the previous one
+            heapq.heappush(waiting, (max(now, player.started -
+                                         latency + interval),
+                                     player.number, player))
+    for player in sockets.values():
+        player.sock.close()
+    return latencies, downloads, received, errors
+
+def spawn(*argv):
+    process = subprocess.Popen([sys.executable, __file__] + list(argv),
+                               stdout=subprocess.PIPE)
+    process.stdout.readline()
+    return process
+
+def run(scenario, path, seconds, players, interval, rate, clientRate,
+        port=18191, originPort=18192):
+    originProcess = None
+    if scenario == 'reverse':
+        originProcess = spawn('origin', path, str(originPort))
+    server = spawn('serve', *arguments(scenario, path, port, originPort,
+                                       rate, clientRate))
+    try:
+        latencies, downloads, received, errors = drive(port, scenario,
+                                                       players, seconds,
+                                                       interval)
+    finally:
+        server.terminate()
+        usage = json.loads(server.stdout.readline().decode('utf-8'))
+        server.wait()
+        if originProcess is not None:
+            originProcess.terminate()
+            originProcess.wait()
+
+    result = {'scenario': scenario,
+              'players': players,
+              'interval': interval,
+              'requests/s': sum(len(values) for values in latencies.values())
+                            / float(seconds),
+              'bytes/s': received / float(seconds),
+              'errors': errors,
+              'server-cpu-seconds/s': usage['cpu'] / seconds,
+              'server-rss-bytes': usage['rss']}
+    for kind, values in latencies.items():
+        result['%s-p50' % kind] = percentile(values, 0.5)
+        result['%s-p99' % kind] = percentile(values, 0.99)
+    if scenario == 'shaped':
+        # players download segments back to back once shaped below the
+        # segment size per interval, so either rate should be reached
+        clientRates = [size / latency for latency, size in downloads
+                       if latency > 0]
+        result.update({'configured-rate': rate,
+                       'configured-client-rate': clientRate,
+                       'rate-accuracy': received / float(seconds) / rate,
+                       'client-rate-accuracy':
+                           (percentile(clientRates, 0.5) or 0) / clientRate})
+    return result
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    players = int(argv[1]) if len(argv) > 1 else 100
+    interval = float(argv[2]) if len(argv) > 2 else 2.0
+    scenarios = os.environ.get('SCENARIOS')
+    scenarios = scenarios.split(',') if scenarios else SCENARIOS
+    rate = int(os.environ.get('RATE', 16 * 2 ** 20))
+    clientRate = int(os.environ.get('CLIENT_RATE', 128 * 2 ** 10))
+    size = int(os.environ.get('SEGMENT_SIZE', 256 * 2 ** 10))
+
+    path = tempfile.mkdtemp()
+    try:
+        prepare(path, size)
+        for scenario in scenarios:
+            print(json.dumps(run(scenario, path, seconds, players, interval,
+                                 rate, clientRate), sort_keys=True))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2:])
+    elif sys.argv[1:2] == ['origin']:
+        origin(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure the time to first byte of seek-heavy MP4 playback, with and without
+the descriptor pool and movie index of L{mcs.ranges}.
+
+Usage: PYTHONPATH=. python benchmarks/ranges.py [sessions [seeks]]
+
+Each session mimics a player: it probes the start of the file, fetches the
+moov atom from the end of the file, the start of the mdat atom and then
+seeks around in ranges of 256 kB on one keep-alive connection.  The movie
+is dropped from the page cache before each session where posix_fadvise(2)
+is available, so that startup reads hit the disk as they do for movies
+nobody watched recently.
+"""
+
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+MOOV_SIZE = 2 ** 20
+MDAT_SIZE = 64 * 2 ** 20
+SEEK_SIZE = 2 ** 18
+
+def serve(mode, path, port):
+    from twisted.internet import reactor
+    from twisted.web import server
+
+    from mcs import ranges, static
+
+    root = static.File(path)
+    if mode == 'fast':
+        root.descriptorPool = ranges.DescriptorPool(64)
+        root.movieIndex = ranges.MovieIndexCache(64 * 2 ** 20)
+    site = server.Site(root)
+    reactor.listenTCP(port, site, interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def request(sock, name, start, end):
+    """
+    Request a range and return the seconds until the first byte of the body
+    arrived, reading the whole response.
+    """
+    started = time.time()
+    sock.sendall(('GET /%s HTTP/1.1\r\nHost: localhost\r\n'
+                  'Range: bytes=%d-%d\r\n\r\n' % (name, start, end))
+                 .encode('ascii'))
+    data = b''
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(65536)
+    head, body = data.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n'):
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    while not body and length:
+        body = sock.recv(65536)
+    firstByte = time.time() - started
+    received = len(body)
+    while received < length:
+        received += len(sock.recv(2 ** 20))
+    return firstByte
+
+def play(port, name, size, seeks):
+    """Return the times to first byte of startup and of seeking."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    moov = size - MOOV_SIZE - 8
+    startup = [request(sock, name, 0, 1023),
+               request(sock, name, moov, size - 1),
+               request(sock, name, 0, SEEK_SIZE - 1)]
+    seeking = []
+    for i in range(seeks):
+        start = random.randrange(0, size - SEEK_SIZE)
+        seeking.append(request(sock, name, start, start + SEEK_SIZE - 1))
+    sock.close()
+    return startup, seeking
+
+def dropFromPageCache(path):
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            fadvise = libc.posix_fadvise
+        except (ImportError, OSError, AttributeError):
+            return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # POSIX_FADV_DONTNEED
+        fadvise(fd, 0, 0, 4)
+    finally:
+        os.close(fd)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(mode, path, name, size, sessions, seeks, port=18183):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', mode, path,
+                               str(port)], stdout=subprocess.PIPE)
+    server.stdout.readline()
+    startup, seeking = [], []
+    try:
+        for i in range(sessions):
+            dropFromPageCache(os.path.join(path, name))
+            first, rest = play(port, name, size, seeks)
+            startup.extend(first)
+            seeking.extend(rest)
+    finally:
+        server.terminate()
+        server.wait()
+    result = {'mode': mode}
+    for kind, times in (('startup', startup), ('seek', seeking)):
+        result[kind + '-ttfb-ms-median'] = percentile(times, 0.5) * 1000
+        result[kind + '-ttfb-ms-p95'] = percentile(times, 0.95) * 1000
+    return result
+
+def main(argv):
+    sessions = int(argv[0]) if argv else 50
+    seeks = int(argv[1]) if len(argv) > 1 else 20
+
+    path = tempfile.mkdtemp()
+    name = 'movie.mp4'
+    # a movie not prepared for fast start, the moov atom comes last
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(struct.pack('>I4s4sI8s', 24, b'ftyp', b'isom', 0, b'isomiso2'))
+        f.write(struct.pack('>I4s', MDAT_SIZE + 8, b'mdat'))
+        block = os.urandom(2 ** 20)
+        for i in range(MDAT_SIZE // len(block)):
+            f.write(block)
+        f.write(struct.pack('>I4s', MOOV_SIZE + 8, b'moov'))
+        f.write(os.urandom(MOOV_SIZE))
+    size = os.path.getsize(os.path.join(path, name))
+    try:
+        for mode in ('plain', 'fast'):
+            print(json.dumps(run(mode, path, name, size, sessions, seeks),
+                             sort_keys=True))
+    finally:
+        os.unlink(os.path.join(path, name))
+        os.rmdir(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure the time to the first byte of every segment a player fetches in
+order from a cold page cache, without and with the readahead of
+L{mcs.readahead}.
+
+Usage: PYTHONPATH=. python benchmarks/readahead.py [segments [size [pace]]]
+
+The segments of size bytes are written to a directory of C{DIRECTORY},
+which should be on the disk to measure rather than a tmpfs, and dropped
+from the page cache with posix_fadvise(2) before every run, which needs
+python 3.  The player requests the playlist and then one segment every
+pace seconds, as a player buffering ahead would.  Reported are the 50th,
+90th and 99th percentile and the maximum time to the first byte.
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {'plain': [],
+         'readahead': ['--readahead=3'],
+         'readahead-cache': ['--cache=268435456,8388608', '--readahead=3']}
+
+def prepare(path, segments, size):
+    directory = os.path.join(path, 'vod')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'index.m3u8'), 'w') as f:
+        f.write('#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:0\n')
+        for segment in range(segments):
+            f.write('#EXTINF:2,\nsegment%05d.ts\n' % segment)
+        f.write('#EXT-X-ENDLIST\n')
+    for segment in range(segments):
+        with open(os.path.join(directory, 'segment%05d.ts' % segment),
+                  'wb') as f:
+            f.write(os.urandom(size))
+            f.flush()
+            os.fsync(f.fileno())
+
+def evict(path):
+    """Drop the files below C{path} from the page cache."""
+    for directory, names, files in os.walk(path):
+        for name in files:
+            fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+def serve(path, port, mode):
+    from twisted.internet import reactor
+
+    from mcs import server
+
+    config = server.Options()
+    config.parseOptions(['--port=tcp:%d:interface=127.0.0.1' % port,
+                         '--path=%s' % path] + MODES[mode])
+    multiService = server.makeService(config)
+    multiService.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  multiService.stopService)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def fetch(port, uri):
+    """
+    Request C{uri}, returning the seconds to the first byte of the response
+    and its body.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        started = time.time()
+        sock.sendall(('GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' %
+                      uri).encode('ascii'))
+        data = sock.recv(65536)
+        firstByte = time.time() - started
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    status = int(data.split(b' ', 2)[1])
+    if status != 200:
+        raise AssertionError('%s: %d' % (uri, status))
+    return firstByte, data.split(b'\r\n\r\n', 1)[1]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def play(port, pace):
+    firstBytes = []
+    playlist = fetch(port, '/vod/index.m3u8')[1]
+    for line in playlist.splitlines():
+        if line and not line.startswith(b'#'):
+            firstBytes.append(fetch(port, '/vod/' +
+                                    line.decode('ascii'))[0])
+            time.sleep(pace)
+    return firstBytes
+
+def run(path, mode, pace, port=18194):
+    evict(path)
+    process = subprocess.Popen([sys.executable, __file__, 'serve', path,
+                                str(port), mode], stdout=subprocess.PIPE)
+    try:
+        if process.stdout.readline().decode('utf-8').strip() != 'ready':
+            raise AssertionError('%s server did not start' % mode)
+        firstBytes = play(port, pace)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'mode': mode,
+            'segments': len(firstBytes),
+            'p50': percentile(firstBytes, 0.5),
+            'p90': percentile(firstBytes, 0.9),
+            'p99': percentile(firstBytes, 0.99),
+            'max': max(firstBytes)}
+
+def main(argv):
+    segments = int(argv[0]) if argv else 50
+    size = int(argv[1]) if len(argv) > 1 else 2 ** 20
+    pace = float(argv[2]) if len(argv) > 2 else 0.1
+    if not hasattr(os, 'posix_fadvise'):
+        sys.exit('The page cache can only be dropped with python 3.')
+
+    path = tempfile.mkdtemp(dir=os.environ.get('DIRECTORY'))
+    try:
+        prepare(path, segments, size)
+        for mode in ('plain', 'readahead', 'readahead-cache'):
+            print(json.dumps(run(path, mode, pace), sort_keys=True))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        main(sys.argv[1:])
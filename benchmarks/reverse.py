@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Compare latency and requests per second of the keep-alive reverse proxy in
+L{mcs.reverse} against twisted's reverse proxy, which connects to the
+upstream anew for every request, in front of a local stand-in upstream.
+
+Usage: PYTHONPATH=. python benchmarks/reverse.py [seconds [clients [size]]]
+
+Each client sends its requests one after another on a keep-alive
+connection to the proxy.  The connections the proxy opened to the upstream
+are reported as well, each of which leaves a socket in TIME_WAIT behind.
+"""
+
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+def upstream(port, size):
+    from twisted.internet import reactor
+    from twisted.web import resource, server
+
+    class Segment(resource.Resource):
+        isLeaf = True
+        body = b'x' * size
+
+        def render_GET(self, request):
+            if request.path == b'/connections':
+                return str(site.connections).encode('ascii')
+            request.setHeader(b'content-type', b'video/mp2t')
+            return self.body
+
+    class Site(server.Site):
+        connections = 0
+
+        def buildProtocol(self, addr):
+            self.connections += 1
+            return server.Site.buildProtocol(self, addr)
+
+    site = Site(Segment())
+    reactor.listenTCP(port, site, interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def serve(mode, port, upstreamPort):
+    from twisted.internet import reactor
+    from twisted.web import proxy, server
+
+    from mcs import reverse
+
+    if mode == 'pooled':
+        root = reverse.ReverseProxyResource('127.0.0.1', upstreamPort, '')
+    else:
+        root = proxy.ReverseProxyResource('127.0.0.1', upstreamPort, b'')
+    reactor.listenTCP(port, server.Site(root), interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def fetch(sock, buffered):
+    """Request a segment, returning the bytes read beyond the response."""
+    sock.sendall(b'GET /segment.ts HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    data = buffered
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(65536)
+    head, body = data.split(b'\r\n\r\n', 1)
+    headers = head.lower()
+    if b'transfer-encoding: chunked' in headers:
+        while not body.endswith(b'\r\n0\r\n\r\n'):
+            body += sock.recv(65536)
+        return b''
+    length = int(headers.split(b'content-length:', 1)[1].split(b'\r\n')[0])
+    while len(body) < length:
+        body += sock.recv(65536)
+    return body[length:]
+
+def connections(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'GET /connections HTTP/1.0\r\n\r\n')
+    data = b''
+    while True:
+        received = sock.recv(65536)
+        if not received:
+            break
+        data += received
+    sock.close()
+    return int(data.split(b'\r\n\r\n', 1)[1])
+
+def client(port, deadline, latencies):
+    sock = socket.create_connection(('127.0.0.1', port))
+    buffered = b''
+    while time.time() < deadline:
+        started = time.time()
+        buffered = fetch(sock, buffered)
+        latencies.append(time.time() - started)
+    sock.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(mode, seconds, clients, upstreamPort, port=18185):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', mode,
+                               str(port), str(upstreamPort)],
+                              stdout=subprocess.PIPE)
+    server.stdout.readline()
+    opened = connections(upstreamPort)
+    latencies = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client,
+                                args=(port, deadline, latencies))
+               for i in range(clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return {'mode': mode,
+            'clients': clients,
+            'requests/s': len(latencies) / float(seconds),
+            'p50-ms': percentile(latencies, 0.5) * 1000,
+            'p99-ms': percentile(latencies, 0.99) * 1000,
+            # less the one asking for the count
+            'upstream-connections': connections(upstreamPort) - opened - 1}
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    clients = int(argv[1]) if len(argv) > 1 else 16
+    size = int(argv[2]) if len(argv) > 2 else 64 * 2 ** 10
+
+    upstreamPort = 18184
+    origin = subprocess.Popen([sys.executable, __file__, 'upstream',
+                               str(upstreamPort), str(size)],
+                              stdout=subprocess.PIPE)
+    origin.stdout.readline()
+    try:
+        for mode in ('twisted', 'pooled'):
+            print(json.dumps(run(mode, seconds, clients, upstreamPort),
+                             sort_keys=True))
+    finally:
+        origin.terminate()
+        origin.wait()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['upstream']:
+        upstream(int(sys.argv[2]), int(sys.argv[3]))
+    elif sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(sys.argv[1:])
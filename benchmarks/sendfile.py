@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Compare throughput and server CPU per GB of the zero-copy sendfile producer
+against twisted's default copying producer.
+
+Usage: PYTHONPATH=. python benchmarks/sendfile.py [size-in-MB [rounds [rate]]]
+
+An optional C{rate} (bytes per second) shapes the server like
+C{--shape rate} does.
+"""
+
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+def serve(mode, path, port, rate):
+    from twisted.internet import reactor
+    from twisted.web import server
+
+    from mcs import shaper, static
+
+    root = static.File(path)
+    root.useSendfile = mode == 'sendfile'
+    site = server.Site(root)
+    if rate:
+        site.protocol = shaper.gen_token_bucket(site.protocol, rate)
+
+    def report():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        sys.stdout.write('%f\n' % (usage.ru_utime + usage.ru_stime))
+        sys.stdout.flush()
+
+    reactor.addSystemEventTrigger('after', 'shutdown', report)
+    reactor.listenTCP(port, site, interface='127.0.0.1')
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def fetch(port, name):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(('GET /%s HTTP/1.0\r\nHost: localhost\r\n\r\n' % name)
+                 .encode('ascii'))
+    buf = bytearray(2 ** 20)
+    total = 0
+    while True:
+        received = sock.recv_into(buf)
+        if not received:
+            break
+        total += received
+    sock.close()
+    return total
+
+def run(mode, path, name, size, rounds, rate, port=18181):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', mode, path,
+                               str(port), str(rate)],
+                              stdout=subprocess.PIPE)
+    server.stdout.readline()
+    started = time.time()
+    received = 0
+    for i in range(rounds):
+        received += fetch(port, name)
+    elapsed = time.time() - started
+    server.terminate()
+    cpu = float(server.stdout.readline())
+    server.wait()
+    gigabytes = received / float(2 ** 30)
+    return {'mode': mode,
+            'bytes': received,
+            'seconds': elapsed,
+            'MB/s': received / elapsed / 2 ** 20,
+            'cpu-seconds/GB': cpu / gigabytes if gigabytes else 0.0}
+
+def main(argv):
+    size = int(argv[0]) if argv else 256
+    rounds = int(argv[1]) if len(argv) > 1 else 8
+    rate = int(argv[2]) if len(argv) > 2 else 0
+
+    path = tempfile.mkdtemp()
+    name = 'segment.ts'
+    with open(os.path.join(path, name), 'wb') as f:
+        block = os.urandom(2 ** 20)
+        for i in range(size):
+            f.write(block)
+    try:
+        for mode in ('copy', 'sendfile'):
+            result = run(mode, path, name, size, rounds, rate)
+            print('%(mode)-8s %(MB/s)10.1f MB/s %(cpu-seconds/GB)8.3f '
+                  'cpu-seconds/GB' % result)
+    finally:
+        os.unlink(os.path.join(path, name))
+        os.rmdir(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        main(sys.argv[1:])
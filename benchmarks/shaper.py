@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Compare reactor CPU and the size distribution of writes to the sockets of
+the tick-scheduled shaper in L{mcs.shaper} against twisted's htb-shaper,
+with 10, 100 and 1000 concurrent clients downloading the same segment.
+
+Usage: PYTHONPATH=. python benchmarks/shaper.py [seconds [rate [client-rate]]]
+
+Sendfile is disabled on the server, so that every byte passes through the
+shaped transport's writes.  1000 clients need C{ulimit -n} above 2048.
+"""
+
+import json
+import os
+import resource
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = (512, 1448, 1500, 8192, 65536)
+
+def legacy_token_bucket(protocol, rate, client_rate):
+    """The htb-based shaping L{mcs.shaper} used to implement."""
+    from twisted.protocols import htb
+
+    class Bucket(htb.Bucket):
+        # newer twisted versions compute fractional amounts
+        def add(self, amount):
+            return int(htb.Bucket.add(self, amount))
+
+    class ClientBucket(Bucket):
+        pass
+
+    class FilterByHost(htb.FilterByHost):
+        def getBucketKey(self, transport):
+            return transport.getPeer().host
+
+    serverFilter = htb.HierarchicalBucketFilter()
+    serverBucket = Bucket()
+    serverBucket.maxburst = serverBucket.rate = rate
+    serverFilter.buckets[None] = serverBucket
+
+    ClientBucket.maxburst = ClientBucket.rate = client_rate
+    webFilter = FilterByHost(serverFilter)
+    webFilter.bucketFactory = ClientBucket
+    return htb.ShapedProtocolFactory(protocol, webFilter)
+
+def serve(engine, path, port, rate, client_rate):
+    from twisted.internet import reactor, tcp
+    from twisted.web import server
+
+    from mcs import shaper, static
+
+    histogram = dict((size, 0) for size in SIZES + (None,))
+    write = tcp.Connection.write
+
+    def recordingWrite(self, data):
+        for size in SIZES:
+            if len(data) <= size:
+                break
+        else:
+            size = None
+        histogram[size] += 1
+        return write(self, data)
+
+    tcp.Connection.write = recordingWrite
+
+    root = static.File(path)
+    root.useSendfile = False
+    site = server.Site(root)
+    if engine == 'htb':
+        site.protocol = legacy_token_bucket(site.protocol, rate, client_rate)
+    else:
+        site.protocol = shaper.gen_token_bucket(site.protocol, rate,
+                                                client_rate)
+
+    def report():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        writes = dict(('<=%d' % size if size else '>%d' % SIZES[-1], count)
+                      for size, count in histogram.items())
+        sys.stdout.write(json.dumps({'cpu': usage.ru_utime + usage.ru_stime,
+                                     'writes': writes}) + '\n')
+        sys.stdout.flush()
+
+    reactor.addSystemEventTrigger('after', 'shutdown', report)
+    reactor.listenTCP(port, site, interface='127.0.0.1', backlog=1024)
+    reactor.callWhenRunning(sys.stdout.write, 'ready\n')
+    reactor.callWhenRunning(sys.stdout.flush)
+    reactor.run()
+
+def drive(port, name, clients, seconds):
+    """
+    Keep C{clients} connections busy fetching C{name} for C{seconds}, with
+    one new request per finished response.  Returns the received bytes.
+    """
+    request = ('GET /%s HTTP/1.0\r\nHost: localhost\r\n\r\n' % name
+               ).encode('ascii')
+    poller = select.poll()
+    sockets = {}
+
+    def connect(client):
+        # every client gets its own address, and thereby its own bucket
+        source = ('127.0.%d.%d' % (client // 250, client % 250 + 2), 0)
+        sock = socket.create_connection(('127.0.0.1', port),
+                                        source_address=source)
+        sock.sendall(request)
+        sock.setblocking(False)
+        sockets[sock.fileno()] = (client, sock)
+        poller.register(sock.fileno(), select.POLLIN)
+
+    for client in range(clients):
+        connect(client)
+
+    received = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for fd, event in poller.poll(100):
+            client, sock = sockets[fd]
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = b''
+            received += len(data)
+            if not data:
+                poller.unregister(fd)
+                del sockets[fd]
+                sock.close()
+                connect(client)
+    for client, sock in sockets.values():
+        sock.close()
+    return received
+
+def run(engine, path, name, clients, seconds, rate, client_rate, port=18182):
+    server = subprocess.Popen([sys.executable, __file__, 'serve', engine,
+                               path, str(port), str(rate), str(client_rate)],
+                              stdout=subprocess.PIPE)
+    server.stdout.readline()
+    received = drive(port, name, clients, seconds)
+    server.terminate()
+    result = json.loads(server.stdout.readline().decode('utf-8'))
+    server.wait()
+    result.update({'engine': engine,
+                   'clients': clients,
+                   'cpu-seconds/s': result['cpu'] / seconds,
+                   'rate': received / float(seconds),
+                   'configured-rate': rate})
+    return result
+
+def main(argv):
+    seconds = int(argv[0]) if argv else 10
+    rate = int(argv[1]) if len(argv) > 1 else 10 * 2 ** 20
+    client_rate = int(argv[2]) if len(argv) > 2 else 64 * 2 ** 10
+
+    path = tempfile.mkdtemp()
+    name = 'segment.ts'
+    with open(os.path.join(path, name), 'wb') as f:
+        f.write(os.urandom(4 * 2 ** 20))
+    try:
+        for clients in (10, 100, 1000):
+            for engine in ('htb', 'tick'):
+                print(json.dumps(run(engine, path, name, clients, seconds,
+                                     rate, client_rate), sort_keys=True))
+    finally:
+        os.unlink(os.path.join(path, name))
+        os.rmdir(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]),
+              int(sys.argv[6]))
+    else:
+        main(sys.argv[1:])
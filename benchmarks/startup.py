@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure how long a server takes to start, from a new interpreter to
+listening ports, for the configurations typically run: plain static files,
+a host with all caches and metrics, a reverse proxy with its cache and two
+hosts read from a C{--config} file.
+
+Usage: PYTHONPATH=. python benchmarks/startup.py [runs]
+
+Each run starts a new interpreter, which installs the reactor, imports
+L{mcs.server}, parses the options, builds the services with
+L{mcs.server.makeService} and starts them.  Reported are the 50th and 90th
+percentile of the total time, measured by the parent, the median time each
+step takes in the child and the optional modules which were loaded, if
+any.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# loaded only by the servers needing them, bonjour by all advertising hosts
+OPTIONAL = ('mcs.bonjour', 'mcs.proxycache', 'mcs.reverse', 'mcs.workers',
+            'twisted.web.client', 'twisted.web.distrib', 'yaml')
+
+PORT = '--port=tcp:0:interface=127.0.0.1'
+
+def configurations(path):
+    with open(os.path.join(path, 'config.json'), 'w') as f:
+        json.dump({'hosts': [{'port': 'tcp:18291:interface=127.0.0.1',
+                              'path': path, 'stat-cache': 30},
+                             {'port': 'tcp:18292:interface=127.0.0.1',
+                              'path': path, 'cache': 1 << 26,
+                              'vhosts': [{'fqdn': '*.tenant.example',
+                                          'path': path}]}]}, f)
+    return [
+        ('static', [PORT, '--path=%s' % path]),
+        ('caches', [PORT, '--path=%s' % path, '--cache=67108864',
+                    '--stat-cache=30', '--child-cache=4096',
+                    '--playlist-cache=0', '--listing-cache=256',
+                    '--compress=16777216', '--readahead=2',
+                    '--metrics=metrics']),
+        ('reverse', [PORT, '--reverse-cache=%s,67108864' %
+                     os.path.join(path, 'reverse'),
+                     '--reverse=127.0.0.1,9,/live']),
+        ('config', ['--config=%s' % os.path.join(path, 'config.json')]),
+    ]
+
+def start(options):
+    """Start a server with C{options} and report the time of each step."""
+    started = time.time()
+    # installed by twistd before it loads the plugin
+    from twisted.internet import reactor
+    installed = time.time()
+    from mcs import server
+    imported = time.time()
+    config = server.Options()
+    config.parseOptions(options)
+    parsed = time.time()
+    multiService = server.makeService(config)
+    made = time.time()
+    multiService.startService()
+    listening = time.time()
+    sys.stdout.write(json.dumps({
+        'reactor': installed - started,
+        'import': imported - installed,
+        'parse': parsed - imported,
+        'make-service': made - parsed,
+        'start-service': listening - made,
+        'loaded': [name for name in OPTIONAL if name in sys.modules]}) + '\n')
+    sys.stdout.flush()
+    multiService.stopService()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def run(name, options, runs):
+    totals = []
+    steps = []
+    for number in range(runs):
+        started = time.time()
+        process = subprocess.Popen([sys.executable, __file__, 'start'] +
+                                   options, stdout=subprocess.PIPE)
+        line = process.stdout.readline()
+        totals.append(time.time() - started)
+        process.wait()
+        if not line:
+            raise AssertionError('the server did not start: %s' % name)
+        steps.append(json.loads(line.decode('utf-8')))
+    result = {'configuration': name,
+              'runs': runs,
+              'p50': percentile(totals, 0.5),
+              'p90': percentile(totals, 0.9),
+              'loaded': steps[-1]['loaded']}
+    for step in ('reactor', 'import', 'parse', 'make-service', 'start-service'):
+        result[step] = percentile([s[step] for s in steps], 0.5)
+    return result
+
+def main(argv):
+    runs = int(argv[0]) if argv else 10
+    path = tempfile.mkdtemp()
+    try:
+        for name, options in configurations(path):
+            print(json.dumps(run(name, options, runs), sort_keys=True))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['start']:
+        start(sys.argv[2:])
+    else:
+        main(sys.argv[1:])
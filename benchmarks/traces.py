@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Profile the scheduler tick of L{mcs.shaper} refilling the buckets of 1k to
+20k clients, each replaying a trace of L{mcs.traces} on its own, against
+as many clients at a constant rate.
+
+Usage: PYTHONPATH=. python benchmarks/traces.py [ticks]
+
+The trace is a minute long, alternating every second between 12 and 1.2
+Mbit/s, and is resampled once for all clients.  Clients start replaying
+it one tick apart, so they are at different parts of it.  Reported are the
+microseconds each tick takes, per tick and per client, the bytes the
+resampled trace takes and the calls scheduled with the reactor, which
+stay none.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import task
+
+from mcs import shaper, traces
+
+CLIENTS = (1000, 2000, 5000, 10000, 20000)
+
+def record(path):
+    with open(path, 'w') as f:
+        for second in range(60):
+            # packets per millisecond, 12 or 1.2 mbit/s
+            step = 1 if second % 2 == 0 else 10
+            for ms in range(1, 1001, step):
+                f.write('%d\n' % (second * 1000 + ms))
+
+def profile(trace, clients, ticks):
+    clock = task.Clock()
+    scheduler = shaper.Scheduler(clock=clock)
+    shape = shaper.Shaper(10 ** 12, 187500, clientTrace=trace)
+    scheduler.addShaper(shape)
+    scheduler.refill()
+    for client in range(clients):
+        bucket = shape.bucketFor('10.%d.%d.%d' % (client >> 16,
+                                                  (client >> 8) & 255,
+                                                  client & 255))
+        bucket.tokens = 0
+        if trace is not None:
+            # as if connected one tick after the other
+            bucket.offset = client * scheduler.interval % trace.period
+            bucket.delivered = trace.delivered(bucket.offset)
+    started = time.time()
+    for tick in range(ticks):
+        clock.advance(scheduler.interval)
+        scheduler.refill()
+    elapsed = time.time() - started
+    return {'us/tick': elapsed / ticks * 1e6,
+            'us/client-tick': elapsed / ticks / clients * 1e6,
+            'delayed-calls': len(clock.getDelayedCalls())}
+
+def main(argv):
+    ticks = int(argv[0]) if argv else 100
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        record(path)
+        trace = traces.Trace.fromFile(path)
+    finally:
+        os.remove(path)
+    for clients in CLIENTS:
+        for mode in ('constant', 'traced'):
+            result = profile(trace if mode == 'traced' else None, clients,
+                             ticks)
+            result.update({'mode': mode, 'clients': clients,
+                           'trace-bytes': trace.cumulative.itemsize *
+                           len(trace.cumulative)})
+            print(json.dumps(result, sort_keys=True))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Measure the startup time of a server with many vhosts and how fast
+requests are dispatched to them, by L{mcs.vhosts.VirtualHostIndex} and by
+twisted's L{vhost.NameVirtualHost}.
+
+Usage: PYTHONPATH=. python benchmarks/vhosts.py [vhosts [lookups]]
+
+Every tenth vhost is a wildcard, all of them serve one of ten directories.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.web import vhost
+
+from mcs import server, vhosts
+
+class FakeRequest(object):
+
+    def __init__(self, host):
+        self.host = host
+
+    def getHeader(self, name):
+        return self.host
+
+def names(count):
+    for number in range(count):
+        if number % 10 == 9:
+            yield '*.tenant%d.example' % number
+        else:
+            yield 'customer%d.example' % number
+
+def startup(count, path):
+    argv = ['--port=tcp:0', '--path=%s' % path, '--stat-cache=30']
+    for number, name in enumerate(names(count)):
+        argv.extend(['--vhost=%s' % name,
+                     '--path=%s' % os.path.join(path, str(number % 10))])
+    started = time.time()
+    config = server.Options()
+    config.parseOptions(argv)
+    server.makeService(config)
+    return {'vhosts': count, 'startup-seconds': time.time() - started}
+
+def dispatch(count, lookups):
+    index = vhosts.VirtualHostIndex()
+    named = vhost.NameVirtualHost()
+    for name in names(count):
+        index.addHost(name, name)
+        named.addHost(name, name)
+    index.default = named.default = 'default'
+
+    results = []
+    for kind, host in (('exact', 'Customer%d.example:8080' % (count // 2)),
+                       ('wildcard', 'www.tenant%d.example' % (count - 1)),
+                       ('miss', 'unknown.example'),
+                       ('distinct-wildcards', None)):
+        if host is None:
+            # a different host name every time, never remembered
+            requests = [FakeRequest('w%d.tenant%d.example' % (i, count - 1))
+                        for i in range(lookups)]
+        else:
+            requests = [FakeRequest(host)] * lookups
+        for name, root in (('VirtualHostIndex', index),
+                           ('NameVirtualHost', named)):
+            lookup = root._getResourceForRequest
+            started = time.time()
+            for request in requests:
+                lookup(request)
+            elapsed = time.time() - started
+            results.append({'vhosts': count,
+                            'host': kind,
+                            'dispatcher': name,
+                            'lookups/s': lookups / elapsed,
+                            'result': lookup(requests[0])})
+    return results
+
+def main(argv):
+    count = int(argv[0]) if argv else 1000
+    lookups = int(argv[1]) if len(argv) > 1 else 200000
+
+    path = tempfile.mkdtemp()
+    for number in range(10):
+        os.mkdir(os.path.join(path, str(number)))
+    try:
+        print(json.dumps(startup(count, path), sort_keys=True))
+    finally:
+        shutil.rmtree(path)
+    for result in dispatch(count, lookups):
+        print(json.dumps(result, sort_keys=True))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,6 +2,11 @@
 # © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
 # See LICENSE for details.
 
-from mcs import alias, bonjour, mediatypes, shaper, static
-
-__all__ = ['alias', 'bonjour', 'mediatypes', 'shaper', 'static']
\ No newline at end of file
+# the submodules get imported by those using them, so that starting the
+# server does not load the optional ones like bonjour, while
+# "from mcs import *" imports all of them
+__all__ = ['accesslog', 'alias', 'bonjour', 'cache', 'compression',
+           'configfile', 'connections', 'listing', 'mediatypes', 'metrics',
+           'playlist', 'proxycache', 'ranges', 'readahead', 'reverse',
+           'sendfile', 'server', 'shaper', 'statcache', 'static', 'traces',
+           'uvloopreactor', 'vhosts', 'workers']
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Access logging off the reactor thread.
+
+twisted's sites write one line per request to their log file as the
+request finishes, on the reactor thread, and a slow disk holds up every
+connection of every site sharing the file.  An L{AccessLog} copies the
+lines into one of a few buffers allocated up front instead, and hands full
+buffers, or whatever has been buffered after C{interval} seconds, to a
+thread writing them to the file.  Should the disk fall so far behind that
+all buffers wait for it, lines are dropped and counted rather than
+blocking the reactor.  The file is rotated after C{rotateLength} bytes and
+reopened on SIGUSR1, for rotation by other tools.
+
+Lines are in the Combined Log Format, or JSON objects including the time a
+request waited for the buckets of L{mcs.shaper} and the bytes released
+once they had been refilled.
+"""
+
+import json
+import signal
+import threading
+
+from collections import deque
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.python import log, logfile
+from twisted.web import http, server
+
+from mcs import shaper
+
+FORMATS = ('combined', 'json')
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def jsonLogFormatter(request, mark, now):
+    """
+    Return the JSON line of C{request}, which started at C{mark} (see
+    L{AccessLogSite.getResourceFor}) and is finished at C{now}.
+    """
+    address = request.getClientAddress()
+    started, throttled, throttledBytes = mark or (now, 0.0, 0)
+    shaped = shaper.unwrapTransport(request.transport)[1]
+    if shaped is not None:
+        throttled = shaped.throttledTime() - throttled
+        throttledBytes = shaped.throttledBytes - throttledBytes
+    else:
+        throttled, throttledBytes = 0.0, 0
+    return json.dumps({
+        'time': round(started, 3),
+        'remote': _text(getattr(address, 'host', None)),
+        'host': _text(request.getHeader('host')),
+        'method': _text(request.method),
+        'uri': _text(request.uri),
+        'protocol': _text(request.clientproto),
+        'status': request.code,
+        'bytes': request.sentLength,
+        'referrer': _text(request.getHeader('referer')),
+        'user-agent': _text(request.getHeader('user-agent')),
+        'duration': round(now - started, 6),
+        'shaping-delay': round(throttled, 6),
+        'bytes-throttled': throttledBytes}, sort_keys=True)
+
+class _AppendingFile(object):
+    """
+    The file at C{path} opened for appending, which unlike a
+    L{logfile.LogFile} may be shared with other processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab', 0)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def reopen(self):
+        self._file.close()
+        self._file = open(self.path, 'ab', 0)
+
+    def close(self):
+        self._file.close()
+
+class AccessLog(service.Service):
+    """
+    Writes the lines logged to the file at C{path} from a thread, in batches
+    of up to C{bufferSize} bytes at least every C{interval} seconds.
+    """
+
+    buffers = 4
+
+    def __init__(self, path, bufferSize=2 ** 16, interval=1.0,
+                 rotateLength=0, maxRotatedFiles=None, format='combined',
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.path = path
+        self.bufferSize = bufferSize
+        self.interval = interval
+        self.rotateLength = rotateLength
+        self.maxRotatedFiles = maxRotatedFiles
+        self.format = format
+        self.clock = clock
+        self.free = deque(bytearray(bufferSize) for i in range(self.buffers))
+        self.buffer = None
+        self.length = 0
+        self.pending = queue.Queue()
+        self.thread = None
+        self.loop = None
+        self.previousHandler = None
+        self.lines = 0
+        self.dropped = 0
+        self.reportedDropped = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.rotateLength:
+            self.logFile = logfile.LogFile.fromFullPath(
+                self.path, rotateLength=self.rotateLength,
+                maxRotatedFiles=self.maxRotatedFiles)
+        else:
+            self.logFile = _AppendingFile(self.path)
+        self.thread = threading.Thread(target=self._writeBuffers,
+                                       name='access log writer')
+        self.thread.daemon = True
+        self.thread.start()
+        self.loop = task.LoopingCall(self.flush)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=False)
+        try:
+            self.previousHandler = signal.signal(signal.SIGUSR1,
+                                                 self._reopenSignalled)
+        except (AttributeError, ValueError):
+            # no SIGUSR1 or not the main thread
+            pass
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.previousHandler is not None:
+            signal.signal(signal.SIGUSR1, self.previousHandler)
+            self.previousHandler = None
+        self.loop.stop()
+        self.loop = None
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        self.logFile.close()
+
+    def _reopenSignalled(self, signum, frame):
+        self.clock.callFromThread(self.reopen)
+        if callable(self.previousHandler):
+            # twistd rotates its own log file on SIGUSR1
+            self.previousHandler(signum, frame)
+
+    def reopen(self):
+        """
+        Reopen the file, once the lines buffered so far have been written
+        to the old one, like before it got moved away by logrotate.
+        """
+        self.flush()
+        self.pending.put('reopen')
+
+    def write(self, line):
+        """Buffer the bytes of C{line} for writing."""
+        length = len(line)
+        if self.length + length > self.bufferSize:
+            self.flush()
+            if length > self.bufferSize:
+                # would not fit in any buffer anyway
+                self.lines += 1
+                self.pending.put((bytearray(line), length))
+                return
+        if self.buffer is None:
+            if not self.free:
+                self.dropped += 1
+                return
+            self.buffer = self.free.popleft()
+        self.buffer[self.length:self.length + length] = line
+        self.length += length
+        self.lines += 1
+
+    def flush(self):
+        """Hand whatever has been buffered to the writing thread."""
+        if self.dropped != self.reportedDropped:
+            log.msg('access log behind, dropped %d lines' %
+                    (self.dropped - self.reportedDropped))
+            self.reportedDropped = self.dropped
+        if self.buffer is None:
+            return
+        if self.length:
+            self.pending.put((self.buffer, self.length))
+            self.buffer = None
+            self.length = 0
+
+    def _writeBuffers(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if item == 'reopen':
+                try:
+                    self.logFile.reopen()
+                except Exception:
+                    log.err(None, 'reopening the access log failed')
+                continue
+            buffer, length = item
+            try:
+                self.logFile.write(memoryview(buffer)[:length].tobytes())
+            except Exception:
+                log.err(None, 'writing the access log failed')
+            if len(buffer) == self.bufferSize:
+                self.free.append(buffer)
+
+    def log(self, request, timestamp, mark=None):
+        if self.format == 'json':
+            line = jsonLogFormatter(request, mark, self.clock.seconds())
+        else:
+            line = http.combinedLogFormatter(timestamp, request)
+        self.write(line.encode('utf-8') + b'\n')
+
+    def stats(self):
+        return {'lines': self.lines,
+                'dropped': self.dropped,
+                'buffered': self.length,
+                'pending': self.pending.qsize(),
+                'free-buffers': len(self.free)}
+
+class AccessLogSite(server.Site):
+    """
+    A L{server.Site} logging its requests to an L{AccessLog}.
+    """
+
+    def __init__(self, resource, accessLog, *a, **kw):
+        server.Site.__init__(self, resource, *a, **kw)
+        self.accessLog = accessLog
+
+    def getResourceFor(self, request):
+        # the start of the request, for the JSON lines
+        shaped = shaper.unwrapTransport(request.transport)[1]
+        if shaped is not None:
+            request.accessLogMark = (self.accessLog.clock.seconds(),
+                                     shaped.throttledTime(),
+                                     shaped.throttledBytes)
+        else:
+            request.accessLogMark = (self.accessLog.clock.seconds(), 0.0, 0)
+        return server.Site.getResourceFor(self, request)
+
+    def log(self, request):
+        self.accessLog.log(request, self._logDateTime,
+                           getattr(request, 'accessLogMark', None))
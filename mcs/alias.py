@@ -2,6 +2,14 @@
 # © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
 # See LICENSE for details.
 
+from twisted.web import resource
+
+def _segments(path):
+    """Split C{path} into segments like those of C{request.postpath}."""
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return path.split(b'/')
+
 def rewrite(aliasPath, destPath):
     """
     Original implementation in twisted.web.rewrite.alias.  This one
@@ -14,11 +22,11 @@ def rewrite(aliasPath, destPath):
     alias static.File directory listings that nicely. However, I can
     still be useful, as many resources will play nice.
     """
-    aliasPath = aliasPath.split('/')
-    destPath = destPath.split('/')
-    if destPath == ['']:
+    aliasPath = _segments(aliasPath)
+    destPath = _segments(destPath)
+    if destPath == [b'']:
         def prepend_destPath(after):
-            return after or ['']
+            return after or [b'']
     else:
         def prepend_destPath(after):
             return destPath + after
@@ -26,5 +34,93 @@ def rewrite(aliasPath, destPath):
         if request.postpath[:len(aliasPath)] == aliasPath:
             after = request.postpath[len(aliasPath):]
             request.postpath = prepend_destPath(after)
-            request.path = '/' + '/'.join(request.prepath + request.postpath)
-    return rewriter
\ No newline at end of file
+            request.path = b'/' + b'/'.join(request.prepath +
+                                            request.postpath)
+    return rewriter
+
+class _Node(object):
+    """A path segment of an L{AliasTable}."""
+
+    __slots__ = ('children', 'destPath')
+
+    def __init__(self):
+        self.children = {}
+        self.destPath = None
+
+class AliasTable(object):
+    """
+    All aliases of a host compiled into a trie keyed on path segments, so
+    that finding the alias of a request takes one dict lookup per segment,
+    no matter how many aliases are defined.  The longest matching alias
+    path wins, of aliases defined twice the first one.
+    """
+
+    def __init__(self, aliases=()):
+        self.root = _Node()
+        self.size = 0
+        for aliasPath, destPath in aliases:
+            self.add(aliasPath, destPath)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, aliasPath, destPath):
+        node = self.root
+        for segment in _segments(aliasPath):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if node.destPath is not None:
+            return
+        destPath = _segments(destPath)
+        if destPath == [b'']:
+            destPath = []
+        node.destPath = destPath
+        self.size += 1
+
+    def match(self, segments):
+        """
+        Return the number of leading C{segments} matching the longest alias
+        and its destination segments, or C{(0, None)}.
+        """
+        node = self.root
+        depth, destPath = 0, None
+        for index, segment in enumerate(segments):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.destPath is not None:
+                depth, destPath = index + 1, node.destPath
+        return depth, destPath
+
+    def rewrite(self, request):
+        depth, destPath = self.match(request.postpath)
+        if destPath is not None:
+            request.postpath = (destPath + request.postpath[depth:]) or [b'']
+            request.path = b'/' + b'/'.join(request.prepath +
+                                            request.postpath)
+
+class AliasResource(resource.Resource):
+    """
+    Rewrites the path of requests with an L{AliasTable} before passing them
+    on to the wrapped resource, like L{twisted.web.rewrite.RewriterResource}
+    does with a chain of L{rewrite} rules.
+    """
+
+    def __init__(self, orig, table):
+        resource.Resource.__init__(self)
+        self.resource = orig
+        self.table = table
+
+    def getChild(self, path, request):
+        request.postpath.insert(0, path)
+        request.prepath.pop()
+        self.table.rewrite(request)
+        path = request.postpath.pop(0)
+        request.prepath.append(path)
+        return self.resource.getChildWithDefault(path, request)
+
+    def render(self, request):
+        self.table.rewrite(request)
+        return self.resource.render(request)
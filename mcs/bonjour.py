@@ -2,32 +2,57 @@
 # © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
 # See LICENSE for details.
 
-# import sys, os
+"""
+Advertise the hosts of the server via bonjour (mDNS/zeroconf).
+
+The module is only imported by L{mcs.server} when it advertises hosts, and
+without the pybonjour-library L{available} is false and nothing gets
+advertised, instead of the server refusing to start.
+"""
+
+import socket
 
 from twisted.application import service
-from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.interfaces import IReadDescriptor
 from twisted.python import log
 from zope import interface
 
-# d = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-# sys.path.insert(0, os.path.abspath(os.path.join(d, os.pardir, 'pybonjour')))
-# del d
 try:
     import pybonjour
 except ImportError:
-    print "pybonjour-library missing in %s" % __file__
-    exit(1);
+    pybonjour = None
+
+# looked up by computerName once
+_computerName = None
+
+def available():
+    """Return whether the pybonjour-library is installed."""
+    return pybonjour is not None
 
+def computerName():
+    """
+    Return the name of this computer for the bonjour descriptions, the
+    hostname without its domain, or C{localhost} if it has none.
+    """
+    global _computerName
+    if _computerName is None:
+        try:
+            name = socket.gethostname()
+        except socket.error:
+            name = ''
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', 'replace')
+        _computerName = name.split('.', 1)[0] or u'localhost'
+    return _computerName
+
+@interface.implementer(IReadDescriptor)
 class mDNSServiceDescriptor(object):
     """
     Glue for integrating a pybonjour service with twisted.
     See: http://www.indelible.org/ink/twisted-bonjour/
     """
 
-    interface.implements(IReadDescriptor)
-
     def __init__(self, sdref):
         self.sdref = sdref
 
@@ -90,6 +115,7 @@ class mDNSService(service.Service):
                                                        port=self.mdns_port,
                                                        callBack=_callback)
 
+        from twisted.internet import reactor
         reactor.addReader(mDNSServiceDescriptor(self.mdns_sdref))
 
         return d
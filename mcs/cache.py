@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Size-bounded in-memory caches for the bodies of static files.
+"""
+
+import json
+import os
+
+from collections import OrderedDict
+
+from twisted.web import resource, static
+
+from mcs import mediatypes
+
+def entityTag(inode, size, mtime):
+    """Return a strong ETag of a file's C{inode}, C{size} and C{mtime}."""
+    return '"%x-%x-%x"' % (inode, size, int(mtime * 1000000))
+
+def entityTagMatches(header, etag):
+    """
+    Return whether the If-None-Match C{header} lists C{etag}, weak or not,
+    or C{*}.
+    """
+    if isinstance(header, bytes) and not isinstance(etag, bytes):
+        # the raw header with python 3
+        header = header.decode('latin-1')
+    for tag in (header or '').split(','):
+        tag = tag.strip()
+        if tag[:2] == 'W/':
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
+class LRUCache(object):
+    """
+    Maps keys to immutable byte strings, evicting the least recently used
+    entries once more than C{maxBytes} are held.  Each entry carries a
+    version (eg. modification time and size of a file); looking up an entry
+    with a different version invalidates it.
+    """
+
+    def __init__(self, maxBytes, maxEntrySize=None):
+        self.maxBytes = maxBytes
+        if maxEntrySize is None:
+            maxEntrySize = maxBytes
+        self.maxEntrySize = min(maxEntrySize, maxBytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, version):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] != version:
+            self.size -= len(entry[1])
+            self.invalidations += 1
+            self.misses += 1
+            return None
+        # re-insert as the most recently used entry
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, data):
+        """
+        Cache C{data} for C{key}, returns whether it has been cached at all.
+        """
+        if len(data) > self.maxEntrySize:
+            return False
+        self.invalidate(key)
+        while self.entries and self.size + len(data) > self.maxBytes:
+            evicted = self.entries.popitem(last=False)[1]
+            self.size -= len(evicted[1])
+            self.evictions += 1
+        self.entries[key] = (version, data)
+        self.size += len(data)
+        return True
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+            self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'bytes': self.size,
+                'max-bytes': self.maxBytes,
+                'max-entry-size': self.maxEntrySize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+class SegmentCache(LRUCache):
+    """
+    Caches the bodies of media segments and playlists, keyed by their path
+    and versioned by modification time and size.  Only files with one of the
+    given C{extensions} are cached, all of which must be known media types
+    of L{mediatypes.VIDEO_MIME_TYPES}.
+    """
+
+    def __init__(self, maxBytes, maxEntrySize=None,
+                 extensions=mediatypes.SEGMENT_EXTENSIONS):
+        LRUCache.__init__(self, maxBytes, maxEntrySize)
+        self.extensions = set()
+        for extension in extensions:
+            self.addExtension(extension)
+
+    def addExtension(self, extension):
+        extension = extension.lower()
+        if not extension.startswith('.'):
+            extension = '.' + extension
+        if extension not in mediatypes.VIDEO_MIME_TYPES:
+            raise ValueError("not a media type: %s" % extension)
+        self.extensions.add(extension)
+
+    def cacheable(self, path):
+        return os.path.splitext(path)[1].lower() in self.extensions
+
+class CachedFile(object):
+    """
+    Read-only file-like object over a cached body, as returned by
+    L{mcs.static.File.openForReading} on cache hits.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        start = self.position
+        if size < 0:
+            end = len(self.data)
+        else:
+            end = min(start + size, len(self.data))
+        self.position = end
+        if start == 0 and end == len(self.data):
+            return self.data
+        return self.data[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += len(self.data)
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+class CachedProducer(static.StaticProducer):
+    """
+    Writes a range of a L{CachedFile} in one go.  The whole body is written
+    without copying it at all.
+    """
+
+    def __init__(self, request, fileObject, offset, size):
+        static.StaticProducer.__init__(self, request, fileObject)
+        self.offset = offset
+        self.size = size
+
+    def start(self):
+        self.fileObject.seek(self.offset)
+        self.request.write(self.fileObject.read(self.size))
+        request = self.request
+        self.stopProducing()
+        request.finish()
+
+    def resumeProducing(self):
+        pass
+
+def fromStaticProducer(producer):
+    """
+    Return a L{CachedProducer} replacing the given single-range or whole-file
+    producer of L{twisted.web.static} reading a L{CachedFile}, or C{None}.
+    """
+    if not isinstance(producer.fileObject, CachedFile):
+        return None
+    if isinstance(producer, static.SingleRangeStaticProducer):
+        offset, size = producer.offset, producer.size
+    elif isinstance(producer, static.NoRangeStaticProducer):
+        offset, size = 0, len(producer.fileObject.data)
+    else:
+        return None
+    return CachedProducer(producer.request, producer.fileObject, offset, size)
+
+class CacheStatistics(resource.Resource):
+    """
+    Renders the counters of a cache as JSON, to size it in production.
+    """
+
+    isLeaf = True
+
+    def __init__(self, cache):
+        resource.Resource.__init__(self)
+        self.cache = cache
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('cache-control', 'no-cache')
+        return json.dumps(self.cache.stats(), sort_keys=True).encode('utf-8')
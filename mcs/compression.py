@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Content-encoding negotiation for playlists and manifests.
+
+HLS playlists and HDS manifests are text which compresses to a fraction of
+its size, while the media segments they refer to do not compress at all.
+For the text media types only, L{mcs.static.File} sends a precompressed
+C{.br} or C{.gz} file lying next to the requested one, or else a variant
+compressed once per version of the file and kept in a L{VariantCache}.
+Brotli is used if the C{brotli} module is installed, gzip is always
+available.
+"""
+
+import os
+import time
+import zlib
+
+from mcs import cache, mediatypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# preferred when accepted with the same quality
+PREFERENCE = ('br', 'gzip')
+
+# file extensions of precompressed siblings
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# processor time, rather than wall-clock time, of compressing
+_processTime = getattr(time, 'process_time', None) or time.clock
+
+def acceptedEncodings(header):
+    """
+    Return the codings of L{PREFERENCE} accepted by the Accept-Encoding
+    C{header}, in the client's order of preference.
+    """
+    if not header:
+        return []
+    qualities = {}
+    for item in header.split(','):
+        coding, ignored, parameters = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            name, ignored, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    accepted = []
+    for preference, coding in enumerate(PREFERENCE):
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > 0:
+            accepted.append((-quality, preference, coding))
+    accepted.sort()
+    return [coding for quality, preference, coding in accepted]
+
+def compress(data, encoding, level):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=level)
+    raise ValueError("unsupported content-coding: %s" % encoding)
+
+class VariantCache(cache.LRUCache):
+    """
+    Caches compressed variants of text files with one of the given
+    C{extensions}, keyed by path and coding and versioned like the
+    L{cache.SegmentCache}.  Files larger than C{maxEntrySize} are not
+    compressed on the fly.
+    """
+
+    levels = {'br': 9, 'gzip': 9}
+
+    def __init__(self, maxBytes, maxEntrySize=None,
+                 extensions=mediatypes.TEXT_EXTENSIONS):
+        cache.LRUCache.__init__(self, maxBytes, maxEntrySize)
+        self.extensions = frozenset(extension.lower()
+                                    for extension in extensions)
+        self.encodings = tuple(coding for coding in PREFERENCE
+                               if coding != 'br' or brotli is not None)
+        self.compressions = 0
+        self.compressionTime = 0.0
+        self.encodedResponses = 0
+        self.precompressedResponses = 0
+        self.bytesSaved = 0
+
+    def cacheable(self, path):
+        return os.path.splitext(path)[1].lower() in self.extensions
+
+    def variant(self, path, version, data, encoding):
+        """
+        Return C{data}, the body of C{path} at C{version}, compressed with
+        C{encoding}, or C{None} if that does not make it any smaller.
+        """
+        key = (path, encoding)
+        variant = self.get(key, version)
+        if variant is None:
+            started = _processTime()
+            variant = compress(data, encoding, self.levels[encoding])
+            self.compressionTime += _processTime() - started
+            self.compressions += 1
+            if len(variant) >= len(data):
+                # remembered as not worth it
+                variant = b''
+            self.put(key, version, variant)
+        return variant or None
+
+    def negotiate(self, request, path, version, data):
+        """
+        Return the coding and body to send C{data} with to the client of
+        C{request}, which is C{(None, data)} unless it accepts one of our
+        codings.
+        """
+        if len(data) <= self.maxEntrySize:
+            for encoding in acceptedEncodings(
+                    request.getHeader('accept-encoding')):
+                if encoding in self.encodings:
+                    variant = self.variant(path, version, data, encoding)
+                    if variant is not None:
+                        self.sent(len(data), len(variant))
+                        return encoding, variant
+                    break
+        return None, data
+
+    def sent(self, size, encodedSize, precompressed=False):
+        """Count a response sent encoded instead of C{size} bytes."""
+        self.encodedResponses += 1
+        if precompressed:
+            self.precompressedResponses += 1
+        self.bytesSaved += size - encodedSize
+
+    def stats(self):
+        stats = cache.LRUCache.stats(self)
+        stats.update({'encodings': list(self.encodings),
+                      'compressions': self.compressions,
+                      'compression-cpu-seconds': self.compressionTime,
+                      'encoded-responses': self.encodedResponses,
+                      'precompressed-responses': self.precompressedResponses,
+                      'bytes-saved': self.bytesSaved})
+        return stats
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Configuration files instead of endless command lines.
+
+A JSON, YAML or TOML file given with C{--config} holds the options of the
+command line, the global ones at the top level and the others in a list of
+C{hosts}, each with a list of C{vhosts}, eg.::
+
+    logfile: /var/log/mcs/access.log
+    hosts:
+      - port: tcp:8080
+        path: /srv/media
+        cache: [268435456, 16777216]
+        vhosts:
+          - fqdn: "*.tenant.example"
+            path: /srv/tenants
+            alias: {live: hls/live}
+
+Keys are the long option names.  Lists of repeatable options like
+C{alias} give the option once per item, other lists are joined with
+commas, mappings give C{key,value} items and C{true} gives a flag.  The
+file is validated and translated into the command line it stands for, so
+every option is checked exactly as on the command line.  YAML and TOML
+need PyYAML and a TOML parser to be installed.
+
+On SIGHUP the resource trees of all hosts are built from the file again,
+reusing the caches of the running hosts, and swapped in; requests being
+served complete on the old tree.  Ports, workers, logging, shaping and
+cache sizes only change on restart.
+"""
+
+import json
+import os
+import signal
+import sys
+
+from collections import OrderedDict
+
+from twisted.application import service
+from twisted.python import log, usage
+
+# only at the top level
+GLOBAL_OPTIONS = frozenset(['logfile', 'workers', 'notracebacks',
+                            'no-sendfile', 'log-buffer', 'log-rotate',
+                            'log-format'])
+
+# apply to the --reverse proxies following them, at any level
+REVERSE_OPTIONS = frozenset(['reverse-pool', 'reverse-cache'])
+
+# of a vhost, all others are those of its host
+VHOST_OPTIONS = frozenset(['path', 'user', 'index', 'alias', 'mime-type',
+                           'allow-ignore-ext', 'ignore-ext', 'reverse',
+                           'reverse-pool', 'reverse-cache', 'monster',
+                           'metrics'])
+
+# of the configuration as a whole, which only change on restart
+RESTART_OPTIONS = ('logfile', 'log_buffer', 'log_rotate', 'log_format',
+                   'no-sendfile')
+
+# given once per item of a list
+REPEATED_OPTIONS = frozenset(['index', 'alias', 'cache-ext', 'cache-stats',
+                              'compress-stats', 'ignore-ext', 'bonjour',
+                              'reverse', 'monster', 'metrics'])
+
+# given before the other options of a host or vhost, in this order
+LEADING_OPTIONS = ('path', 'user', 'reverse-pool', 'reverse-cache',
+                   'reverse')
+
+# the options of the hosts and vhosts themselves
+STRUCTURE = frozenset(['config', 'port', 'host', 'vhost', 'hosts', 'vhosts',
+                       'fqdn'])
+
+def _native(value):
+    if not isinstance(value, str) and hasattr(value, 'encode') and \
+       sys.version_info[0] < 3:
+        return value.encode('utf-8')
+    return str(value)
+
+def _yaml():
+    # imported with the first YAML file only, as it takes a while
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError("PyYAML is not installed")
+    return yaml
+
+def _toml():
+    try:
+        import tomllib as toml
+    except ImportError:
+        try:
+            import tomli as toml
+        except ImportError:
+            try:
+                import toml
+            except ImportError:
+                raise ValueError("no TOML parser is installed")
+    return toml
+
+def load(path):
+    """Return the mapping in the JSON, YAML or TOML file at C{path}."""
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension in ('.yaml', '.yml'):
+            yaml = _yaml()
+            with open(path) as f:
+                document = yaml.safe_load(f)
+        elif extension == '.toml':
+            toml = _toml()
+            with open(path, 'rb') as f:
+                data = f.read()
+            document = toml.loads(data.decode('utf-8'))
+        else:
+            with open(path) as f:
+                document = json.load(f, object_pairs_hook=OrderedDict)
+    except Exception as e:
+        raise ValueError("%s: %s" % (path, e))
+    if not isinstance(document, dict):
+        raise ValueError("%s: not a mapping of options" % path)
+    return document
+
+def _arguments(where, options, allowed, known):
+    """
+    Return the command line arguments of the mapping C{options} of
+    C{allowed} option names, found C{where} in the file.
+    """
+    if not isinstance(options, dict):
+        raise ValueError("%s: not a mapping of options" % where)
+    names = [name for name in LEADING_OPTIONS if name in options]
+    names.extend(sorted(name for name in options
+                        if name not in LEADING_OPTIONS and
+                        name not in STRUCTURE))
+    arguments = []
+    for name in names:
+        if name not in allowed or name not in known:
+            raise ValueError("%s: unknown or misplaced option %s" %
+                             (where, name))
+        value = options[name]
+        name = _native(name)
+        if known[name] is False:
+            # a flag
+            if value is True:
+                arguments.append('--%s' % name)
+            elif value not in (False, None):
+                raise ValueError("%s: %s is a flag, true or false" %
+                                 (where, name))
+            continue
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            values = [[key, item] for key, item in value.items()]
+        elif isinstance(value, (list, tuple)) and name in REPEATED_OPTIONS:
+            values = value
+        else:
+            values = [value]
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                value = ','.join(_native(item) for item in value)
+            arguments.append('--%s=%s' % (name, _native(value)))
+    return arguments
+
+def arguments(path, known):
+    """
+    Return the command line the file at C{path} stands for, given the
+    C{known} long options, mapped to whether they take a value.
+    """
+    document = load(path)
+    hosts = document.get('hosts')
+    if not isinstance(hosts, list) or not hosts:
+        raise ValueError("%s: no list of hosts" % path)
+
+    arguments = _arguments(path, document, GLOBAL_OPTIONS | REVERSE_OPTIONS,
+                           known)
+    hostOptions = frozenset(known) - GLOBAL_OPTIONS
+    ports = set()
+    for number, host in enumerate(hosts):
+        where = "%s: hosts[%d]" % (path, number)
+        port = isinstance(host, dict) and host.get('port')
+        if not port:
+            raise ValueError("%s: no port" % where)
+        port = _native(port)
+        if port.isdigit():
+            port = 'tcp:%s' % port
+        if port in ports:
+            raise ValueError("%s: port %s used twice" % (where, port))
+        ports.add(port)
+        arguments.append('--%s=%s' % ('port' if number == 0 else 'host',
+                                      port))
+        arguments.extend(_arguments(where, host, hostOptions, known))
+
+        vhosts = host.get('vhosts') or []
+        if not isinstance(vhosts, list):
+            raise ValueError("%s: vhosts is no list" % where)
+        fqdns = set()
+        for index, vhost in enumerate(vhosts):
+            vhostWhere = "%s.vhosts[%d]" % (where, index)
+            fqdn = isinstance(vhost, dict) and vhost.get('fqdn')
+            if not fqdn:
+                raise ValueError("%s: no fqdn" % vhostWhere)
+            fqdn = _native(fqdn).lower()
+            if fqdn in fqdns:
+                raise ValueError("%s: vhost %s defined twice" %
+                                 (vhostWhere, fqdn))
+            fqdns.add(fqdn)
+            arguments.append('--vhost=%s' % fqdn)
+            arguments.extend(_arguments(vhostWhere, vhost, VHOST_OPTIONS,
+                                        known))
+    return arguments
+
+def knownOptions(options):
+    """
+    Return the long options of the L{usage.Options} C{options}, mapped to
+    whether they take a value.
+    """
+    known = {}
+    for name in options.longOpt:
+        if name.endswith('='):
+            known[name[:-1]] = True
+        else:
+            known[name] = False
+    return known
+
+def expand(options, argv):
+    """
+    Return C{argv} with C{--config=path} replaced by the command line the
+    file stands for, given the L{usage.Options} C{options} to parse it.
+    """
+    expanded = []
+    argv = list(argv)
+    while argv:
+        argument = argv.pop(0)
+        if argument == '--config' and argv:
+            argument = '--config=%s' % argv.pop(0)
+        if argument.startswith('--config='):
+            path = os.path.abspath(argument[len('--config='):])
+            try:
+                expanded.append('--config=%s' % path)
+                expanded.extend(arguments(path, knownOptions(options)))
+            except (IOError, ValueError) as e:
+                raise usage.UsageError("Invalid configuration: %s" % e)
+        else:
+            expanded.append(argument)
+    return expanded
+
+class ConfigReloader(service.Service):
+    """
+    Rebuilds the resource trees of the running C{hosts}, pairs of their
+    configuration and L{server.Site}, from the configuration file of the
+    options C{config} on SIGHUP.
+    """
+
+    def __init__(self, multiService, config, hosts):
+        self.multiService = multiService
+        self.config = config
+        self.hosts = hosts
+        self.previousHandler = None
+
+    def startService(self):
+        service.Service.startService(self)
+        try:
+            self.previousHandler = signal.signal(signal.SIGHUP,
+                                                 self._reloadSignalled)
+        except (AttributeError, ValueError):
+            # no SIGHUP or not the main thread
+            pass
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.previousHandler is not None:
+            signal.signal(signal.SIGHUP, self.previousHandler)
+            self.previousHandler = None
+
+    def _reloadSignalled(self, signum, frame):
+        from twisted.internet import reactor
+        reactor.callFromThread(self.reload)
+        if callable(self.previousHandler):
+            # shaping profiles
+            self.previousHandler(signum, frame)
+
+    def reload(self):
+        from mcs import server
+
+        config = server.Options()
+        # keep what lives beyond a single resource tree
+        config['metrics'] = self.config['metrics']
+        config['reverse_cache_map'] = self.config['reverse_cache_map']
+        try:
+            config.parseOptions(['--config=%s' % self.config['config']])
+        except usage.UsageError as e:
+            log.msg('reloading %s failed, keeping the configuration: %s' %
+                    (self.config['config'], e))
+            return
+
+        changed = [name for name in RESTART_OPTIONS
+                   if config[name] != self.config[name]]
+        if self.config['metrics'] is None and config['metrics'] is not None:
+            changed.append('metrics')
+        if changed:
+            log.msg('restart to apply the changes of %s' % ', '.join(changed))
+
+        reloaded = dict((host_config['port'], host_config)
+                        for host_config in config['hosts'])
+        for index, (running, site) in enumerate(self.hosts):
+            host_config = reloaded.pop(running['port'], None)
+            if host_config is None:
+                log.msg('restart to remove the host on %s' % running['port'])
+                continue
+            changed = [name for name in server.RESTART_SETTINGS
+                       if host_config[name] != running[name]]
+            if changed:
+                log.msg('restart to apply the changes of %s on %s' %
+                        (', '.join(changed), running['port']))
+            server.adoptCaches(host_config, running)
+            if host_config['child_cache'] is not None:
+                # holds the resources of the old tree
+                host_config['child_cache'].clear()
+            playlists = set(host_config['playlist_caches'])
+            # swapped in as a whole, requests being served keep the old tree
+            site.resource = server.prepareRoot(self.multiService, host_config)
+            site.displayTracebacks = not config['notracebacks']
+            if getattr(site, 'metrics', None) is not None:
+                site.metrics.addVhosts(vhost_config['fqdn'] for vhost_config
+                                       in host_config['vhosts'])
+                for root in set(host_config['playlist_caches']) - playlists:
+                    config['metrics'].addStats('playlist_cache',
+                        host_config['playlist_caches'][root],
+                        host=running['port'], root=root)
+            self.hosts[index] = (host_config, site)
+        for port in sorted(reloaded):
+            log.msg('restart to add the host on %s' % port)
+
+        server.startReverseCaches(self.multiService, config,
+                                  self.config['worker'],
+                                  self.config['reverse_caches'])
+        config['worker'] = self.config['worker']
+        config['reverse_caches'] = list(self.config['reverse_caches']) + [
+            proxyCache for proxyCache in config['reverse_caches']
+            if proxyCache not in self.config['reverse_caches']]
+        self.config = config
+        log.msg('reloaded %s' % config['config'])
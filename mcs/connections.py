@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Connection management of a site: how many requests a persistent connection
+may carry, how many connections may be open at once and whether responses
+are sent with Nagle's algorithm.
+
+Players fetching a segment every few seconds keep their connections open,
+so a host either limits them or runs out of file descriptors.  Instead of
+accepting connections beyond the limit, the listening port stops reading
+until one is closed again, so that the kernel's accept backlog and, once
+that is full, the clients' connection attempts hold them back.  Idle
+connections are closed by the C{timeOut} of the site itself.
+"""
+
+import socket
+
+from twisted.python import log
+
+# how responses are handed to the network
+TCP_SEND = ('nodelay', 'nagle', 'cork')
+
+def corkable():
+    """Return whether TCP_CORK is available on this platform."""
+    return hasattr(socket, 'TCP_CORK')
+
+def cork(handle, corked):
+    """Hold back partial segments on the socket C{handle}, or release them."""
+    try:
+        handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+    except socket.error:
+        # closed meanwhile
+        pass
+
+def _listeningPort(transport):
+    """
+    Return the port which accepted the connection of C{transport}, looking
+    through wrapping transports like TLS, or C{None} if it has none.
+    """
+    while transport is not None:
+        port = getattr(transport, 'server', None)
+        if port is not None and hasattr(port, 'stopReading'):
+            return port
+        transport = getattr(transport, 'transport', None)
+    return None
+
+def _channel(proto):
+    # the HTTP/1.1 channel behind twisted's protocol negotiating HTTP/2
+    return getattr(proto, '_channel', proto)
+
+class ConnectionLimits(object):
+    """
+    Wraps a protocol factory (or class), so that the HTTP channels it
+    creates serve at most C{maxRequests} requests per connection, and the
+    ports accepting them pause while C{maxConnections} connections are
+    open.  Connections accepted in the same burst as the one reaching the
+    limit are closed at once.  C{tcpSend} switches Nagle's algorithm off
+    for C{nodelay} and C{cork} or on for C{nagle}, None leaves it as
+    twisted sets it.
+    """
+
+    def __init__(self, protocol, maxRequests=None, maxConnections=None,
+                 tcpSend=None):
+        self.protocol = protocol
+        self.maxRequests = maxRequests
+        self.maxConnections = maxConnections
+        self.tcpSend = tcpSend
+        self.connections = 0
+        self.paused = set()
+        self.pauses = 0
+        self.refused = 0
+        self.closedAfterMax = 0
+
+    def __call__(self, *a, **kw):
+        proto = self.protocol(*a, **kw)
+        origMakeConnection = proto.makeConnection
+        origConnectionLost = proto.connectionLost
+        limits = self
+        accepted = [False]
+
+        def makeConnection(transport):
+            if not limits._accept(transport):
+                transport.loseConnection()
+                return
+            accepted[0] = True
+            result = origMakeConnection(transport)
+            # twisted's channel may have set it when the connection was made
+            if limits.tcpSend is not None and \
+                    hasattr(transport, 'setTcpNoDelay'):
+                transport.setTcpNoDelay(limits.tcpSend != 'nagle')
+            return result
+
+        def connectionLost(reason):
+            if not accepted[0]:
+                # never connected to the protocol
+                return
+            limits._release()
+            return origConnectionLost(reason)
+
+        proto.makeConnection = makeConnection
+        proto.connectionLost = connectionLost
+        if self.maxRequests is not None:
+            self._limitRequests(_channel(proto))
+        return proto
+
+    def _limitRequests(self, channel):
+        origCheckPersistence = channel.checkPersistence
+        served = [0]
+        limits = self
+
+        def checkPersistence(request, version):
+            persistent = origCheckPersistence(request, version)
+            served[0] += 1
+            if persistent and served[0] >= limits.maxRequests:
+                request.responseHeaders.setRawHeaders(b'connection',
+                                                      [b'close'])
+                limits.closedAfterMax += 1
+                return False
+            return persistent
+
+        channel.checkPersistence = checkPersistence
+
+    def _accept(self, transport):
+        if self.maxConnections is None:
+            self.connections += 1
+            return True
+        if self.connections >= self.maxConnections:
+            # beyond the limit, in the burst which reached it
+            self.refused += 1
+            return False
+        self.connections += 1
+        if self.connections >= self.maxConnections:
+            port = _listeningPort(transport)
+            if port is not None and port not in self.paused:
+                port.stopReading()
+                self.paused.add(port)
+                self.pauses += 1
+                log.msg('%d connections open, pausing accepting on %s' %
+                        (self.connections, port.getHost()))
+        return True
+
+    def _release(self):
+        self.connections -= 1
+        if self.paused and self.connections < self.maxConnections:
+            paused, self.paused = self.paused, set()
+            for port in paused:
+                if port.connected:
+                    port.startReading()
+
+    def stats(self):
+        return {'connections': self.connections,
+                'max-connections': self.maxConnections,
+                'max-requests': self.maxRequests,
+                'paused': len(self.paused),
+                'pauses': self.pauses,
+                'refused': self.refused,
+                'closed-after-max-requests': self.closedAfterMax}
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Directory listings built off the reactor thread.
+
+Segment directories of live streams hold tens of thousands of files, and
+twisted's L{static.DirectoryLister} lists and stats all of them on the
+reactor thread, stalling every other client meanwhile.  The
+L{DirectoryCache} reads directories in the reactor's thread pool and keeps
+them until the directory is modified.  Entries are statted in batches when
+they are rendered for the first time, so that the first rows of a
+L{DirectoryListing} are sent before the whole directory has been statted,
+and a page of a paginated listing only ever stats the entries on it.
+"""
+
+import json
+import os
+import stat
+
+from collections import OrderedDict
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape
+
+try:
+    from urllib.parse import quote as urlquote
+except ImportError:
+    from urllib import quote as urlquote
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.web import resource, server, static
+
+def _bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+def _native(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8')
+
+class Listing(object):
+    """
+    The sorted names in a directory, and the C{(isdir, size)} of those which
+    have been statted already.  Entries which vanished are C{None}.
+    """
+
+    __slots__ = ('path', 'mtime', 'names', 'entries')
+
+    def __init__(self, path, mtime, names):
+        self.path = path
+        self.mtime = mtime
+        self.names = names
+        self.entries = {}
+
+def _listdir(path):
+    names = os.listdir(path)
+    names.sort()
+    return names
+
+def _stat(path, names):
+    entries = []
+    for name in names:
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            entries.append(None)
+            continue
+        entries.append((stat.S_ISDIR(st.st_mode), st.st_size))
+    return entries
+
+class DirectoryCache(object):
+    """
+    Caches the L{Listing} and the index file of up to C{maxDirectories}
+    directories, versioned by the modification time of the directory.
+    Listings are read, and their entries statted C{batchSize} at a time, in
+    the reactor's thread pool.
+    """
+
+    batchSize = 256
+
+    def __init__(self, maxDirectories=256, pageSize=1000):
+        self.maxDirectories = max(1, maxDirectories)
+        self.pageSize = pageSize
+        self.listings = OrderedDict()
+        self.indexes = OrderedDict()
+        self.reading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, entries, path, mtime):
+        entry = entries.pop(path, None)
+        if entry is None or entry[0] != mtime:
+            return None
+        # re-insert as the most recently used entry
+        entries[path] = entry
+        return entry[1]
+
+    def _store(self, entries, path, mtime, value):
+        entries.pop(path, None)
+        while len(entries) >= self.maxDirectories:
+            entries.popitem(last=False)
+        entries[path] = (mtime, value)
+
+    def listing(self, path, mtime):
+        """
+        Return a L{Deferred} firing with the L{Listing} of the directory
+        C{path}, which has been modified at C{mtime}.  Concurrent requests
+        for the same directory share a single read.
+        """
+        listing = self._lookup(self.listings, path, mtime)
+        if listing is not None:
+            self.hits += 1
+            return defer.succeed(listing)
+        self.misses += 1
+        waiting = self.reading.get((path, mtime))
+        if waiting is None:
+            waiting = self.reading[(path, mtime)] = []
+            d = threads.deferToThread(_listdir, path)
+            d.addBoth(self._listed, path, mtime)
+        d = defer.Deferred()
+        waiting.append(d)
+        return d
+
+    def _listed(self, result, path, mtime):
+        waiting = self.reading.pop((path, mtime))
+        if not isinstance(result, list):
+            for d in waiting:
+                d.errback(result)
+            return
+        listing = Listing(path, mtime, result)
+        self._store(self.listings, path, mtime, listing)
+        for d in waiting:
+            d.callback(listing)
+
+    def entries(self, listing, names):
+        """
+        Return a L{Deferred} firing with the entries of C{names} in
+        C{listing}, statting those which have not been statted yet.
+        """
+        missing = [name for name in names if name not in listing.entries]
+        if not missing:
+            return defer.succeed([listing.entries[name] for name in names])
+
+        def statted(entries):
+            listing.entries.update(zip(missing, entries))
+            return [listing.entries[name] for name in names]
+
+        return threads.deferToThread(_stat, listing.path,
+                                     missing).addCallback(statted)
+
+    def index(self, directory, indexNames):
+        """
+        Return the child of the L{static.File} C{directory} named by the
+        first of C{indexNames} which exists, or C{None}.  Probing is
+        repeated only after the directory has been modified.
+        """
+        mtime = directory.getModificationTime()
+        key = (directory.path, tuple(indexNames))
+        name = self._lookup(self.indexes, key, mtime)
+        if name is None:
+            child = static.File.childSearchPreauth(directory, *indexNames)
+            name = ''
+            if child is not None:
+                name = child.basename()
+            self._store(self.indexes, key, mtime, name)
+        if not name:
+            return None
+        return directory.child(name)
+
+    def clear(self):
+        self.listings.clear()
+        self.indexes.clear()
+
+    def stats(self):
+        return {'listings': len(self.listings),
+                'indexes': len(self.indexes),
+                'max-directories': self.maxDirectories,
+                'hits': self.hits,
+                'misses': self.misses}
+
+class DirectoryListing(static.DirectoryLister):
+    """
+    Renders a L{Listing} of a L{DirectoryCache} as HTML, or as JSON with
+    C{?format=json}, writing the rows batch by batch as their entries get
+    statted.  With C{?page=n} only the n-th page of C{pageSize} entries is
+    rendered.
+    """
+
+    def __init__(self, pathname, mtime, cache,
+                 contentTypes=static.File.contentTypes,
+                 contentEncodings=static.File.contentEncodings,
+                 defaultType='text/html'):
+        static.DirectoryLister.__init__(self, pathname, None, contentTypes,
+                                        contentEncodings, defaultType)
+        self.mtime = mtime
+        self.cache = cache
+
+    def _argument(self, request, name, default=None):
+        values = request.args.get(name)
+        if not values:
+            return default
+        return values[0]
+
+    def render_GET(self, request):
+        asJSON = self._argument(request, b'format') == b'json'
+        if asJSON:
+            request.setHeader('content-type', 'application/json')
+        else:
+            request.setHeader('content-type', 'text/html; charset=utf-8')
+        if request.method == b'HEAD':
+            return b''
+        try:
+            page = int(self._argument(request, b'page', 0))
+        except ValueError:
+            page = 0
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = self.cache.listing(self.path, self.mtime)
+        d.addCallback(self._write, request, page, asJSON, finished)
+        d.addErrback(self._failed, request, finished)
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+    def render(self, request):
+        return resource.Resource.render(self, request)
+
+    @defer.inlineCallbacks
+    def _write(self, listing, request, page, asJSON, finished):
+        names = listing.names
+        write = lambda data: request.write(_bytes(data))
+        path = _native(request.path)
+        pages = max(1, (len(names) + self.cache.pageSize - 1) //
+                       self.cache.pageSize)
+        if page:
+            page = min(max(1, page), pages)
+            start = (page - 1) * self.cache.pageSize
+            names = names[start:start + self.cache.pageSize]
+
+        if asJSON:
+            write('{"path": %s, "page": %d, "pages": %d, "entries": [' %
+                  (json.dumps(path), page, pages))
+        else:
+            head, tail = self.template.split('%(tableContent)s')
+            header = 'Directory listing for %s' % escape(path)
+            write(head % {'header': header})
+
+        first = True
+        for offset in range(0, len(names), self.cache.batchSize):
+            batch = names[offset:offset + self.cache.batchSize]
+            entries = yield self.cache.entries(listing, batch)
+            if finished:
+                return
+            rows = []
+            for index, (name, entry) in enumerate(zip(batch, entries)):
+                if entry is None:
+                    continue
+                if asJSON:
+                    rows.append(self._jsonEntry(name, entry))
+                else:
+                    rows.append(self._htmlEntry(name, entry, offset + index))
+            if rows:
+                if asJSON:
+                    if not first:
+                        write(', ')
+                    write(', '.join(rows))
+                    first = False
+                else:
+                    write(''.join(rows))
+
+        if asJSON:
+            write(']}')
+        else:
+            write(tail.replace('</body>', self._navigation(page, pages)
+                                       + '</body>'))
+        request.finish()
+
+    def _failed(self, failure, request, finished):
+        log.err(failure, 'listing %s failed' % self.path)
+        if not finished:
+            request.setResponseCode(500)
+            request.finish()
+
+    def _describe(self, name, isdir):
+        if isdir:
+            return '[Directory]', ''
+        mimetype, encoding = static.getTypeAndEncoding(name,
+                                                       self.contentTypes,
+                                                       self.contentEncodings,
+                                                       self.defaultType)
+        return '[%s]' % mimetype, encoding and '[%s]' % encoding or ''
+
+    def _htmlEntry(self, name, entry, index):
+        isdir, size = entry
+        mimetype, encoding = self._describe(name, isdir)
+        suffix = isdir and '/' or ''
+        return self.linePattern % {'class': ('odd', 'even')[index % 2],
+                                   'href': urlquote(name) + suffix,
+                                   'text': escape(name) + suffix,
+                                   'size': not isdir and
+                                           static.formatFileSize(size) or '',
+                                   'type': mimetype,
+                                   'encoding': encoding}
+
+    def _jsonEntry(self, name, entry):
+        isdir, size = entry
+        if isdir:
+            return json.dumps({'name': name, 'type': 'directory'},
+                              sort_keys=True)
+        mimetype = self._describe(name, isdir)[0][1:-1]
+        return json.dumps({'name': name, 'type': 'file', 'size': size,
+                           'content-type': mimetype}, sort_keys=True)
+
+    def _navigation(self, page, pages):
+        if not page:
+            return ''
+        links = []
+        if page > 1:
+            links.append('<a href="?page=%d">previous</a>' % (page - 1))
+        links.append('page %d of %d' % (page, pages))
+        if page < pages:
+            links.append('<a href="?page=%d">next</a>' % (page + 1))
+        return '<p>%s</p>\n' % ' | '.join(links)
+
+    def __repr__(self):
+        return '<DirectoryListing of %r>' % self.path
+
+    __str__ = __repr__
@@ -8,6 +8,8 @@ VIDEO_MIME_TYPES = {
                     '.avi': 'video/x-msvideo',
                     '.flv': 'video/x-flv',
                     '.f4a': 'audio/mp4',
+                    '.f4f': 'video/f4f',
+                    '.f4m': 'application/f4m+xml',
                     '.f4v': 'video/mp4',
                     '.ts': 'video/mp2t',
                     '.m3u8': 'application/x-mpegurl',
@@ -21,3 +23,13 @@ VIDEO_MIME_TYPES = {
                     '.ogv': 'video/ogg',
                     '.webm': 'video/webm'
                     }
+
+# segments and playlists of http live streaming and http dynamic streaming
+SEGMENT_EXTENSIONS = ('.f4f', '.f4m', '.m3u8', '.ts')
+
+# playlists and manifests, which unlike the media compress well
+TEXT_EXTENSIONS = ('.f4m', '.m3u8')
+
+# progressive downloads in the iso base media file format (mp4)
+MOVIE_EXTENSIONS = ('.3gp', '.f4a', '.f4v', '.m4a', '.m4v', '.mov', '.mp4',
+                    '.qt')
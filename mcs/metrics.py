@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Metrics of all hosts in the Prometheus text format.
+
+Every host (listening port) gets a L{HostMetrics} with counters for its
+default site and each of its vhosts, allocated up front.  The
+L{MeteredRequest} adds to them when a request has finished: the number of
+requests by status class, the body bytes sent and histograms of the time
+to the first byte and the total time.  Connections are counted by wrapping
+the site's protocol, shaping is reported from the buckets of L{mcs.shaper}
+per traffic class and the counters of the caches from their C{stats()}.
+Nothing is rendered until the L{MetricsResource} is requested.
+
+With several worker processes every worker reports its own metrics.
+"""
+
+import bisect
+import numbers
+import time
+
+from twisted.web import resource, server
+
+from mcs import vhosts
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# status classes counted, 1xx to 5xx
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+class Histogram(object):
+    """Counts observations into the buckets of fixed upper C{bounds}."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, lines, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' %
+                         (name, labels, bound, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %f' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+
+class SiteMetrics(object):
+    """The counters of the default site or of one vhost of a host."""
+
+    __slots__ = ('requests', 'aborted', 'bytesSent', 'timeToFirstByte',
+                 'duration')
+
+    def __init__(self):
+        # by status class, anything else counts as 5xx
+        self.requests = [0] * len(STATUS_CLASSES)
+        self.aborted = 0
+        self.bytesSent = 0
+        self.timeToFirstByte = Histogram()
+        self.duration = Histogram()
+
+class HostMetrics(object):
+    """
+    The metrics of the server on C{port}, with counters for each of the
+    vhosts named C{fqdns}, which may be wildcards.  Requests for any other
+    host name count for the default site.
+    """
+
+    def __init__(self, port, fqdns=()):
+        self.port = port
+        self.default = SiteMetrics()
+        self.vhosts = {}
+        self.index = vhosts.HostIndex()
+        self.addVhosts(fqdns)
+        self.connections = 0
+        self.accepted = 0
+        # the shaped protocol factory, providing shapers()
+        self.shaping = None
+
+    def addVhosts(self, fqdns):
+        """Count the requests for the vhosts C{fqdns} from now on."""
+        for fqdn in fqdns:
+            site = self.vhosts.setdefault(fqdn.lower(), SiteMetrics())
+            self.index.add(fqdn, site)
+
+    def siteFor(self, request):
+        if not self.vhosts:
+            return self.default
+        host = vhosts.hostName(request.getHeader('host') or '')
+        return self.index.get(host, self.default)
+
+class MeteredRequest(server.Request):
+    """
+    A L{server.Request} adding to the L{HostMetrics} of its site, which
+    must have been set as the site's C{metrics}.
+    """
+
+    metrics = None
+    started = None
+    firstByte = None
+
+    def process(self):
+        self.metrics = self.channel.site.metrics.siteFor(self)
+        self.started = time.time()
+        server.Request.process(self)
+
+    def write(self, data):
+        if self.firstByte is None:
+            self.firstByte = time.time()
+        server.Request.write(self, data)
+
+    def finish(self):
+        server.Request.finish(self)
+        if self.started is None:
+            return
+        metrics = self.metrics
+        now = time.time()
+        index = self.code // 100 - 1
+        if not 0 <= index < len(STATUS_CLASSES):
+            index = len(STATUS_CLASSES) - 1
+        metrics.requests[index] += 1
+        metrics.bytesSent += self.sentLength
+        metrics.timeToFirstByte.observe((self.firstByte or now) - self.started)
+        metrics.duration.observe(now - self.started)
+        self.started = None
+
+    def connectionLost(self, reason):
+        if self.started is not None and not self.finished:
+            self.metrics.aborted += 1
+            self.started = None
+        server.Request.connectionLost(self, reason)
+
+class ConnectionCounter(object):
+    """
+    Wraps a protocol factory (or class), counting the open connections of
+    the protocols it creates in C{metrics}.
+    """
+
+    def __init__(self, protocol, metrics):
+        self.protocol = protocol
+        self.metrics = metrics
+
+    def __call__(self, *a, **kw):
+        proto = self.protocol(*a, **kw)
+        origMakeConnection = proto.makeConnection
+        origConnectionLost = proto.connectionLost
+        metrics = self.metrics
+
+        def makeConnection(transport):
+            metrics.connections += 1
+            metrics.accepted += 1
+            return origMakeConnection(transport)
+
+        def connectionLost(reason):
+            metrics.connections -= 1
+            return origConnectionLost(reason)
+
+        proto.makeConnection = makeConnection
+        proto.connectionLost = connectionLost
+        return proto
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                 .replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+def _metricName(key):
+    return ''.join(c if c.isalnum() else '_' for c in key.lower())
+
+class Registry(object):
+    """
+    The L{HostMetrics} of all hosts and the sources of C{stats()} to render.
+    """
+
+    def __init__(self):
+        self.hosts = []
+        self.sources = []
+
+    def host(self, port, fqdns=()):
+        metrics = HostMetrics(port, fqdns)
+        self.hosts.append(metrics)
+        return metrics
+
+    def addStats(self, name, source, **labels):
+        """Render the numbers of C{source.stats()} as C{mcs_<name>_*}."""
+        self.sources.append((name, source, labels))
+
+    def render(self):
+        families = {}
+
+        def add(name, kind, help, line):
+            family = families.get(name)
+            if family is None:
+                family = families[name] = ['# HELP %s %s' % (name, help),
+                                            '# TYPE %s %s' % (name, kind)]
+            family.append(line)
+
+        for host in self.hosts:
+            self._renderHost(host, add)
+        for name, source, labels in self.sources:
+            self._renderStats(name, source.stats(), labels, add)
+
+        lines = []
+        for name in sorted(families):
+            lines.extend(families[name])
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _renderHost(self, host, add):
+        labels = _labels(host=host.port)
+        add('mcs_connections', 'gauge', 'Open client connections.',
+            'mcs_connections{%s} %d' % (labels, host.connections))
+        add('mcs_connections_total', 'counter', 'Accepted connections.',
+            'mcs_connections_total{%s} %d' % (labels, host.accepted))
+
+        sites = [('', host.default)] + sorted(host.vhosts.items())
+        for vhost, metrics in sites:
+            labels = _labels(host=host.port, vhost=vhost or 'default')
+            for status, count in zip(STATUS_CLASSES, metrics.requests):
+                add('mcs_requests_total', 'counter', 'Finished requests.',
+                    'mcs_requests_total{%s,code="%s"} %d' %
+                    (labels, status, count))
+            add('mcs_requests_aborted_total', 'counter',
+                'Requests whose client went away before they finished.',
+                'mcs_requests_aborted_total{%s} %d' % (labels,
+                                                       metrics.aborted))
+            add('mcs_sent_bytes_total', 'counter',
+                'Response body bytes sent.',
+                'mcs_sent_bytes_total{%s} %d' % (labels, metrics.bytesSent))
+            for name, help, histogram in (
+                    ('mcs_time_to_first_byte_seconds',
+                     'Time until the response headers were written.',
+                     metrics.timeToFirstByte),
+                    ('mcs_request_duration_seconds',
+                     'Time until the response was finished.',
+                     metrics.duration)):
+                lines = []
+                histogram.render(lines, name, labels)
+                for line in lines:
+                    add(name, 'histogram', help, line)
+
+        if host.shaping is not None:
+            for trafficClass, shaper in host.shaping.shapers():
+                self._renderShaper(host, trafficClass, shaper, add)
+
+    def _renderShaper(self, host, trafficClass, shaper, add):
+        buckets = [('server', '', shaper.server)]
+        buckets.extend(('client', client, bucket)
+                       for client, bucket in sorted(shaper.clients.items()))
+        for kind, client, bucket in buckets:
+            labels = _labels(host=host.port, bucket=kind, client=client,
+                             **{'class': trafficClass})
+            add('mcs_shaper_tokens', 'gauge', 'Bytes left in the bucket.',
+                'mcs_shaper_tokens{%s} %d' % (labels, bucket.tokens))
+            add('mcs_shaper_burst', 'gauge', 'Capacity of the bucket.',
+                'mcs_shaper_burst{%s} %d' % (labels, bucket.burst))
+            add('mcs_shaper_rate', 'gauge',
+                'Bytes per second the bucket is refilled with.',
+                'mcs_shaper_rate{%s} %d' % (labels, bucket.rate))
+            add('mcs_shaper_connections', 'gauge',
+                'Connections shaped by the bucket.',
+                'mcs_shaper_connections{%s} %d' % (labels,
+                                                   bucket.connections))
+            add('mcs_shaper_delays_total', 'counter',
+                'Times the bucket held up a connection.',
+                'mcs_shaper_delays_total{%s} %d' % (labels, bucket.delays))
+            add('mcs_shaper_throttled_seconds_total', 'counter',
+                'Time connections waited for the bucket.',
+                'mcs_shaper_throttled_seconds_total{%s} %f' %
+                (labels, bucket.throttled))
+        labels = _labels(host=host.port, **{'class': trafficClass})
+        add('mcs_shaper_clients', 'gauge', 'Client buckets in use.',
+            'mcs_shaper_clients{%s} %d' % (labels, len(shaper.clients)))
+        add('mcs_shaper_client_delays_total', 'counter',
+            'Times any client bucket held up a connection.',
+            'mcs_shaper_client_delays_total{%s} %d' %
+            (labels, shaper.sweptDelays + sum(bucket.delays for bucket
+                                              in shaper.clients.values())))
+        add('mcs_shaper_client_throttled_seconds_total', 'counter',
+            'Time connections waited for any client bucket.',
+            'mcs_shaper_client_throttled_seconds_total{%s} %f' %
+            (labels, shaper.sweptThrottled + sum(bucket.throttled for bucket
+                                                 in shaper.clients.values())))
+
+    def _renderStats(self, name, stats, labels, add):
+        for key, value in sorted(stats.items()):
+            if isinstance(value, dict):
+                self._renderStats('%s_%s' % (name, key), value, labels, add)
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, numbers.Number):
+                continue
+            metric = 'mcs_%s_%s' % (_metricName(name), _metricName(key))
+            add(metric, 'untyped', '%s of the %s.' % (key, name),
+                '%s{%s} %s' % (metric, _labels(**labels), value))
+
+class MetricsResource(resource.Resource):
+    """Renders the metrics of a L{Registry} for Prometheus to scrape."""
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        request.setHeader('cache-control', 'no-cache')
+        return self.registry.render().encode('utf-8')
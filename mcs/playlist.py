@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+In-memory fast path for live HLS playlists.
+
+Live playlists are polled by every player once per target-duration, so the
+same tiny C{.m3u8} file gets requested over and over.  The L{PlaylistCache}
+keeps their bodies in memory and answers them without touching the
+filesystem at all.  Entries are invalidated by a Linux inotify watcher on
+the served root, so updates of the live edge are visible immediately.
+Where inotify is unavailable, every hit is revalidated with a single stat.
+
+Low-latency HLS clients ask for the next version of a live playlist with
+C{_HLS_msn} and C{_HLS_part} query parameters instead of polling it.  Such
+requests are parked with the L{PlaylistCache} until a notification of the
+segmenter closing or renaming the playlist shows it lists the media segment
+or part asked for, costing a list entry and a delayed call each while they
+wait.
+"""
+
+import os
+import sys
+
+from twisted.application import service
+from twisted.python import filepath, log
+from twisted.web import http, resource, server
+
+from mcs import cache, mediatypes
+
+PLAYLIST_EXTENSION = '.m3u8'
+
+# creating, rewriting, renaming or removing a file
+WATCH_MASK = (0x00000002 | # IN_MODIFY
+              0x00000004 | # IN_ATTRIB
+              0x00000008 | # IN_CLOSE_WRITE
+              0x00000040 | # IN_MOVED_FROM
+              0x00000080 | # IN_MOVED_TO
+              0x00000100 | # IN_CREATE
+              0x00000200 | # IN_DELETE
+              0x00000400 | # IN_DELETE_SELF
+              0x00000800)  # IN_MOVE_SELF
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+
+# how often parked requests look for updates without inotify
+POLL_INTERVAL = 0.1
+
+class Position(object):
+    """
+    The live edge of a playlist: the media sequence number C{msn} of its
+    last segment, the C{parts} of the following one listed so far, its
+    C{targetDuration} and whether it has C{ended}.
+    """
+
+    __slots__ = ('msn', 'parts', 'targetDuration', 'ended')
+
+    def __init__(self, msn, parts, targetDuration, ended):
+        self.msn = msn
+        self.parts = parts
+        self.targetDuration = targetDuration
+        self.ended = ended
+
+    def reached(self, msn, part=None):
+        """Whether segment C{msn}, or its C{part} if given, is listed."""
+        if self.ended or self.msn >= msn:
+            return True
+        return part is not None and msn == self.msn + 1 and \
+            self.parts > part
+
+def parsePosition(data):
+    """Return the L{Position} of the playlist C{data}."""
+    sequence = 0
+    segments = 0
+    parts = 0
+    targetDuration = 10.0
+    ended = False
+    # a line being written is not listed yet
+    for line in data[:data.rfind(b'\n') + 1].splitlines():
+        if line.startswith(b'#EXTINF:'):
+            segments += 1
+            parts = 0
+        elif line.startswith(b'#EXT-X-PART:'):
+            parts += 1
+        elif line.startswith(b'#EXT-X-MEDIA-SEQUENCE:'):
+            try:
+                sequence = int(line[22:])
+            except ValueError:
+                pass
+        elif line.startswith(b'#EXT-X-TARGETDURATION:'):
+            try:
+                targetDuration = float(line[22:])
+            except ValueError:
+                pass
+        elif line.startswith(b'#EXT-X-ENDLIST'):
+            ended = True
+    return Position(sequence + segments - 1, parts, targetDuration, ended)
+
+class Playlist(object):
+    """
+    A cached playlist body, with the ETag L{mcs.static.File} sends for the
+    file it was read from.
+    """
+
+    __slots__ = ('path', 'data', 'mtime', 'size', 'inode', 'etag', 'created',
+                 '_position')
+
+    def __init__(self, path, data, mtime, size, inode, created):
+        self.path = path
+        self.data = data
+        self.mtime = mtime
+        self.size = size
+        self.inode = inode
+        self.etag = cache.entityTag(inode, size, mtime)
+        self.created = created
+        self._position = None
+
+    def position(self):
+        """Return the L{Position} of the playlist, parsed once."""
+        if self._position is None:
+            self._position = parsePosition(self.data)
+        return self._position
+
+class PlaylistResource(resource.Resource):
+    """
+    Renders a cached L{Playlist}, honouring If-None-Match and, without it,
+    If-Modified-Since, compressed with the L{mcs.compression.VariantCache}
+    C{variants} if given.  Compressed variants get ETags of their own, like
+    those of L{mcs.static.File}.
+    """
+
+    isLeaf = True
+
+    def __init__(self, playlist, variants=None):
+        resource.Resource.__init__(self)
+        self.playlist = playlist
+        self.variants = variants
+
+    def render_GET(self, request):
+        playlist = self.playlist
+        request.setHeader('accept-ranges', 'none')
+        data = playlist.data
+        encoding = None
+        if self.variants is not None:
+            request.setHeader('vary', 'accept-encoding')
+            encoding, data = self.variants.negotiate(request, playlist.path,
+                (playlist.mtime, playlist.size), data)
+        etag = playlist.etag
+        if encoding is not None:
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        request.setHeader('etag', etag)
+        tags = request.getHeader('if-none-match')
+        if tags is not None:
+            if cache.entityTagMatches(tags, etag):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return b''
+            # If-Modified-Since only counts without If-None-Match
+            request.requestHeaders.removeHeader(b'if-modified-since')
+        if request.setLastModified(playlist.mtime) is http.CACHED:
+            return b''
+        request.setHeader('content-type',
+                          mediatypes.VIDEO_MIME_TYPES[PLAYLIST_EXTENSION])
+        if encoding is not None:
+            request.setHeader('content-encoding', encoding)
+        request.setHeader('content-length', str(len(data)))
+        if request.method == b'HEAD':
+            return b''
+        return data
+
+    render_HEAD = render_GET
+
+def _queryNumber(request, name):
+    values = request.args.get(name)
+    if not values:
+        return None
+    number = int(values[0])
+    if number < 0:
+        raise ValueError(values[0])
+    return number
+
+class BlockingPlaylistResource(resource.Resource):
+    """
+    Renders the playlist at C{path} once it lists the media segment and part
+    of the C{_HLS_msn} and C{_HLS_part} query parameters, waiting for it
+    with the L{PlaylistCache} C{playlists} for up to three target durations.
+    """
+
+    isLeaf = True
+
+    def __init__(self, playlists, path, variants=None):
+        resource.Resource.__init__(self)
+        self.playlists = playlists
+        self.path = path
+        self.variants = variants
+
+    def render_GET(self, request):
+        try:
+            msn = _queryNumber(request, b'_HLS_msn')
+            part = _queryNumber(request, b'_HLS_part')
+        except ValueError:
+            msn = None
+        if msn is None:
+            return resource.ErrorPage(http.BAD_REQUEST, "Bad Request",
+                "Invalid _HLS_msn or _HLS_part").render(request)
+        playlist = self.playlists.current(self.path)
+        if playlist is None:
+            return resource.NoResource("File not found.").render(request)
+        position = playlist.position()
+        if position.reached(msn, part):
+            return PlaylistResource(playlist, self.variants).render(request)
+        if msn > position.msn + 2:
+            # too far ahead to be on its way
+            return resource.ErrorPage(http.BAD_REQUEST, "Bad Request",
+                "_HLS_msn beyond the live edge").render(request)
+
+        def ready(playlist):
+            if playlist is None:
+                request.write(resource.ErrorPage(http.SERVICE_UNAVAILABLE,
+                    "Service Unavailable",
+                    "Playlist not updated in time").render(request))
+            else:
+                body = PlaylistResource(playlist,
+                                        self.variants).render(request)
+                if body:
+                    request.write(body)
+            request.finish()
+
+        waiter = self.playlists.block(self.path, msn, part,
+                                      3 * position.targetDuration, ready)
+        request.notifyFinish().addErrback(
+            lambda reason: self.playlists.unblock(waiter))
+        return server.NOT_DONE_YET
+
+    render_HEAD = render_GET
+
+class _Waiter(object):
+    """A request parked until the playlist at C{path} reaches a position."""
+
+    __slots__ = ('path', 'msn', 'part', 'callback', 'timeout')
+
+    def __init__(self, path, msn, part, callback):
+        self.path = path
+        self.msn = msn
+        self.part = part
+        self.callback = callback
+        self.timeout = None
+
+class PlaylistCache(service.Service):
+    """
+    Caches the playlists below C{root}.  Entries are dropped by filesystem
+    notifications or, if those are unavailable, revalidated with stat on
+    every hit.  Entries older than C{ttl} seconds are revalidated with stat
+    in any case, guarding against lost notifications.
+    """
+
+    def __init__(self, root, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.root = root
+        self.ttl = ttl or None
+        self.clock = clock
+        self.entries = {}
+        self.notifier = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # parked requests by path
+        self.waiters = {}
+        self.polls = {}
+        self.blocked = 0
+        self.released = 0
+        self.timeouts = 0
+
+    def cacheable(self, path):
+        return path.endswith(PLAYLIST_EXTENSION)
+
+    def lookup(self, path):
+        """
+        Return the cached L{Playlist} for C{path}, or C{None} if it is not
+        cached or no longer valid.  Misses are counted once the playlist
+        has been read and stored.
+        """
+        playlist = self.entries.get(path)
+        if playlist is None:
+            return None
+        if self.notifier is None or (self.ttl is not None and
+               self.clock.seconds() - playlist.created > self.ttl):
+            if not self._revalidate(playlist):
+                return None
+        self.hits += 1
+        return playlist
+
+    def pathFor(self, base, segments):
+        """
+        Return the path of the playlist at the path segments below the
+        directory C{base}, or C{None} if they do not name a playlist or could
+        escape C{base}.
+        """
+        if not isinstance(base, bytes):
+            # the segments of requests are bytes, paths on python 3 are not
+            try:
+                segments = [segment.decode('utf-8')
+                            if isinstance(segment, bytes) else segment
+                            for segment in segments]
+            except UnicodeError:
+                return None
+        if not segments[-1].endswith(PLAYLIST_EXTENSION):
+            return None
+        for segment in segments:
+            if segment in ('', '.', '..') or '/' in segment or '\0' in segment:
+                return None
+        return os.path.join(base, *segments)
+
+    def lookupSegments(self, base, segments):
+        """
+        Return the cached L{Playlist} for the path segments below the
+        directory C{base}, without touching the filesystem.  Segments which
+        could escape C{base} never match.
+        """
+        path = self.pathFor(base, segments)
+        if path is None:
+            return None
+        return self.lookup(path)
+
+    def current(self, path):
+        """
+        Return the L{Playlist} at C{path}, reading it unless it is cached, or
+        C{None} if it does not exist or is being written.
+        """
+        playlist = self.lookup(path)
+        if playlist is not None:
+            return playlist
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+        except (IOError, OSError):
+            return None
+        return self.store(path, data, st.st_mtime, st.st_size, st.st_ino)
+
+    def block(self, path, msn, part, timeout, callback):
+        """
+        Call C{callback} with the L{Playlist} at C{path} once it lists the
+        media segment C{msn} or its C{part}, or with C{None} after
+        C{timeout} seconds.  Return the waiter to L{unblock} early.
+        """
+        waiter = _Waiter(path, msn, part, callback)
+        waiter.timeout = self.clock.callLater(timeout, self._timedOut, waiter)
+        self.waiters.setdefault(path, []).append(waiter)
+        self.blocked += 1
+        if self.notifier is None and path not in self.polls:
+            self.polls[path] = self.clock.callLater(POLL_INTERVAL,
+                                                    self._poll, path)
+        return waiter
+
+    def unblock(self, waiter):
+        """Forget the C{waiter} of a request gone away."""
+        waiters = self.waiters.get(waiter.path)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del self.waiters[waiter.path]
+        if waiter.timeout.active():
+            waiter.timeout.cancel()
+
+    def _timedOut(self, waiter):
+        self.unblock(waiter)
+        self.timeouts += 1
+        waiter.callback(None)
+
+    def _poll(self, path):
+        del self.polls[path]
+        self.invalidate(path)
+        self._release(path)
+        if path in self.waiters and self.notifier is None:
+            self.polls[path] = self.clock.callLater(POLL_INTERVAL,
+                                                    self._poll, path)
+
+    def _release(self, path):
+        """Answer the requests waiting for what the playlist lists now."""
+        if path not in self.waiters:
+            return
+        playlist = self.current(path)
+        if playlist is None:
+            return
+        position = playlist.position()
+        waiting = []
+        for waiter in self.waiters.pop(path):
+            if position.reached(waiter.msn, waiter.part):
+                waiter.timeout.cancel()
+                self.released += 1
+                waiter.callback(playlist)
+            else:
+                waiting.append(waiter)
+        if waiting:
+            self.waiters[path] = waiting
+
+    def _revalidate(self, playlist):
+        try:
+            st = os.stat(playlist.path)
+        except OSError:
+            self.invalidate(playlist.path)
+            return False
+        if st.st_mtime != playlist.mtime or st.st_size != playlist.size or \
+                st.st_ino != playlist.inode:
+            self.invalidate(playlist.path)
+            return False
+        playlist.created = self.clock.seconds()
+        return True
+
+    def store(self, path, data, mtime, size, inode):
+        self.misses += 1
+        if len(data) != size:
+            # modified while reading it, the notification is on its way
+            return None
+        playlist = Playlist(path, data, mtime, size, inode,
+                            self.clock.seconds())
+        self.entries[path] = playlist
+        return playlist
+
+    def invalidate(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def notify(self, ignored, path, mask):
+        if mask & (IN_ISDIR | IN_Q_OVERFLOW):
+            # whole directories moved or events lost, start over
+            self.clear()
+            for waiting in list(self.waiters):
+                self._release(waiting)
+        else:
+            path = path.path
+            if not isinstance(path, str):
+                # notifications carry bytes with python 3
+                path = path.decode(sys.getfilesystemencoding(),
+                                   'surrogateescape')
+            self.invalidate(path)
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                # written completely, unlike on IN_MODIFY
+                self._release(path)
+
+    def startService(self):
+        service.Service.startService(self)
+        notifier = None
+        try:
+            from twisted.internet import inotify
+            notifier = inotify.INotify()
+            notifier.startReading()
+            notifier.watch(filepath.FilePath(self.root), mask=WATCH_MASK,
+                           autoAdd=True, callbacks=[self.notify],
+                           recursive=True)
+        except Exception as e:
+            log.msg('inotify unavailable for %s, revalidating playlists '
+                    'with stat: %s' % (self.root, e))
+            if notifier is not None:
+                notifier.loseConnection()
+            self.clear()
+            return
+        self.notifier = notifier
+        log.msg('watching playlists below %s' % self.root)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        for poll in self.polls.values():
+            poll.cancel()
+        self.polls.clear()
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'blocking': sum(len(waiting)
+                                for waiting in self.waiters.values()),
+                'blocked': self.blocked,
+                'released': self.released,
+                'timeouts': self.timeouts,
+                'inotify': self.notifier is not None}
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Caching layer for reverse proxies fronting a remote origin.
+
+Media segments are immutable, yet every client request for one used to be
+forwarded upstream again.  The L{ProxyCache} keeps upstream responses in a
+directory, bounded to a number of bytes and evicting the least recently
+used responses first, and the most requested ones in memory as well.
+Concurrent misses for the same URL are collapsed into a single upstream
+request.  Freshness follows the upstream's Cache-Control and Expires
+headers, stale responses are revalidated with their ETag or Last-Modified
+date.  Hits are served by L{mcs.static.File}, just like local files.
+Responses which are not cached are streamed to the clients waiting for
+them as they arrive.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from twisted.application import service
+from twisted.internet import defer, interfaces, protocol
+from twisted.python import failure, log
+from twisted.web import client, http, iweb, server
+from zope import interface
+
+from mcs import cache, reverse, static
+
+# request headers which must not reach the upstream when fetching for all
+# clients, or would get a partial or encoded response cached
+PRIVATE_HEADERS = ('accept-encoding', 'cookie', 'if-match',
+                   'if-modified-since', 'if-none-match', 'if-range',
+                   'if-unmodified-since', 'range')
+
+# response headers derived from the cached file instead of being replayed
+FILE_HEADERS = ('accept-ranges', 'age', 'content-encoding', 'content-length',
+                'content-range', 'content-type', 'date', 'last-modified',
+                'server', 'set-cookie')
+
+# heuristic freshness of responses with nothing but a Last-Modified date
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+
+def cacheControl(headers):
+    """Return the directives of the Cache-Control headers as a dict."""
+    directives = {}
+    for value in headers.getRawHeaders('cache-control', []):
+        for directive in value.split(','):
+            name, ignored, argument = directive.strip().partition('=')
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+def parseDate(value):
+    try:
+        return http.stringToDatetime(reverse.toBytes(value))
+    except (ValueError, IndexError, KeyError):
+        return None
+
+def expiration(headers, now):
+    """
+    Return when a response with C{headers} becomes stale, or C{None} if it
+    must not be cached at all.
+    """
+    directives = cacheControl(headers)
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return now + int(directives[name])
+            except ValueError:
+                return now
+    if 'no-cache' in directives:
+        return now
+    value = headers.getRawHeaders('expires', [None])[0]
+    if value is not None:
+        # invalid dates mean already expired
+        return parseDate(value) or now
+    lastModified = parseDate(headers.getRawHeaders('last-modified', [''])[0])
+    if lastModified is not None and lastModified < now:
+        return now + min((now - lastModified) / 10, MAX_HEURISTIC_FRESHNESS)
+    return now
+
+class Entry(object):
+    """A response stored in the directory of a L{ProxyCache}."""
+
+    __slots__ = ('key', 'path', 'size', 'expires', 'headers')
+
+    def __init__(self, key, path, size, expires, headers):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.expires = expires
+        self.headers = headers
+
+    def header(self, name):
+        for key, values in self.headers:
+            if key.lower() == name:
+                return values[0]
+        return None
+
+    def toJSON(self):
+        return json.dumps({'key': self.key, 'size': self.size,
+                           'expires': self.expires, 'headers': self.headers})
+
+    @classmethod
+    def fromJSON(cls, path, data):
+        data = json.loads(data)
+        return cls(str(data['key']), path, data['size'], data['expires'],
+                   [[str(name), [str(value) for value in values]]
+                    for name, values in data['headers']])
+
+class Transient(object):
+    """An upstream response which has not been cached."""
+
+    __slots__ = ('code', 'phrase', 'headers', 'path')
+
+    def __init__(self, code, phrase, headers, path):
+        self.code = code
+        self.phrase = phrase
+        self.headers = headers
+        self.path = path
+
+@interface.implementer(interfaces.IPushProducer)
+class _Share(object):
+    """The producer of a L{PassThrough} registered with one of its requests."""
+
+    def __init__(self, passThrough, request):
+        self.passThrough = passThrough
+        self.request = request
+
+    def pauseProducing(self):
+        self.passThrough.pause(self.request)
+
+    def resumeProducing(self):
+        self.passThrough.resume(self.request)
+
+    def stopProducing(self):
+        self.passThrough.detach(self.request)
+
+class PassThrough(protocol.Protocol):
+    """
+    An upstream response which is not cached, its body written to the
+    requests of all clients waiting for it as it arrives.  The upstream
+    connection is paused while any of them can not keep up, and dropped
+    once all of them went away.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+        self.paused = set()
+
+    def attach(self, request):
+        self.requests.append(request)
+        request.registerProducer(_Share(self, request), True)
+
+    def detach(self, request):
+        """The client of C{request} went away."""
+        if request not in self.requests:
+            return
+        self.requests.remove(request)
+        if not self.requests:
+            if self.transport is not None:
+                self.transport.stopProducing()
+        elif request in self.paused:
+            self.resume(request)
+
+    def start(self):
+        """Receive the body, once all waiting clients are attached."""
+        self.response.deliverBody(self)
+
+    def connectionMade(self):
+        if not self.requests:
+            self.transport.stopProducing()
+
+    def pause(self, request):
+        if not self.paused and self.transport is not None:
+            self.transport.pauseProducing()
+        self.paused.add(request)
+
+    def resume(self, request):
+        self.paused.discard(request)
+        if not self.paused and self.transport is not None:
+            self.transport.resumeProducing()
+
+    def dataReceived(self, data):
+        for request in self.requests:
+            request.write(data)
+
+    def connectionLost(self, reason):
+        requests, self.requests = self.requests, []
+        complete = reason.check(client.ResponseDone, http.PotentialDataLoss)
+        if requests and not complete:
+            log.msg('upstream response broken off: %s' %
+                    reason.getErrorMessage())
+        for request in requests:
+            request.unregisterProducer()
+            if complete:
+                request.finish()
+            else:
+                request.transport.loseConnection()
+
+class MemoryTier(cache.LRUCache):
+    """
+    Keeps the bodies of the most requested responses in memory, as the
+    segment cache of the files serving them.
+    """
+
+    def cacheable(self, path):
+        return True
+
+class _Download(protocol.Protocol):
+    """Writes a response body to a file."""
+
+    def __init__(self, fileObject, finished):
+        self.fileObject = fileObject
+        self.finished = finished
+
+    def dataReceived(self, data):
+        self.fileObject.write(data)
+
+    def connectionLost(self, reason):
+        self.fileObject.close()
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+class ProxyCache(service.Service):
+    """
+    Stores upstream responses in C{directory}, up to C{maxBytes} in total,
+    and keeps up to C{memoryBytes} of the most requested ones in memory.
+    Responses which must not be cached, or whose Content-Length exceeds
+    C{maxEntrySize}, are passed through as they arrive.  Those without a
+    Content-Length are downloaded to learn their size and passed through
+    as L{Transient} responses if they turn out too large.
+    """
+
+    def __init__(self, directory, maxBytes, memoryBytes=0, maxEntrySize=None,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxEntrySize = min(maxEntrySize or maxBytes, maxBytes)
+        self.memory = None
+        if memoryBytes:
+            self.memory = MemoryTier(memoryBytes)
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size = 0
+        self.fetching = {}
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.passed = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stored = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('tmp-'):
+                # left behind by an interrupted download
+                os.unlink(path)
+            elif name.endswith('.json'):
+                try:
+                    with open(path) as f:
+                        entry = Entry.fromJSON(path[:-5], f.read())
+                    if os.path.getsize(entry.path) != entry.size:
+                        raise ValueError('size mismatch')
+                except (IOError, OSError, ValueError, KeyError) as e:
+                    log.msg('dropping cached response %s: %s' % (path, e))
+                    self._unlink(path[:-5])
+                    continue
+                stored.append((os.path.getmtime(path), entry))
+        known = set(entry.path for mtime, entry in stored)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.json') and path not in known and \
+                    os.path.isfile(path):
+                # stored without its description
+                os.unlink(path)
+        stored.sort(key=lambda item: item[0])
+        for mtime, entry in stored:
+            self.entries[entry.key] = entry
+            self.size += entry.size
+        self._evict()
+        log.msg('%d responses (%d bytes) cached in %s' %
+                (len(self.entries), self.size, self.directory))
+
+    def _path(self, key):
+        # keep the extension, which determines the content-type of files
+        extension = os.path.splitext(urlparse(key)[2])[1]
+        digest = hashlib.sha1(reverse.toBytes(key)).hexdigest()
+        return os.path.join(self.directory, digest + extension[:16])
+
+    def _unlink(self, path):
+        for name in (path, path + '.json'):
+            if os.path.exists(name):
+                os.unlink(name)
+        if self.memory is not None:
+            self.memory.invalidate(path)
+
+    def lookup(self, key):
+        """Return the cached L{Entry} for C{key}, fresh or stale, or C{None}."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            # re-insert as the most recently used entry
+            self.entries[key] = entry
+        return entry
+
+    def fresh(self, entry):
+        return entry.expires > self.clock.seconds()
+
+    def _store(self, key, tempPath, size, expires, headers):
+        path = self._path(key)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        os.rename(tempPath, path)
+        entry = Entry(key, path, size, expires, headers)
+        self._save(entry)
+        self.entries[key] = entry
+        self.size += size
+        if self.memory is not None:
+            self.memory.invalidate(path)
+        self._evict()
+        return entry
+
+    def _save(self, entry):
+        with open(entry.path + '.json', 'w') as f:
+            f.write(entry.toJSON())
+
+    def _evict(self):
+        while self.size > self.maxBytes and self.entries:
+            entry = self.entries.popitem(last=False)[1]
+            self.size -= entry.size
+            self.evictions += 1
+            self._unlink(entry.path)
+
+    def fetch(self, agent, key, headers, entry=None):
+        """
+        Return a L{Deferred} firing with the L{Entry} for C{key} fetched, or
+        revalidated if a stale C{entry} is given, with C{agent}, or with a
+        L{PassThrough} or L{Transient} response if it must not be cached.
+        Concurrent fetches of the same C{key} share a single upstream
+        request.
+        """
+        d = defer.Deferred()
+        waiting = self.fetching.get(key)
+        if waiting is not None:
+            self.collapsed += 1
+            waiting.append(d)
+            return d
+        self.misses += 1
+        waiting = self.fetching[key] = [d]
+        if entry is not None:
+            etag = entry.header('etag')
+            if etag is not None:
+                headers.setRawHeaders('if-none-match', [etag])
+            lastModified = entry.header('last-modified')
+            if lastModified is not None:
+                headers.setRawHeaders('if-modified-since', [lastModified])
+        request = agent.request(b'GET', reverse.toBytes(key), headers)
+        request.addCallback(self._received, key, entry)
+        request.addBoth(self._fetched, key)
+        return d
+
+    def cacheable(self, response, expires, now, size=None):
+        """
+        Return whether C{response}, stale at C{expires}, may be stored, if
+        it has C{size} bytes, or whatever size if not known yet.
+        """
+        headers = response.headers
+        vary = [value.strip().lower()
+                for values in headers.getRawHeaders('vary', [])
+                for value in values.split(',')]
+        return (response.code == http.OK and expires is not None and
+                (size is None or size <= self.maxEntrySize) and
+                not headers.hasHeader('set-cookie') and
+                set(vary) <= set(['accept-encoding']) and
+                (expires > now or headers.hasHeader('etag') or
+                 headers.hasHeader('last-modified')))
+
+    def _received(self, response, key, entry):
+        now = self.clock.seconds()
+        native = reverse.toNative
+        excluded = reverse.hopByHop(response.headers)
+        headers = [[native(name), [native(value) for value in values]]
+                   for name, values in response.headers.getAllRawHeaders()
+                   if native(name).lower() not in excluded]
+
+        if response.code == http.NOT_MODIFIED and entry is not None:
+            self.revalidations += 1
+            names = set(name.lower() for name, values in headers)
+            entry.headers = [[name, values] for name, values in entry.headers
+                             if name.lower() not in names] + headers
+            entry.expires = expiration(response.headers, now) or now
+            self._save(entry)
+            return client.readBody(response).addCallback(lambda ignored:
+                                                          entry)
+
+        expires = expiration(response.headers, now)
+        length = None
+        if response.length is not iweb.UNKNOWN_LENGTH:
+            length = response.length
+        if not self.cacheable(response, expires, now, length):
+            self.passed += 1
+            return PassThrough(response)
+
+        fd, tempPath = tempfile.mkstemp(prefix='tmp-', dir=self.directory)
+        finished = defer.Deferred()
+        response.deliverBody(_Download(os.fdopen(fd, 'wb'), finished))
+
+        def downloaded(ignored):
+            size = os.path.getsize(tempPath)
+            if lastModified is not None:
+                os.utime(tempPath, (lastModified, lastModified))
+            if self.cacheable(response, expires, now, size):
+                return self._store(key, tempPath, size, expires, headers)
+            self.passed += 1
+            return Transient(response.code, response.phrase, headers,
+                             tempPath)
+
+        def failed(reason):
+            os.unlink(tempPath)
+            return reason
+
+        # serve it with the upstream's modification time
+        lastModified = parseDate(
+            response.headers.getRawHeaders('last-modified', [''])[0])
+
+        return finished.addCallbacks(downloaded, failed)
+
+    def _fetched(self, result, key):
+        waiting = self.fetching.pop(key)
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        if isinstance(result, PassThrough):
+            # every waiter is attached by now
+            result.start()
+        elif isinstance(result, Transient):
+            # every waiter has opened it by now
+            os.unlink(result.path)
+        elif isinstance(result, failure.Failure):
+            # handled by the waiters
+            return None
+
+    def stats(self):
+        stats = {'entries': len(self.entries),
+                 'bytes': self.size,
+                 'max-bytes': self.maxBytes,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'collapsed': self.collapsed,
+                 'revalidations': self.revalidations,
+                 'evictions': self.evictions,
+                 'passed': self.passed}
+        if self.memory is not None:
+            stats['memory'] = self.memory.stats()
+        return stats
+
+class CachingReverseProxyResource(reverse.ReverseProxyResource):
+    """
+    A L{reverse.ReverseProxyResource} answering GET and HEAD requests from
+    a L{ProxyCache}.  Requests with credentials are always passed through.
+    """
+
+    def __init__(self, host, port, path, pool=None, cache=None,
+                 clock=None):
+        reverse.ReverseProxyResource.__init__(self, host, port, path, pool,
+                                              clock)
+        self.cache = cache
+
+    def render(self, request):
+        if request.method not in (b'GET', b'HEAD') or \
+                request.requestHeaders.hasHeader('authorization'):
+            return reverse.ReverseProxyResource.render(self, request)
+        key = self.upstreamURL(request)
+        entry = self.cache.lookup(key)
+        if entry is not None and self.cache.fresh(entry):
+            self.cache.hits += 1
+            return self._serve(entry, request)
+
+        headers = self.upstreamHeaders(request)
+        for name in PRIVATE_HEADERS:
+            headers.removeHeader(name)
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        d = self.cache.fetch(self.agent, key, headers, entry)
+        d.addCallback(self._fetched, request, gone)
+        d.addErrback(self._failed, request, gone)
+        return server.NOT_DONE_YET
+
+    def _fetched(self, result, request, gone):
+        if gone:
+            return
+        if isinstance(result, Entry):
+            body = self._serve(result, request)
+        elif isinstance(result, PassThrough):
+            body = self._stream(result, request)
+        else:
+            body = self._relay(result, request)
+        if body is not server.NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+    def _file(self, path, headers):
+        f = static.File(path)
+        headers = dict((name.lower(), values[0]) for name, values in headers)
+        if 'content-type' in headers:
+            # otherwise guessed from the extension
+            f.type = headers['content-type']
+            f.encoding = headers.get('content-encoding')
+        return f
+
+    def _serve(self, entry, request):
+        for name, values in entry.headers:
+            if name.lower() not in FILE_HEADERS:
+                request.responseHeaders.setRawHeaders(name, values)
+        etag = entry.header('etag')
+        if etag is not None:
+            if cache.entityTagMatches(request.getHeader('if-none-match'),
+                                      etag):
+                request.setResponseCode(http.NOT_MODIFIED)
+                return b''
+        f = self._file(entry.path, entry.headers)
+        f.segmentCache = self.cache.memory
+        return f.render(request)
+
+    def _stream(self, passThrough, request):
+        response = passThrough.response
+        request.setResponseCode(response.code, response.phrase)
+        # replaces the defaults set by twisted.web.server.Request.process
+        reverse.forwardHeaders(response.headers, request.responseHeaders)
+        if response.length is not iweb.UNKNOWN_LENGTH and \
+                response.code not in (http.NO_CONTENT, http.NOT_MODIFIED):
+            request.setHeader('content-length', str(response.length))
+        passThrough.attach(request)
+        request.notifyFinish().addErrback(
+            lambda ignored: passThrough.detach(request))
+        return server.NOT_DONE_YET
+
+    def _relay(self, response, request):
+        request.setResponseCode(response.code, response.phrase)
+        for name, values in response.headers:
+            if name.lower() not in FILE_HEADERS:
+                request.responseHeaders.setRawHeaders(name, values)
+        if response.code == http.OK:
+            return self._file(response.path, response.headers).render(request)
+        for name, values in response.headers:
+            if name.lower() == 'content-type':
+                request.responseHeaders.setRawHeaders(name, values)
+        with open(response.path, 'rb') as f:
+            return f.read()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Fast path for the Range requests of players seeking in progressive downloads.
+
+Players seek inside MP4 files with lots of small Range requests, each of
+which used to open, seek and read the file anew.  The L{DescriptorPool}
+keeps the files which have been requested in ranges open, L{coalesce}
+merges the overlapping and adjacent ranges of multipart requests and the
+L{MovieIndexCache} keeps the C{moov} atom and the start of the C{mdat} atom
+of MP4 files in memory, which is what players fetch before starting
+playback.
+"""
+
+import os
+import struct
+
+from collections import OrderedDict
+
+from mcs import cache, mediatypes
+
+class _Descriptor(object):
+    """A pooled file descriptor, closed once evicted and no longer read."""
+
+    __slots__ = ('fd', 'version', 'references', 'evicted')
+
+    def __init__(self, fd, version):
+        self.fd = fd
+        self.version = version
+        self.references = 0
+        self.evicted = False
+
+class PooledFile(object):
+    """
+    File-like object reading a pooled descriptor at its own position, as
+    returned by L{mcs.static.File.openForReading} for pooled files.
+    Closing it hands the descriptor back to the pool.
+    """
+
+    def __init__(self, pool, name, descriptor):
+        self.pool = pool
+        self.name = name
+        self.descriptor = descriptor
+        self.position = 0
+        descriptor.references += 1
+
+    def fileno(self):
+        return self.descriptor.fd
+
+    def read(self, size=-1):
+        fd = self.descriptor.fd
+        if size < 0:
+            size = max(0, os.fstat(fd).st_size - self.position)
+        os.lseek(fd, self.position, os.SEEK_SET)
+        data = os.read(fd, size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += os.fstat(self.descriptor.fd).st_size
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.descriptor is not None:
+            descriptor, self.descriptor = self.descriptor, None
+            self.pool.release(descriptor)
+
+class DescriptorPool(object):
+    """
+    Keeps up to C{maxOpen} files open, which have recently been requested
+    in ranges.  Each entry carries the version (modification time and size)
+    of the file it has been opened for; opening it with a different version
+    drops it.
+    """
+
+    def __init__(self, maxOpen):
+        self.maxOpen = max(1, maxOpen)
+        self.descriptors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def open(self, path, version):
+        """
+        Return a L{PooledFile} for C{path}, or C{None} if it is not pooled.
+        """
+        descriptor = self.descriptors.pop(path, None)
+        if descriptor is None:
+            self.misses += 1
+            return None
+        if descriptor.version != version:
+            self._evict(descriptor)
+            self.misses += 1
+            return None
+        # re-insert as the most recently used entry
+        self.descriptors[path] = descriptor
+        self.hits += 1
+        return PooledFile(self, path, descriptor)
+
+    def add(self, path, version, fileObject):
+        """
+        Pool a duplicate of the descriptor of C{fileObject}, which has just
+        been opened for a Range request on C{path}.
+        """
+        if path in self.descriptors:
+            return
+        while len(self.descriptors) >= self.maxOpen:
+            self._evict(self.descriptors.popitem(last=False)[1])
+        self.descriptors[path] = _Descriptor(os.dup(fileObject.fileno()),
+                                             version)
+
+    def release(self, descriptor):
+        descriptor.references -= 1
+        if descriptor.evicted and not descriptor.references:
+            os.close(descriptor.fd)
+
+    def _evict(self, descriptor):
+        descriptor.evicted = True
+        self.evictions += 1
+        if not descriptor.references:
+            os.close(descriptor.fd)
+
+    def clear(self):
+        while self.descriptors:
+            self._evict(self.descriptors.popitem()[1])
+
+    def stats(self):
+        return {'entries': len(self.descriptors),
+                'max-open': self.maxOpen,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+def coalesce(ranges):
+    """
+    Merge overlapping and adjacent C{(offset, size)} ranges, returning them
+    in ascending order.
+    """
+    merged = []
+    for offset, size in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            start = merged[-1][0]
+            merged[-1] = (start, max(merged[-1][1], offset + size - start))
+        else:
+            merged.append((offset, size))
+    return merged
+
+def readAtoms(fileObject, fileSize):
+    """
+    Yield the type, offset and size of the top-level atoms of an MP4 file,
+    stopping at the first one which is broken.
+    """
+    offset = 0
+    while offset + 8 <= fileSize:
+        fileObject.seek(offset)
+        header = fileObject.read(16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header[:8])
+        headerSize = 8
+        if size == 1:
+            if len(header) < 16:
+                return
+            size = struct.unpack('>Q', header[8:16])[0]
+            headerSize = 16
+        elif size == 0:
+            # the last atom extends to the end of the file
+            size = fileSize - offset
+        if size < headerSize:
+            return
+        yield kind, offset, size
+        offset += size
+
+class MovieIndex(object):
+    """
+    The regions of an MP4 file players fetch before starting playback, as
+    C{(offset, data)} pairs.
+    """
+
+    __slots__ = ('regions',)
+
+    def __init__(self, regions=()):
+        self.regions = list(regions)
+
+    def __len__(self):
+        return sum(len(data) for offset, data in self.regions)
+
+    def find(self, offset, size):
+        """
+        Return the data of the region containing the range of C{size} bytes
+        at C{offset} and the range's offset in it, or C{(None, None)}.
+        """
+        for start, data in self.regions:
+            if start <= offset and offset + size <= start + len(data):
+                return data, offset - start
+        return None, None
+
+def buildIndex(fileObject, fileSize, maxMoovSize, headSize):
+    """
+    Read the L{MovieIndex} of an MP4 file: everything up to the first
+    C{headSize} bytes of the C{mdat} atom, which includes the C{moov} atom of
+    files prepared for fast start, and the C{moov} atom of the others.  The
+    index is empty for files which are no MP4 at all or whose C{moov} atom
+    exceeds C{maxMoovSize}.
+    """
+    moov = mdat = None
+    for kind, offset, size in readAtoms(fileObject, fileSize):
+        if kind == b'moov':
+            moov = (offset, size)
+        elif kind == b'mdat' and mdat is None:
+            mdat = (offset, size)
+        if moov is not None and mdat is not None:
+            break
+    if moov is None or moov[1] > maxMoovSize:
+        return MovieIndex()
+
+    if mdat is None:
+        headEnd = moov[0] + moov[1]
+    else:
+        headEnd = mdat[0] + min(mdat[1], headSize)
+    headEnd = min(headEnd, fileSize)
+    if headEnd > maxMoovSize + headSize:
+        return MovieIndex()
+    fileObject.seek(0)
+    regions = [(0, fileObject.read(headEnd))]
+    if moov[0] >= headEnd:
+        fileObject.seek(moov[0])
+        regions.append((moov[0], fileObject.read(moov[1])))
+    return MovieIndex(regions)
+
+class MovieIndexCache(cache.LRUCache):
+    """
+    Caches the L{MovieIndex} of MP4 files, keyed by their path and versioned
+    by modification time and size.  Only files with one of the given
+    C{extensions} are indexed.
+    """
+
+    def __init__(self, maxBytes, headSize=2 ** 18,
+                 extensions=mediatypes.MOVIE_EXTENSIONS):
+        cache.LRUCache.__init__(self, maxBytes)
+        self.headSize = headSize
+        self.extensions = set(extensions)
+
+    def cacheable(self, path):
+        return os.path.splitext(path)[1].lower() in self.extensions
+
+    def lookup(self, path, version, fileObject):
+        """
+        Return the L{MovieIndex} of C{path}, reading it from C{fileObject} on
+        misses or after the file has been modified.
+        """
+        index = self.get(path, version)
+        if index is None:
+            index = buildIndex(fileObject, version[1],
+                               max(0, self.maxEntrySize - self.headSize),
+                               self.headSize)
+            if not self.put(path, version, index):
+                # remember not to read it over and over again
+                self.put(path, version, MovieIndex())
+        return index
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Read the segments players are going to fetch next before they ask.
+
+HLS and HDS players fetch the segments of a stream in strict order, while
+L{mcs.static.File} only touches the disk once a request arrives, so on a
+cold spinning disk or a network filesystem every segment pays the full
+read latency.  A L{Readahead} warms the segments following the one just
+served, by the number in its name, and the segments a playlist just served
+lists next, in the reactor's thread pool.  Segments fitting into the
+segment cache are read into it, others are handed to the kernel with
+posix_fadvise(2), or read and dropped where that is not available, so that
+they are in the page cache when requested.
+"""
+
+import os
+import re
+import stat
+
+from collections import OrderedDict
+
+from twisted.internet import threads
+from twisted.python import log
+
+# followed by the number in their names, hls segments and hds fragments
+SEQUENCE_EXTENSIONS = ('.ts', '.f4f', '.aac', '.m4s', '')
+
+PLAYLIST_EXTENSIONS = ('.m3u8',)
+
+# the last run of digits of a name, followed by no other
+_NUMBER = re.compile(r'(\d+)\D*$')
+
+def successors(path, count):
+    """
+    Return the paths of the C{count} segments following the segment at
+    C{path}, by the last number in its name, keeping its leading zeros.
+    """
+    directory, name = os.path.split(path)
+    base, extension = os.path.splitext(name)
+    if extension.lower() not in SEQUENCE_EXTENSIONS:
+        return []
+    match = _NUMBER.search(base)
+    if match is None:
+        return []
+    digits = match.group(1)
+    head, tail = base[:match.start(1)], base[match.end(1):]
+    number = int(digits)
+    return [os.path.join(directory, '%s%s%s%s' %
+                         (head, str(number + offset).zfill(len(digits)),
+                          tail, extension))
+            for offset in range(1, count + 1)]
+
+def upcoming(path, data, count):
+    """
+    Return the paths of the C{count} segments of the playlist C{data} at
+    C{path} players are going to fetch next: the first ones of a playlist
+    which has ended, the last ones of a live one.  Segments outside of the
+    directory of the playlist are left out.
+    """
+    directory = os.path.dirname(path)
+    uris = [line.strip() for line in data.splitlines()
+            if line.strip() and not line.startswith(b'#')]
+    if b'#EXT-X-ENDLIST' in data:
+        uris = uris[:count]
+    else:
+        uris = uris[-count:]
+    paths = []
+    for uri in uris:
+        if not isinstance(uri, str):
+            # bytes with python 3
+            uri = uri.decode('utf-8', 'replace')
+        uri = uri.split('?', 1)[0]
+        segments = uri.split('/')
+        if '://' in uri or not segments[0] or '..' in segments or \
+                '.' in segments:
+            continue
+        paths.append(os.path.join(directory, *segments))
+    return paths
+
+def _warm(path, maxSize):
+    """
+    Read C{path} ahead in a thread, returning its version and its body if
+    it is no larger than C{maxSize}, or C{None} if it does not exist yet.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        version = (st.st_mtime, st.st_size)
+        if st.st_size <= maxSize:
+            return version, f.read()
+        advise = getattr(os, 'posix_fadvise', None)
+        if advise is not None:
+            advise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while f.read(2 ** 20):
+                pass
+        return version, None
+
+class Readahead(object):
+    """
+    Warms the C{count} segments following those served, and those listed
+    next by the playlists served, with at most C{maxPending} reads under
+    way at once.  Segments the L{cache.SegmentCache} C{segmentCache} can
+    hold are read into it.  A segment is warmed once every C{interval}
+    seconds at most, one which does not exist yet, like those following
+    the live edge, once every C{retry} seconds.
+    """
+
+    maxPending = 32
+    maxRecent = 4096
+
+    def __init__(self, count, segmentCache=None, interval=60, retry=1,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.count = count
+        self.segmentCache = segmentCache
+        self.interval = interval
+        self.retry = retry
+        self.clock = clock
+        self.pending = set()
+        # when paths warmed recently are due again
+        self.due = OrderedDict()
+        self.scheduled = 0
+        self.warmed = 0
+        self.cached = 0
+        self.missing = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def served(self, path):
+        """Warm what follows the segment or playlist at C{path}."""
+        extension = os.path.splitext(path)[1].lower()
+        if extension in PLAYLIST_EXTENSIONS:
+            if self._throttled(path):
+                return
+            d = threads.deferToThread(self._readPlaylist, path)
+            d.addCallback(self._playlistRead, path)
+            d.addErrback(log.err, 'reading playlist %s ahead failed' % path)
+        else:
+            self.warm(successors(path, self.count))
+
+    def playlist(self, path, data):
+        """Warm the segments listed next by the playlist C{data}."""
+        if not self._throttled(path):
+            self.warm(upcoming(path, data, self.count))
+
+    def _throttled(self, path):
+        # polled by every player, but updated every few seconds only
+        now = self.clock.seconds()
+        if now < self.due.get(path, now):
+            return True
+        self._due(path, now + self.retry)
+        return False
+
+    def _readPlaylist(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _playlistRead(self, data, path):
+        if data is not None:
+            self.warm(upcoming(path, data, self.count))
+
+    def warm(self, paths):
+        now = self.clock.seconds()
+        segments = self.segmentCache
+        for path in paths:
+            if path in self.pending or now < self.due.get(path, now) or \
+                    (segments is not None and path in segments):
+                continue
+            if len(self.pending) >= self.maxPending:
+                self.dropped += 1
+                continue
+            maxSize = -1
+            if segments is not None and segments.cacheable(path):
+                maxSize = segments.maxEntrySize
+            self.pending.add(path)
+            self.scheduled += 1
+            d = threads.deferToThread(_warm, path, maxSize)
+            d.addCallbacks(self._warmed, self._failed, callbackArgs=(path,),
+                           errbackArgs=(path,))
+
+    def _failed(self, failure, path):
+        self.pending.discard(path)
+        log.err(failure, 'reading %s ahead failed' % path)
+
+    def _due(self, path, when):
+        self.due.pop(path, None)
+        while len(self.due) >= self.maxRecent:
+            self.due.popitem(last=False)
+        self.due[path] = when
+
+    def _warmed(self, result, path):
+        self.pending.discard(path)
+        if result is None:
+            self.missing += 1
+            self._due(path, self.clock.seconds() + self.retry)
+            return
+        self._due(path, self.clock.seconds() + self.interval)
+        version, data = result
+        self.warmed += 1
+        self.bytes += version[1]
+        segments = self.segmentCache
+        if data is not None and len(data) == version[1] and \
+                path not in segments:
+            if segments.put(path, version, data):
+                self.cached += 1
+
+    def stats(self):
+        return {'count': self.count,
+                'pending': len(self.pending),
+                'scheduled': self.scheduled,
+                'warmed': self.warmed,
+                'cached': self.cached,
+                'missing': self.missing,
+                'dropped': self.dropped,
+                'bytes': self.bytes}
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Reverse proxy keeping HTTP/1.1 connections to its upstream alive.
+
+Twisted's L{twisted.web.proxy.ReverseProxyResource} connects to the upstream
+anew for every request.  The L{ReverseProxyResource} in here sends requests
+through an L{HTTPConnectionPool} of persistent connections instead, and
+streams the upstream's response body to the client as it arrives.  The
+upstream connection is paused whenever the client's transport (or the
+shaper in front of it, see L{mcs.shaper}) can not keep up.
+"""
+
+import copy
+
+try:
+    from urllib.parse import quote as urlquote, urlparse
+except ImportError:
+    from urllib import quote as urlquote
+    from urlparse import urlparse
+
+from twisted.internet import protocol
+from twisted.python import log
+from twisted.web import client, http, http_headers, iweb, resource, server
+
+# headers of a single connection, which must not be forwarded (rfc 2616)
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-authenticate',
+              'proxy-authorization', 'proxy-connection', 'te', 'trailers',
+              'transfer-encoding', 'upgrade')
+
+def toNative(data):
+    """
+    Return the bytes of a URL or header, which are C{bytes} with python 3,
+    as a native string.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode('latin-1')
+
+def toBytes(data):
+    """Return the native string C{data} as C{bytes}."""
+    if isinstance(data, bytes):
+        return data
+    return data.encode('latin-1')
+
+def connectionPool(size, idleTimeout, clock=None):
+    """
+    Return a pool keeping up to C{size} idle connections per upstream open
+    for C{idleTimeout} seconds.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    pool = client.HTTPConnectionPool(clock, persistent=True)
+    pool.maxPersistentPerHost = size
+    pool.cachedConnectionTimeout = idleTimeout
+    return pool
+
+def hopByHop(headers):
+    """
+    Return the lower-case names of the hop-by-hop headers of the
+    L{http_headers.Headers} C{headers}, those of L{HOP_BY_HOP} and those
+    named by its Connection header (rfc 7230, section 6.1).
+    """
+    names = set(HOP_BY_HOP)
+    for value in headers.getRawHeaders(b'connection', ()):
+        names.update(token.strip().lower()
+                     for token in toNative(value).split(','))
+    return names
+
+def forwardHeaders(source, destination, exclude=()):
+    """
+    Copy the headers of a L{http_headers.Headers} but the hop-by-hop ones
+    and those named in C{exclude}.
+    """
+    excluded = hopByHop(source)
+    excluded.update(exclude)
+    for name, values in source.getAllRawHeaders():
+        if toNative(name).lower() not in excluded:
+            destination.setRawHeaders(name, values)
+
+class _BodyRelay(protocol.Protocol):
+    """
+    Writes an upstream response body to the client's request, registering
+    the upstream connection as the request's producer.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def connectionMade(self):
+        self.request.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        if self.request is not None:
+            self.request.write(data)
+
+    def stop(self):
+        """The client went away, drop the upstream connection."""
+        if self.request is not None:
+            self.request = None
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        request, self.request = self.request, None
+        if request is None:
+            return
+        request.unregisterProducer()
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            request.finish()
+        else:
+            log.msg('upstream response broken off: %s' %
+                    reason.getErrorMessage())
+            request.transport.loseConnection()
+
+class ReverseProxyResource(resource.Resource):
+    """
+    Relays requests to the path below C{path} on the HTTP server at C{host}
+    and C{port}, over the persistent connections of C{pool}.  The children
+    of this resource share the pool.
+    """
+
+    def __init__(self, host, port, path, pool=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        resource.Resource.__init__(self)
+        self.host = host
+        self.port = port
+        self.path = path
+        if pool is None:
+            pool = connectionPool(16, 60, clock)
+        self.pool = pool
+        self.clock = clock
+        self.agent = client.Agent(clock, pool=pool)
+
+    def getChild(self, path, request):
+        child = copy.copy(self)
+        child.path = self.path + '/' + urlquote(toNative(path), safe='')
+        return child
+
+    def upstreamURL(self, request):
+        """Return the upstream's URL for C{request}."""
+        url = 'http://%s:%d%s' % (self.host, self.port, self.path)
+        query = urlparse(toNative(request.uri))[4]
+        if query:
+            url += '?' + query
+        return url
+
+    def upstreamHeaders(self, request):
+        """Return the headers of C{request} to forward to the upstream."""
+        if self.port == 80:
+            host = self.host
+        else:
+            host = '%s:%d' % (self.host, self.port)
+        headers = http_headers.Headers()
+        # the agent sets the content-length of the body it sends itself
+        forwardHeaders(request.requestHeaders, headers,
+                       ('host', 'content-length'))
+        headers.setRawHeaders('host', [host])
+        return headers
+
+    def render(self, request):
+        headers = self.upstreamHeaders(request)
+
+        body = None
+        request.content.seek(0, 2)
+        if request.content.tell() or \
+                request.requestHeaders.hasHeader('content-length'):
+            request.content.seek(0, 0)
+            body = client.FileBodyProducer(request.content)
+
+        d = self.agent.request(request.method,
+                               toBytes(self.upstreamURL(request)), headers,
+                               body)
+        relay, gone = [], []
+
+        def clientGone(reason):
+            gone.append(reason)
+            if relay:
+                relay[0].stop()
+            else:
+                d.cancel()
+
+        request.notifyFinish().addErrback(clientGone)
+        d.addCallback(self._respond, request, relay)
+        d.addErrback(self._failed, request, gone)
+        return server.NOT_DONE_YET
+
+    def _respond(self, response, request, relay):
+        request.setResponseCode(response.code, response.phrase)
+        # replaces the defaults set by twisted.web.server.Request.process
+        forwardHeaders(response.headers, request.responseHeaders)
+        # the agent keeps content-length to itself, except for HEAD requests
+        if response.length is not iweb.UNKNOWN_LENGTH and \
+                request.method != b'HEAD' and \
+                response.code not in (http.NO_CONTENT, http.NOT_MODIFIED):
+            request.setHeader('content-length', str(response.length))
+        relay.append(_BodyRelay(request))
+        response.deliverBody(relay[0])
+
+    def _failed(self, failure, request, gone):
+        if gone:
+            return
+        log.msg('upstream %s:%d failed: %s' % (self.host, self.port,
+                                               failure.getErrorMessage()))
+        request.setResponseCode(http.BAD_GATEWAY, b'Gateway error')
+        request.responseHeaders.setRawHeaders('content-type', ['text/html'])
+        request.write(b'<H1>Could not connect</H1>')
+        request.finish()
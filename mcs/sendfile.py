@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Zero-copy body producers for static files.
+
+Instead of reading each chunk of a file into python and writing it through
+the transport, the producers in here hand file ranges to the kernel with
+sendfile(2).  When the connection is shaped (see L{mcs.shaper}), every
+sendfile call is limited to the amount of bytes the client's bucket allows
+and an exhausted bucket is waited for with the shaper's scheduler tick.
+"""
+
+import errno
+import os
+import sys
+
+from twisted.python import log
+from twisted.web import static
+
+from mcs import connections, shaper
+
+def _libc_sendfile():
+    """
+    Look up sendfile(2) in the C-library, for python versions lacking
+    C{os.sendfile}.  Returns a callable with the signature of
+    C{os.sendfile(out_fd, in_fd, offset, count)} or C{None}.
+    """
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (ImportError, OSError):
+        return None
+
+    if sys.platform.startswith('linux'):
+        fn = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+        if fn is None:
+            return None
+        fn.argtypes = [ctypes.c_int, ctypes.c_int,
+                       ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        fn.restype = ctypes.c_ssize_t
+
+        def sendfile(out_fd, in_fd, offset, count):
+            offset = ctypes.c_int64(offset)
+            sent = fn(out_fd, in_fd, ctypes.byref(offset), count)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return sent
+
+    elif sys.platform == 'darwin':
+        fn = getattr(libc, 'sendfile', None)
+        if fn is None:
+            return None
+        fn.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                       ctypes.POINTER(ctypes.c_int64), ctypes.c_void_p,
+                       ctypes.c_int]
+        fn.restype = ctypes.c_int
+
+        def sendfile(out_fd, in_fd, offset, count):
+            length = ctypes.c_int64(count)
+            if fn(in_fd, out_fd, offset, ctypes.byref(length), None, 0) < 0:
+                err = ctypes.get_errno()
+                # a partial write on a non-blocking socket still counts
+                if err not in (errno.EAGAIN, errno.EINTR) or not length.value:
+                    raise OSError(err, os.strerror(err))
+            return length.value
+
+    else:
+        return None
+
+    return sendfile
+
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+
+def available():
+    """Return whether sendfile(2) is usable on this platform."""
+    return _sendfile is not None
+
+def socketFor(transport):
+    """
+    Return the file descriptor of the plain TCP socket below C{transport}
+    and the L{shaper.ShapedTransport} wrapping it, or C{(None, None)} if the
+    transport can not be bypassed (eg. TLS or transports without a handle).
+    """
+    transport, shaped = shaper.unwrapTransport(transport)
+    if getattr(transport, 'TLS', False):
+        return None, None
+    try:
+        fd = transport.getHandle().fileno()
+    except AttributeError:
+        return None, None
+    return fd, shaped
+
+class SendfileProducer(static.StaticProducer):
+    """
+    A push producer sending C{size} bytes of C{fileObject}, starting at
+    C{offset}, with sendfile(2) directly to the socket of the request.
+
+    The producer watches a duplicate of the socket's file descriptor for
+    writability on its own, so it does not depend on the transport asking
+    for more data.  The response headers still go through the transport and
+    must have been flushed before the first sendfile call.  For sites
+    sending with C{cork}, the socket is corked until the body has been sent,
+    so that the headers go out in one segment with its start.
+
+    If the kernel refuses to sendfile the file (eg. on some network
+    filesystems), the rest of the range is handed to twisted's copying
+    producer.
+    """
+
+    chunkSize = 2 ** 20
+
+    def __init__(self, request, fileObject, offset, size):
+        static.StaticProducer.__init__(self, request, fileObject)
+        self.offset = offset
+        self.size = size
+        self.fd = None
+        self.shaped = None
+        self.sendfile = _sendfile
+        self._writing = False
+        self._paused = False
+        self._waiting = False
+        self.corked = None
+
+    def start(self):
+        fd, self.shaped = socketFor(self.request.transport)
+        site = getattr(self.request, 'site', None)
+        if fd is not None and getattr(site, 'tcpSend', None) == 'cork':
+            self.corked = shaper.unwrapTransport(
+                self.request.transport)[0].getHandle()
+            connections.cork(self.corked, True)
+        # push the headers to the transport before bypassing it
+        self.request.write(b'')
+        self.request.registerProducer(self, True)
+        if fd is None:
+            self._handOff()
+            return
+        self.fd = os.dup(fd)
+        self._startWriting()
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return 'sendfile'
+
+    def _startWriting(self):
+        if not self._writing and not self._paused and self.fd is not None:
+            self._writing = True
+            from twisted.internet import reactor
+            reactor.addWriter(self)
+
+    def _stopWriting(self):
+        if self._writing:
+            self._writing = False
+            from twisted.internet import reactor
+            reactor.removeWriter(self)
+
+    def _flushed(self):
+        """
+        Return whether everything written through the transport (the
+        response headers) has been handed to the kernel already.
+        """
+        if self.shaped is not None and self.shaped.queued:
+            return False
+        transport = shaper.unwrapTransport(self.request.transport)[0]
+        pending = (len(getattr(transport, 'dataBuffer', '')) -
+                   getattr(transport, 'offset', 0) +
+                   getattr(transport, '_tempDataLen', 0))
+        return pending <= 0
+
+    def _allowance(self, amount):
+        """
+        Take up to C{amount} bytes from the bucket shaping the connection.
+        Returns the allowed amount, which is 0 if the bucket is exhausted.
+        """
+        if self.shaped is None:
+            return amount
+        return self.shaped.take(amount)
+
+    def _refund(self, amount):
+        if self.shaped is not None:
+            self.shaped.refund(amount)
+
+    def _waitForTokens(self):
+        self._stopWriting()
+        if not self._waiting:
+            self._waiting = True
+            self.shaped.waitForTokens(self._tokensAvailable)
+
+    def _tokensAvailable(self):
+        self._waiting = False
+        if self.request is not None:
+            self._startWriting()
+
+    def doWrite(self):
+        if self.request is None:
+            return
+        if not self._flushed():
+            if self.shaped is not None and self.shaped.queued:
+                # the headers are waiting for tokens as well
+                self._waitForTokens()
+            return
+
+        amount = self._allowance(min(self.chunkSize, self.size))
+        if amount <= 0:
+            self._waitForTokens()
+            return
+
+        try:
+            sent = self.sendfile(self.fd, self.fileObject.fileno(),
+                                 self.offset, amount)
+        except (OSError, IOError) as e:
+            self._refund(amount)
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            if e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                log.msg('sendfile unsupported for %s, falling back to copying'
+                        % self.fileObject.name)
+                self._handOff()
+                return
+            self._abort()
+            return
+
+        self._refund(amount - sent)
+        if self.shaped is not None:
+            self.shaped.sent(sent)
+        # as twisted counts the bytes written through the request
+        self.request.sentLength += sent
+        self.offset += sent
+        self.size -= sent
+        if not sent:
+            # the file has been truncated while sending it
+            self.size = 0
+        if self.size <= 0:
+            self._finish()
+
+    def _handOff(self):
+        """Let twisted's copying producer send the rest of the range."""
+        request, fileObject = self.request, self.fileObject
+        self._close()
+        self.request = None
+        request.unregisterProducer()
+        static.SingleRangeStaticProducer(request, fileObject,
+                                         self.offset, self.size).start()
+
+    def _finish(self):
+        request = self.request
+        self.stopProducing()
+        request.unregisterProducer()
+        request.finish()
+
+    def _abort(self):
+        transport = self.request.transport
+        self.stopProducing()
+        transport.loseConnection()
+
+    def _close(self):
+        self._stopWriting()
+        if self.corked is not None:
+            connections.cork(self.corked, False)
+            self.corked = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def connectionLost(self, reason):
+        if self.request is not None:
+            self._abort()
+
+    def pauseProducing(self):
+        self._paused = True
+        self._stopWriting()
+
+    def resumeProducing(self):
+        self._paused = False
+        if not self._waiting:
+            self._startWriting()
+
+    def stopProducing(self):
+        self._close()
+        static.StaticProducer.stopProducing(self)
+
+def fromStaticProducer(producer):
+    """
+    Return a L{SendfileProducer} replacing the given single-range or
+    whole-file producer of L{twisted.web.static}, or C{None} if the producer
+    can not be replaced.
+    """
+    if not available():
+        return None
+    if isinstance(producer, static.SingleRangeStaticProducer):
+        offset, size = producer.offset, producer.size
+    elif isinstance(producer, static.NoRangeStaticProducer):
+        offset = 0
+        size = os.fstat(producer.fileObject.fileno()).st_size
+    else:
+        return None
+    if socketFor(producer.request.transport)[0] is None:
+        return None
+    return SendfileProducer(producer.request, producer.fileObject,
+                            offset, size)
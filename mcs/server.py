@@ -7,15 +7,25 @@ Create a service which runs a web server.
 """
 
 import os
+import sys
 import warnings
 # Twisted Imports
 
-from twisted.python import usage
-from twisted.web import distrib, error, proxy, rewrite, server, vhost
+from twisted.python import log, usage
+from twisted.web import resource, server
 from twisted.internet import interfaces
 from twisted.application import service, strports
 
-from mcs import alias, bonjour, shaper, static
+# bonjour, the --reverse proxies and the --workers are imported when used,
+# for a quick start of servers without them
+from mcs import accesslog, alias, cache, compression, configfile, \
+    connections, listing, mediatypes, metrics, playlist, ranges, readahead, \
+    shaper, static, statcache, vhosts
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
 
 class Options(usage.Options):
     """
@@ -24,10 +34,15 @@ class Options(usage.Options):
     synopsis = "[mediacastserver options]"
 
     optParameters = [["logfile", "l", None, "Path to web CLF (Combined Log Format) log file."],
+                     ["workers", None, 0, "Number of worker processes " +
+                      "sharing the listening ports, each running its own " +
+                      "reactor.", int],
                      ]
 
     optFlags = [["notracebacks", "n", "Display tracebacks in broken web pages. " +
                  "Displaying tracebacks to users may be security risk!"],
+                ["no-sendfile", None, "Disable zero-copy sendfile(2) " +
+                 "transfers of static files."],
                 ]
 
     zsh_actions = {"logfile" : "_files -g '*.log'"}
@@ -41,6 +56,22 @@ This starts a webserver, intended to serve from a filesystem."""
         self['hosts'] = [{
                           'root': None,
                           'shape': None,
+                          'shape_profile': None,
+                          'cache': None,
+                          'cache_exts': [],
+                          'cache_stats': [],
+                          'playlists': None,
+                          'fd_pool': None,
+                          'movie_index': None,
+                          'listings': None,
+                          'compress': None,
+                          'compress_stats': [],
+                          'metadata': None,
+                          'children': None,
+                          'prefetch': None,
+                          'keep_alive': None,
+                          'max_connections': None,
+                          'tcp_send': None,
                           'port': None,
                           'bonjour': [],
                           'indexes': [],
@@ -48,7 +79,32 @@ This starts a webserver, intended to serve from a filesystem."""
                           'vhosts': [],
                           'leafs': {}
                           }]
-
+        self['worker'] = None
+        self['reverse_pool'] = [16, 60.0]
+        self['reverse_cache'] = None
+        self['reverse_caches'] = []
+        # by their --reverse-cache, reused when reloading the --config
+        self['reverse_cache_map'] = {}
+        self['metrics'] = None
+        self['config'] = None
+        self['log_buffer'] = [2 ** 16, 1.0]
+        self['log_rotate'] = [0, None]
+        self['log_format'] = 'combined'
+
+
+    def parseOptions(self, options=None):
+        if options is None:
+            options = sys.argv[1:]
+        # workers get started with the very same options
+        self['argv'] = list(options)
+        usage.Options.parseOptions(self, configfile.expand(self, options))
+
+    def opt_config(self, configPath):
+        """Read the options from a JSON, YAML or TOML file, with the global
+        ones at the top level and a list of hosts, each with a list of vhosts.
+        The resource trees are rebuilt from it on SIGHUP.
+        """
+        self['config'] = configPath
 
     def opt_port(self, portStr):
         """strports description of the port to
@@ -59,11 +115,29 @@ This starts a webserver, intended to serve from a filesystem."""
 
 
     def opt_host(self, portStr):
-        """port number (not strports description!) to
+        """port number or strports description of the port to
         start an additional server on."""
+        if ':' not in portStr:
+            portStr = 'tcp:%d' % int(portStr)
         self['hosts'].append({'root': None,
                               'shape': None,
-                              'port': 'tcp:%d' % int(portStr),
+                              'shape_profile': None,
+                              'cache': None,
+                              'cache_exts': [],
+                              'cache_stats': [],
+                              'playlists': None,
+                              'fd_pool': None,
+                              'movie_index': None,
+                              'listings': None,
+                              'compress': None,
+                              'compress_stats': [],
+                              'metadata': None,
+                              'children': None,
+                              'prefetch': None,
+                              'keep_alive': None,
+                              'max_connections': None,
+                              'tcp_send': None,
+                              'port': portStr,
                               'bonjour': [],
                               'indexes': [],
                               'aliases': [],
@@ -75,8 +149,9 @@ This starts a webserver, intended to serve from a filesystem."""
 
 
     def opt_vhost(self, fqdn):
-        """Additional vhost(s) to run, eg.:
-        host.domain.tld
+        """Additional vhost(s) to run, or all vhosts below a domain not run
+        otherwise, eg.:
+        host.domain.tld or *.domain.tld
         """
         self['hosts'][-1]['vhosts'].append({'root':None,
                                             'fqdn':fqdn,
@@ -108,11 +183,10 @@ This starts a webserver, intended to serve from a filesystem."""
         destPath = ''
         if "," in aliasMap:
             aliasPath, destPath = aliasMap.split(",", 2)
-        alias = alias.rewrite(aliasPath.strip(), destPath.strip())
         cfg = self['hosts'][-1]
         if self['hosts'][-1]['vhosts']:
             cfg = self['hosts'][-1]['vhosts'][-1]
-        cfg['aliases'].append(alias)
+        cfg['aliases'].append((aliasPath.strip(), destPath.strip()))
 
     opt_a = opt_alias
 
@@ -124,6 +198,7 @@ This starts a webserver, intended to serve from a filesystem."""
         cfg = self['hosts'][-1]
         if self['hosts'][-1]['vhosts']:
             cfg = self['hosts'][-1]['vhosts'][-1]
+        from twisted.web import distrib
         cfg['root'] = distrib.UserDirectory()
 
     opt_u = opt_user
@@ -183,11 +258,320 @@ This starts a webserver, intended to serve from a filesystem."""
         limit = [limitMap]
         if "," in limitMap:
             limit = limitMap.split(",", 4)
+        try:
+            values = [int(value) for value in limit]
+        except ValueError:
+            values = [0]
+        if len(values) > 4 or min(values) <= 0:
+            raise usage.UsageError("Invalid bandwidth limit: %s" % limitMap)
+        # unless given, the bursts follow the rates
+        rate = clientRate = values[0]
+        if len(values) > 1:
+            clientRate = values[1]
+        shaper.warnSmallBurst("the server", len(values) > 2 and values[2] or
+                              rate)
+        shaper.warnSmallBurst("each client", len(values) > 3 and values[3] or
+                              clientRate)
         self['hosts'][-1]['shape'] = limit
 
     opt_s = opt_shape
 
 
+    def opt_shape_profile(self, profilePath):
+        """Shape downloads by the traffic classes of a JSON profile, which
+        assigns requests to classes by vhost, client network and path prefix
+        and is reloaded on SIGHUP.  Classes may let each client replay a
+        mahimahi trace file, and the profile may record the bytes sent on
+        each connection into one.  The server-wide rate of --shape limits
+        all classes together.
+        """
+        try:
+            shaper.Profile.fromFile(profilePath)
+        except (IOError, ValueError) as e:
+            raise usage.UsageError("Invalid shaping profile: %s" % e)
+        self['hosts'][-1]['shape_profile'] = os.path.abspath(profilePath)
+
+
+    def opt_cache(self, cacheMap):
+        """Cache media segments and playlists in memory, limited to max-bytes
+        in total and max-entry-size per file, eg.:
+        max-bytes[,max-entry-size]
+        """
+        try:
+            limits = [int(limit) for limit in cacheMap.split(",", 1)]
+        except ValueError:
+            raise usage.UsageError("Invalid cache limits: %s" % cacheMap)
+        self['hosts'][-1]['cache'] = limits
+
+
+    def opt_cache_ext(self, ext):
+        """Cache files with the given media extension.
+        [default: %s]
+        """
+        if self['hosts'][-1]['cache'] is None:
+            raise usage.UsageError("You can only use --cache-ext "
+                                   "after --cache.")
+        if not ext.startswith('.'):
+            ext = '.' + ext
+        if ext.lower() not in mediatypes.VIDEO_MIME_TYPES:
+            raise usage.UsageError("Not a media extension: %s" % ext)
+        self['hosts'][-1]['cache_exts'].append(ext)
+
+    opt_cache_ext.__doc__ %= ', '.join(mediatypes.SEGMENT_EXTENSIONS)
+
+
+    def opt_cache_stats(self, statsPath):
+        """add a child-path rendering the counters of the --cache as JSON."""
+        if self['hosts'][-1]['cache'] is None:
+            raise usage.UsageError("You can only use --cache-stats "
+                                   "after --cache.")
+        self['hosts'][-1]['cache_stats'].append(statsPath)
+
+
+    def opt_playlist_cache(self, ttl):
+        """Keep .m3u8 playlists in memory, invalidated by inotify or else
+        revalidated with stat on each request.  Entries older than ttl
+        seconds are revalidated in any case, 0 disables this.  Blocking
+        playlist reloads (_HLS_msn and _HLS_part) wait for the update.
+        """
+        try:
+            self['hosts'][-1]['playlists'] = float(ttl)
+        except ValueError:
+            raise usage.UsageError("Invalid playlist ttl: %s" % ttl)
+
+
+    def opt_fd_pool(self, maxOpen):
+        """Keep up to max-open files requested in ranges open, for players
+        seeking in progressive downloads.
+        """
+        try:
+            self['hosts'][-1]['fd_pool'] = int(maxOpen)
+        except ValueError:
+            raise usage.UsageError("Invalid number of open files: %s" %
+                                   maxOpen)
+
+
+    def opt_movie_index(self, indexMap):
+        """Keep the moov atom and the first mdat-head-bytes of the mdat atom
+        of MP4 files in memory, limited to max-bytes in total, to serve the
+        ranges players fetch to start playback, eg.:
+        max-bytes[,mdat-head-bytes]
+        """
+        try:
+            limits = [int(limit) for limit in indexMap.split(",", 1)]
+        except ValueError:
+            raise usage.UsageError("Invalid movie index limits: %s" % indexMap)
+        self['hosts'][-1]['movie_index'] = limits
+
+
+    def opt_listing_cache(self, listingMap):
+        """List directories in a thread pool and cache the listings and index
+        file lookups of up to max-directories until they are modified.
+        Append ?page=n for pages of page-size entries and ?format=json for
+        JSON, eg.: max-directories[,page-size]
+        """
+        try:
+            limits = [int(limit) for limit in listingMap.split(",", 1)]
+        except ValueError:
+            raise usage.UsageError("Invalid listing cache limits: %s" %
+                                   listingMap)
+        self['hosts'][-1]['listings'] = limits
+
+
+    def opt_compress(self, compressMap):
+        """Send playlists and manifests gzip or brotli compressed to clients
+        accepting it, from .gz or .br files next to them or else compressed
+        once per version of the file and kept in memory, limited to max-bytes
+        in total and max-entry-size per file, eg.: max-bytes[,max-entry-size]
+        """
+        try:
+            limits = [int(limit) for limit in compressMap.split(",", 1)]
+        except ValueError:
+            raise usage.UsageError("Invalid compression limits: %s" %
+                                   compressMap)
+        self['hosts'][-1]['compress'] = limits
+
+
+    def opt_compress_stats(self, statsPath):
+        """add a child-path rendering the counters of --compress as JSON,
+        including the bytes saved and the processor time spent compressing.
+        """
+        if self['hosts'][-1]['compress'] is None:
+            raise usage.UsageError("You can only use --compress-stats "
+                                   "after --compress.")
+        self['hosts'][-1]['compress_stats'].append(statsPath)
+
+
+    def opt_stat_cache(self, statMap):
+        """Keep the metadata of up to max-entries files in memory for ttl
+        seconds, dropping it earlier on inotify notifications, and answer
+        conditional requests with ETags without touching the disk, eg.:
+        ttl[,max-entries]
+        """
+        limits = statMap.split(",", 1)
+        try:
+            limits = [float(limits[0])] + [int(limit) for limit in limits[1:]]
+        except ValueError:
+            limits = [0]
+        if limits[0] <= 0:
+            raise usage.UsageError("Invalid stat cache: %s" % statMap)
+        self['hosts'][-1]['metadata'] = limits
+
+
+    def opt_child_cache(self, childMap):
+        """Remember the files and content types of up to max-entries
+        request paths, so that repeated requests neither walk the path nor
+        probe the --ignore-ext extensions again.  Entries are invalidated by
+        the --stat-cache, which is required, eg.: max-entries
+        """
+        try:
+            maxEntries = int(childMap)
+        except ValueError:
+            maxEntries = 0
+        if maxEntries <= 0:
+            raise usage.UsageError("Invalid child cache: %s" % childMap)
+        self['hosts'][-1]['children'] = maxEntries
+
+
+    def opt_readahead(self, count):
+        """Read the count segments following each segment served, by the
+        number in its name, and those a playlist served lists next, ahead in
+        a thread: into the --cache if they fit, else into the page cache,
+        eg.: count
+        """
+        try:
+            segments = int(count)
+        except ValueError:
+            segments = 0
+        if segments <= 0:
+            raise usage.UsageError("Invalid readahead: %s" % count)
+        self['hosts'][-1]['prefetch'] = segments
+
+
+    def opt_keep_alive(self, keepAliveMap):
+        """Close persistent connections idle for idle-timeout seconds, never
+        for 0, and after max-requests requests, eg.:
+        idle-timeout[,max-requests]
+        """
+        try:
+            limits = keepAliveMap.split(",", 1)
+            keepAlive = [float(limits[0]), None]
+            if len(limits) > 1:
+                keepAlive[1] = int(limits[1])
+        except ValueError:
+            keepAlive = [-1, None]
+        if keepAlive[0] < 0 or (keepAlive[1] is not None and
+                                keepAlive[1] <= 0):
+            raise usage.UsageError("Invalid keep-alive: %s" % keepAliveMap)
+        self['hosts'][-1]['keep_alive'] = keepAlive
+
+
+    def opt_max_connections(self, count):
+        """Stop accepting connections while count are open, leaving the
+        others waiting in the listen backlog, per worker process.
+        """
+        try:
+            limit = int(count)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise usage.UsageError("Invalid max connections: %s" % count)
+        self['hosts'][-1]['max_connections'] = limit
+
+
+    def opt_tcp_send(self, mode):
+        """Send responses with nodelay, writing segments out at once, nagle,
+        coalescing small ones, or cork, holding the headers of files sent with
+        sendfile(2) back until the body fills the segment, eg.:
+        nodelay|nagle|cork
+        """
+        if mode not in connections.TCP_SEND:
+            raise usage.UsageError("Invalid tcp send mode: %s" % mode)
+        if mode == 'cork' and not connections.corkable():
+            raise usage.UsageError("TCP_CORK is not available here.")
+        self['hosts'][-1]['tcp_send'] = mode
+
+
+    def opt_log_buffer(self, bufferMap):
+        """Write the --logfile from a thread, in batches of up to
+        buffer-bytes at least every interval seconds, eg.:
+        buffer-bytes[,interval] [default: 65536,1]
+        """
+        try:
+            limits = bufferMap.split(",", 1)
+            buffering = [int(limits[0]), self['log_buffer'][1]]
+            if len(limits) > 1:
+                buffering[1] = float(limits[1])
+        except ValueError:
+            buffering = [0]
+        if buffering[0] <= 0 or buffering[1] <= 0:
+            raise usage.UsageError("Invalid log buffer: %s" % bufferMap)
+        self['log_buffer'] = buffering
+
+
+    def opt_log_rotate(self, rotateMap):
+        """Rotate the --logfile once it reaches max-bytes, keeping up to
+        max-files old ones.  It is reopened on SIGUSR1 in any case, eg.:
+        max-bytes[,max-files]
+        """
+        try:
+            limits = [int(limit) for limit in rotateMap.split(",", 1)]
+        except ValueError:
+            limits = [0]
+        if limits[0] <= 0:
+            raise usage.UsageError("Invalid log rotation: %s" % rotateMap)
+        self['log_rotate'] = limits + [None] * (2 - len(limits))
+
+
+    def opt_log_format(self, logFormat):
+        """Format of the --logfile lines, either combined (CLF) or json,
+        which includes the time requests waited for --shape and the bytes
+        held up meanwhile. [default: combined]
+        """
+        if logFormat not in accesslog.FORMATS:
+            raise usage.UsageError("Invalid log format: %s" % logFormat)
+        self['log_format'] = logFormat
+
+
+    def opt_reverse_pool(self, poolMap):
+        """Keep up to connections idle keep-alive connections per upstream of
+        the following --reverse proxies open for idle-timeout seconds, eg.:
+        connections[,idle-timeout] [default: 16,60]
+        """
+        try:
+            limits = poolMap.split(",", 1)
+            pool = [int(limits[0]), self['reverse_pool'][1]]
+            if len(limits) > 1:
+                pool[1] = float(limits[1])
+        except ValueError:
+            raise usage.UsageError("Invalid reverse proxy pool: %s" % poolMap)
+        self['reverse_pool'] = pool
+
+
+    def opt_reverse_cache(self, cacheMap):
+        """Cache the responses of the following --reverse proxies in a
+        directory, limited to max-bytes in total, keeping memory-bytes of them
+        in memory as well, eg.: directory,max-bytes[,memory-bytes]
+        """
+        limits = cacheMap.split(",", 2)
+        try:
+            directory = os.path.abspath(limits[0])
+            limits = [int(limit) for limit in limits[1:]]
+        except ValueError:
+            limits = []
+        if not limits:
+            raise usage.UsageError("Invalid reverse proxy cache: %s" %
+                                   cacheMap)
+        proxyCache = self['reverse_cache_map'].get(cacheMap)
+        if proxyCache is None:
+            from mcs import proxycache
+            proxyCache = proxycache.ProxyCache(directory, *limits)
+            self['reverse_cache_map'][cacheMap] = proxyCache
+        if proxyCache not in self['reverse_caches']:
+            self['reverse_caches'].append(proxyCache)
+        self['reverse_cache'] = proxyCache
+
+
     def opt_reverse(self, proxyStr):
         """run a reverse proxy, either as the whole server or on a direct
         child-path (leaf) only eg.:
@@ -211,7 +595,14 @@ This starts a webserver, intended to serve from a filesystem."""
         else:
             leaf = None
 
-        res = proxy.ReverseProxyResource(host, port, path)
+        from mcs import reverse
+        pool = reverse.connectionPool(*self['reverse_pool'])
+        if self['reverse_cache'] is None:
+            res = reverse.ReverseProxyResource(host, port, path, pool)
+        else:
+            from mcs import proxycache
+            res = proxycache.CachingReverseProxyResource(host, port, path,
+                pool, self['reverse_cache'])
 
         cfg = self['hosts'][-1]
         if self['hosts'][-1]['vhosts']:
@@ -232,18 +623,32 @@ This starts a webserver, intended to serve from a filesystem."""
 
         and on redirects and other link calculation, the external-host:port
         will be transmitted to this client."""
+        from twisted.web import vhost
         cfg = self['hosts'][-1]
         if self['hosts'][-1]['vhosts']:
             cfg = self['hosts'][-1]['vhosts'][-1]
         cfg['leafs'].setdefault(monsterPath, vhost.VHostMonsterResource())
 
 
+    def opt_metrics(self, metricsPath):
+        """add a child-path rendering the metrics of all hosts for Prometheus:
+        requests, bytes sent and latencies per vhost, connections, the
+        buckets of --shape and the counters of the caches."""
+        if self['metrics'] is None:
+            self['metrics'] = metrics.Registry()
+        cfg = self['hosts'][-1]
+        if self['hosts'][-1]['vhosts']:
+            cfg = self['hosts'][-1]['vhosts'][-1]
+        cfg['leafs'].setdefault(metricsPath,
+                                metrics.MetricsResource(self['metrics']))
+
+
     def opt_bonjour(self, bonjourStr):
         """override or append additional bonjour (mDNS/zeroconf) record.  the
         first occurrence per host overrides the default description, subsequent
         occurrences append additional records.  eg.:
         'computer %s on port %d'"""
-        self['hosts'][-1]['bonjour'].append(unicode(bonjourStr))
+        self['hosts'][-1]['bonjour'].append(_text(bonjourStr))
 
 
     def postOptions(self):
@@ -256,36 +661,100 @@ This starts a webserver, intended to serve from a filesystem."""
         if self['hosts'][0]['port'] is None:
             self['hosts'][0]['port'] = 'tcp:8080'
 
+        if self['workers'] < 0:
+            raise usage.UsageError("Invalid number of workers: %d" %
+                                   self['workers'])
+
         ports = {}
         for host_config in self['hosts']:
-            if ports.has_key(host_config['port']):
+            if host_config['port'] in ports:
                 raise usage.UsageError("Duplicate port definition: %s" %
                                        host_config['port'])
             ports[host_config['port']] = True
+            if host_config['children'] is not None and \
+                    host_config['metadata'] is None:
+                raise usage.UsageError("You can only use --child-cache "
+                                       "with --stat-cache.")
         del ports
 
-def prepareMultiService(multi_service, config):
+def prepareFile(multi_service, root, host_config):
+    """
+    Attach the caches configured for a host to one of its file roots.
+    """
+    root.segmentCache = host_config['segment_cache']
+    root.descriptorPool = host_config['descriptor_pool']
+    root.movieIndex = host_config['movie_index_cache']
+    root.directoryCache = host_config['directory_cache']
+    root.variantCache = host_config['variant_cache']
+
+    if host_config['stat_cache'] is not None:
+        host_config['stat_cache'].addRoot(root.path)
+        root.statCache = host_config['stat_cache']
+        root.childCache = host_config['child_cache']
+    root.readahead = host_config['readahead']
+
+    if host_config['playlists'] is not None:
+        playlists = host_config['playlist_caches'].get(root.path)
+        if playlists is None:
+            playlists = playlist.PlaylistCache(root.path,
+                                               host_config['playlists'])
+            playlists.setServiceParent(multi_service)
+            host_config['playlist_caches'][root.path] = playlists
+        root.playlistCache = playlists
+
+def addStatistics(registry, host_config):
+    """
+    Add the caches of a host to the metrics rendered by C{registry}.
+    """
+    port = host_config['port']
+    for name in ('segment_cache', 'descriptor_pool', 'movie_index_cache',
+                 'directory_cache', 'variant_cache', 'stat_cache',
+                 'child_cache', 'readahead'):
+        if host_config[name] is not None:
+            registry.addStats(name, host_config[name], host=port)
+    for root, playlists in sorted(host_config['playlist_caches'].items()):
+        registry.addStats('playlist_cache', playlists, host=port, root=root)
+
+def sharedRootKey(vhost_config):
+    """
+    Return what the root of a vhost must have in common with that of another
+    vhost to be shared with it, or C{None} if it has settings of its own.
+    """
+    root = vhost_config['root']
+    if (not isinstance(root, static.File) or vhost_config['indexes'] or
+        vhost_config['aliases'] or vhost_config['leafs']):
+        return None
+    return (root.path, root.defaultType, tuple(root.ignoredExts))
+
+def prepareMultiService(multi_service, config, host_config=None):
+
+    if host_config is None:
+        host_config = config
 
     if config['root'] is None:
         config['root'] = static.File(os.path.abspath(os.getcwd()))
 
+    if isinstance(config['root'], static.File):
+        prepareFile(multi_service, config['root'], host_config)
+
     if config['indexes']:
         config['root'].indexNames = config['indexes']
 
-    for path, res in config['leafs'].iteritems():
-        segments = path.split('/')
-        print 'path %s segs %s' % (path,segments), config['root']
+    for path, res in config['leafs'].items():
+        # path segments are bytes to twisted
+        segments = [segment.encode('utf-8') if not isinstance(segment, bytes)
+                    else segment for segment in path.split('/')]
         parent = config['root']
         for segment in range(0, len(segments) - 1, 1):
             child = parent.getChildWithDefault(segments[segment], None)
-            if isinstance(child, error.NoResource):
+            if isinstance(child, resource.NoResource):
                 child = static.PathSegment()
                 parent.putChild(segments[segment], child)
-            elif segment > 0 and not isinstance(static.Data):
+            elif segment > 0 and not isinstance(child, static.Data):
                 warnings.warn("path '%s' might not work." % path)
             parent = child
         if isinstance(parent.getChildWithDefault(segments[-1], None),
-                      error.NoResource):
+                      resource.NoResource):
             parent.putChild(segments[-1], res)
         else:
             warnings.warn("ignoring path '%s', as it is already defined." % path)
@@ -295,41 +764,170 @@ def prepareMultiService(multi_service, config):
                                              multi_service)
 
     if config['aliases']:
-        config['root'] = rewrite.RewriterResource(config['root'],
-                                                  *config['aliases'])
+        # compiled once, instead of trying each alias on every request
+        table = alias.AliasTable(config['aliases'])
+        config['root'] = alias.AliasResource(config['root'], table)
+
+# settings of a host which only change on restart, as its caches and the
+# buckets of its shaping are kept when the --config is reloaded
+RESTART_SETTINGS = ('shape', 'shape_profile', 'cache', 'cache_exts',
+                    'playlists', 'fd_pool', 'movie_index', 'listings',
+                    'compress', 'metadata', 'children', 'prefetch',
+                    'keep_alive', 'max_connections', 'tcp_send')
+
+# what lives beyond a single resource tree of a host
+CACHES = ('segment_cache', 'playlist_caches', 'descriptor_pool',
+          'movie_index_cache', 'directory_cache', 'variant_cache',
+          'stat_cache', 'child_cache', 'readahead', 'shaping_profiles')
+
+def prepareCaches(multi_service, host_config):
+    """
+    Create the caches configured for a host.
+    """
+    host_config['segment_cache'] = None
+    host_config['playlist_caches'] = {}
+    if host_config['cache'] is not None:
+        host_config['segment_cache'] = cache.SegmentCache(
+            *host_config['cache'],
+            extensions=host_config['cache_exts'] or
+                       mediatypes.SEGMENT_EXTENSIONS)
+
+    host_config['readahead'] = None
+    if host_config['prefetch'] is not None:
+        host_config['readahead'] = readahead.Readahead(
+            host_config['prefetch'], host_config['segment_cache'])
+
+    host_config['descriptor_pool'] = None
+    if host_config['fd_pool']:
+        host_config['descriptor_pool'] = \
+            ranges.DescriptorPool(host_config['fd_pool'])
+
+    host_config['movie_index_cache'] = None
+    if host_config['movie_index'] is not None:
+        host_config['movie_index_cache'] = \
+            ranges.MovieIndexCache(*host_config['movie_index'])
+
+    host_config['directory_cache'] = None
+    if host_config['listings'] is not None:
+        host_config['directory_cache'] = \
+            listing.DirectoryCache(*host_config['listings'])
+
+    host_config['variant_cache'] = None
+    if host_config['compress'] is not None:
+        host_config['variant_cache'] = \
+            compression.VariantCache(*host_config['compress'])
+
+    host_config['stat_cache'] = None
+    if host_config['metadata'] is not None:
+        host_config['stat_cache'] = \
+            statcache.StatCache(*host_config['metadata'])
+        host_config['stat_cache'].setServiceParent(multi_service)
+
+    host_config['child_cache'] = None
+    if host_config['children'] is not None:
+        host_config['child_cache'] = statcache.ChildCache(
+            host_config['stat_cache'], host_config['children'])
+
+def adoptCaches(host_config, running_config):
+    """
+    Take over the caches of the running host of C{running_config}.
+    """
+    for name in CACHES:
+        host_config[name] = running_config[name]
 
-def makeService(config):
-    computername = unicode(os.popen("/usr/sbin/networksetup -getcomputername",
-                                    "r").readlines()[0]).strip()
-    s = service.MultiService()
+def prepareRoot(multi_service, host_config):
+    """
+    Build the resource tree of a host, whose caches have been prepared, and
+    return its root.
+    """
+    for statsPath in host_config['cache_stats']:
+        host_config['leafs'].setdefault(statsPath,
+            cache.CacheStatistics(host_config['segment_cache']))
+    for statsPath in host_config['compress_stats']:
+        host_config['leafs'].setdefault(statsPath,
+            cache.CacheStatistics(host_config['variant_cache']))
 
-    for host_config in config['hosts']:
+    prepareMultiService(multi_service, host_config)
 
-        prepareMultiService(s, host_config)
+    if host_config['vhosts']:
 
-        if host_config['vhosts']:
+        vhost_root = vhosts.VirtualHostIndex()
+        vhost_root.default = host_config['root']
 
-            vhost_root = vhost.NameVirtualHost()
-            vhost_root.default = host_config['root']
+        # vhosts serving the same directory alike share its root
+        shared = {}
+        for vhost_config in host_config['vhosts']:
 
-            for vhost_config in host_config['vhosts']:
+            key = sharedRootKey(vhost_config)
+            if key is not None and key in shared:
+                vhost_config['root'] = shared[key]
+            else:
+                prepareMultiService(multi_service, vhost_config, host_config)
+                if key is not None:
+                    shared[key] = vhost_config['root']
 
-                prepareMultiService(s, vhost_config)
+            vhost_root.addHost(vhost_config['fqdn'], vhost_config['root'])
 
-                vhost_root.addHost(vhost_config['fqdn'], vhost_config['root'])
+        host_config['root'] = vhost_root
 
-            host_config['root'] = vhost_root
+    if host_config['shaping_profiles'] is not None:
+        host_config['root'] = shaper.ClassifyingResource(
+            host_config['root'], host_config['shaping_profiles'])
 
-        if config['logfile']:
-            site = server.Site(host_config['root'], logPath=config['logfile'])
-        else:
-            site = server.Site(host_config['root'])
+    return host_config['root']
 
-        site.displayTracebacks = not config["notracebacks"]
+def startReverseCaches(multi_service, config, worker, running=()):
+    """
+    Start the caches of the --reverse proxies, except for those C{running}.
+    """
+    for number, proxyCache in enumerate(config['reverse_caches']):
+        if proxyCache in running:
+            continue
+        if config['metrics'] is not None:
+            config['metrics'].addStats('reverse_cache', proxyCache,
+                                       cache=number)
+        if worker is not None:
+            # workers do not share their caches
+            proxyCache.directory = os.path.join(proxyCache.directory,
+                'worker-%d' % worker['number'])
+        proxyCache.setServiceParent(multi_service)
 
-        if not host_config['shape'] is None:
-            site.protocol = shaper.gen_token_bucket(site.protocol,
-                                                    *host_config['shape'])
+def makeService(config):
+    s = service.MultiService()
+
+    static.File.useSendfile = not config['no-sendfile']
+
+    # the parent of several workers only listens and advertises, workers
+    # serve without advertising
+    pool = None
+    if config['workers'] > 1:
+        from mcs import workers
+        pool = workers.WorkerPool(config['workers'], config['argv'])
+    worker = config['worker']
+
+    bonjour = None
+    if worker is None:
+        from mcs import bonjour
+        if not bonjour.available():
+            log.msg("pybonjour-library missing, not advertising any host")
+            bonjour = None
+
+    accessLog = None
+    if config['logfile'] and pool is None:
+        logPath = config['logfile']
+        if worker is not None and config['log_rotate'][0]:
+            # workers must not rotate each other's files
+            logPath = '%s.worker-%d' % (logPath, worker['number'])
+        accessLog = accesslog.AccessLog(logPath, *config['log_buffer'],
+            rotateLength=config['log_rotate'][0],
+            maxRotatedFiles=config['log_rotate'][1],
+            format=config['log_format'])
+        accessLog.setServiceParent(s)
+        if config['metrics'] is not None:
+            config['metrics'].addStats('access_log', accessLog)
+
+    sites = []
+    for index, host_config in enumerate(config['hosts']):
 
         port = host_config['port']
         if ":" in str(host_config['port']):
@@ -339,15 +937,100 @@ def makeService(config):
         if not host_config['bonjour']:
             host_config['bonjour'].append(u"Mediacast-Webserver (%s on port %d)")
 
-        for bonjour_desc in host_config['bonjour']:
-            if '%s' in bonjour_desc and '%d' in bonjour_desc:
-                bonjour_desc %= (computername, port)
-            elif '%s' in bonjour_desc:
-                bonjour_desc %= computername
-            elif '%d' in bonjour_desc:
-                bonjour_desc %= port
-            bonjour.mDNSService(bonjour_desc, "_http._tcp", port).setServiceParent(s)
+        if bonjour is not None:
+            for bonjour_desc in host_config['bonjour']:
+                if '%s' in bonjour_desc and '%d' in bonjour_desc:
+                    bonjour_desc %= (bonjour.computerName(), port)
+                elif '%s' in bonjour_desc:
+                    bonjour_desc %= bonjour.computerName()
+                elif '%d' in bonjour_desc:
+                    bonjour_desc %= port
+                bonjour.mDNSService(bonjour_desc, "_http._tcp",
+                                    port).setServiceParent(s)
+
+        if pool is not None:
+            pool.addHost(host_config)
+            continue
+
+        prepareCaches(s, host_config)
+
+        host_config['shaping_profiles'] = None
+        if host_config['shape_profile'] is not None:
+            root = None
+            shape = host_config['shape']
+            if worker is not None and shape is not None:
+                root = worker['memory'].bucket(index, shape)
+            elif shape is not None:
+                root = shaper.Bucket(int(shape[0]), len(shape) > 2 and
+                                     int(shape[2]) or None)
+            host_config['shaping_profiles'] = shaper.ShapingProfiles(
+                host_config['shape_profile'], root)
+            host_config['shaping_profiles'].setServiceParent(s)
+
+        prepareRoot(s, host_config)
+
+        if accessLog is not None:
+            site = accesslog.AccessLogSite(host_config['root'], accessLog)
+        else:
+            site = server.Site(host_config['root'])
 
-        strports.service(host_config['port'], site).setServiceParent(s)
+        site.displayTracebacks = not config["notracebacks"]
+
+        registry = config['metrics']
+        if registry is not None:
+            fqdns = [vhost_config['fqdn']
+                     for vhost_config in host_config['vhosts']]
+            site.metrics = registry.host(host_config['port'], fqdns)
+            site.requestFactory = metrics.MeteredRequest
+            addStatistics(registry, host_config)
+
+        profiles = host_config['shaping_profiles']
+        if profiles is not None:
+            site.protocol = shaper.ProfiledProtocolFactory(site.protocol,
+                                                           profiles)
+            if registry is not None:
+                site.metrics.shaping = site.protocol
+        elif not host_config['shape'] is None:
+            server_bucket = None
+            if worker is not None:
+                server_bucket = worker['memory'].bucket(index,
+                                                        host_config['shape'])
+            site.protocol = shaper.gen_token_bucket(site.protocol,
+                                                    *host_config['shape'],
+                                                    server_bucket=server_bucket)
+            if registry is not None:
+                site.metrics.shaping = site.protocol
+
+        keepAlive = host_config['keep_alive'] or [None, None]
+        if keepAlive[0] is not None:
+            site.timeOut = keepAlive[0] or None
+        site.tcpSend = host_config['tcp_send']
+        if (keepAlive[1] is not None or site.tcpSend is not None or
+                host_config['max_connections'] is not None):
+            site.protocol = connections.ConnectionLimits(
+                site.protocol, keepAlive[1], host_config['max_connections'],
+                site.tcpSend)
+            if registry is not None:
+                registry.addStats('connection_limits', site.protocol,
+                                  host=host_config['port'])
+
+        if registry is not None:
+            site.protocol = metrics.ConnectionCounter(site.protocol,
+                                                      site.metrics)
+
+        if worker is not None:
+            from mcs import workers
+            fileno, family = worker['sockets'][index]
+            workers.AdoptedPortService(fileno, family, site).setServiceParent(s)
+        else:
+            strports.service(host_config['port'], site).setServiceParent(s)
+        sites.append((host_config, site))
+
+    if pool is not None:
+        pool.setServiceParent(s)
+    else:
+        startReverseCaches(s, config, worker)
+        if config['config'] is not None:
+            configfile.ConfigReloader(s, config, sites).setServiceParent(s)
 
     return s
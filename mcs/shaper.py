@@ -5,66 +5,1210 @@
 
 """Example of rate-limiting your web server.
 
+All buckets of all shaped servers are refilled by one shared scheduler tick,
+which also releases the data queued on shaped transports.  Nothing gets
+rescheduled per write.  Data is released in quanta aligned to the payload
+of a full TCP segment, unless less than a quantum is left to send, so the
+shaping does not result in lots of tiny packets.  Buckets holding less than
+a quantum release their whole burst at once instead.
+
+Instead of one server-wide and one per-client rate, a L{Profile} read from
+a JSON file defines a hierarchy of traffic classes, optionally following
+traces of changing rates, and the rules assigning requests to them by
+vhost, client network and path prefix.  L{ShapingProfiles} reloads it on
+SIGHUP, moving the open connections over to the new classes.
+
 Caveat emptor: While the transfer rates imposed by this mechanism will
 look accurate with wget's rate-meter, don't forget to examine your network
-interface's traffic statistics as well.  The current implementation tends
-to create lots of small packets in some conditions, and each packet carries
-with it some bytes of overhead.  Check to make sure this overhead is not
-costing you more bandwidth than you are saving by limiting the rate!
+interface's traffic statistics as well.
 """
 
-from twisted.protocols import htb
+import binascii
+import json
+import os
+import signal
+import socket
+import time
+
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import interfaces, task
 from twisted.python import log
-# for picklability
-# from mcs import shaper
+from twisted.web import resource
+from zope import interface
 
-def gen_server_wide_token_bucket(server_rate, server_burst=None):
+from mcs import traces
 
-    if server_burst is None:
-        server_burst = server_rate
+# tcp payload of a 1500 bytes ethernet frame carrying tcp timestamps
+QUANTUM = 1448
 
-    log.msg('server-wide bandwidth limit: %s bytes per second' % server_rate)
-    log.msg('server-wide initial burst: %s bytes' % server_burst)
+class Bucket(object):
+    """
+    A token bucket holding up to C{burst} bytes, refilled at C{rate} bytes
+    per second.  It starts full, so the first C{burst} bytes are free.
+    Sending from a bucket also takes the tokens from all of its parents.
+    The bucket counts how often and for how long it held up connections.
+    """
 
-    serverFilter = htb.HierarchicalBucketFilter()
-    serverBucket = htb.Bucket()
+    __slots__ = ('rate', 'burst', 'tokens', 'parent', 'connections',
+                 'delays', 'throttled')
 
-    serverBucket.maxburst = int(server_burst)
-    serverBucket.rate = int(server_rate)
+    def __init__(self, rate, burst=None, parent=None):
+        self.rate = rate
+        if burst is None:
+            burst = rate
+        self.burst = burst
+        self.tokens = burst
+        self.parent = parent
+        self.connections = 0
+        self.delays = 0
+        self.throttled = 0.0
 
-    serverFilter.buckets[None] = serverBucket
+    def refill(self, elapsed):
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
 
-    return serverFilter
+    def drain(self, amount):
+        self.tokens -= amount
 
-def gen_per_client_token_bucket(client_rate, client_burst=None):
+    def fill(self, amount):
+        self.tokens = min(self.burst, self.tokens + amount)
 
-    if client_burst is None:
-        client_burst = client_rate
+    def available(self):
+        tokens = self.tokens
+        parent = self.parent
+        while parent is not None:
+            tokens = min(tokens, parent.tokens)
+            parent = parent.parent
+        return int(tokens)
 
-    log.msg('per-client bandwidth limit: %s bytes per second' % client_rate)
-    log.msg('per-client initial burst: %s bytes' % client_burst)
+    def quantum(self):
+        """
+        Return the multiple tokens are taken in, L{QUANTUM} or the smallest
+        burst of this bucket and its parents, if that holds less.
+        """
+        quantum = QUANTUM
+        bucket = self
+        while bucket is not None:
+            if bucket.burst < quantum:
+                quantum = bucket.burst
+            bucket = bucket.parent
+        return max(1, int(quantum))
+
+    def limiting(self):
+        """Return the bucket with the fewest tokens of this and its parents."""
+        limiting = bucket = self
+        while bucket.parent is not None:
+            bucket = bucket.parent
+            if bucket.tokens < limiting.tokens:
+                limiting = bucket
+        return limiting
+
+    def consume(self, amount):
+        bucket = self
+        while bucket is not None:
+            bucket.drain(amount)
+            bucket = bucket.parent
+
+    def refund(self, amount):
+        bucket = self
+        while bucket is not None:
+            bucket.fill(amount)
+            bucket = bucket.parent
+
+class SharedBucket(Bucket):
+    """
+    A L{Bucket} whose level lives in C{memory} shared by several worker
+    processes (see L{mcs.workers.SharedMemory}), so that its rate holds for
+    all of them together.  The level is refilled from the wall-clock time of
+    the last update by any process.  C{tokens} is a snapshot as of the last
+    update by this process, which may let the shared level drop below zero;
+    that debt is paid back before anybody may send again.
+    """
+
+    __slots__ = ('memory', 'slot')
+
+    def __init__(self, memory, slot, rate, burst=None):
+        Bucket.__init__(self, rate, burst)
+        self.memory = memory
+        self.slot = slot
+
+    def _update(self, change):
+        memory = self.memory
+        memory.lock()
+        try:
+            tokens, last = memory.read(self.slot)
+            now = time.time()
+            tokens = min(self.burst,
+                         tokens + self.rate * max(0, now - last) + change)
+            memory.write(self.slot, tokens, now)
+        finally:
+            memory.unlock()
+        self.tokens = tokens
+
+    def refill(self, elapsed):
+        self._update(0)
+
+    def drain(self, amount):
+        self._update(-amount)
+
+    def fill(self, amount):
+        self._update(amount)
+
+class TracedBucket(Bucket):
+    """
+    A L{Bucket} refilled by the bytes the L{traces.Trace} C{trace} delivers,
+    played from its start as the bucket is created and over and over.  Its
+    C{rate} is the average rate of the trace.
+    """
+
+    __slots__ = ('trace', 'offset', 'delivered')
+
+    def __init__(self, trace, burst=None, parent=None):
+        Bucket.__init__(self, int(trace.rate), burst, parent)
+        self.trace = trace
+        # into the trace and the bytes it delivered by then
+        self.offset = 0.0
+        self.delivered = 0.0
+
+    def refill(self, elapsed):
+        trace = self.trace
+        offset = self.offset + elapsed
+        delivered = trace.delivered(offset)
+        self.tokens = min(self.burst,
+                          self.tokens + delivered - self.delivered)
+        if offset >= trace.period:
+            offset %= trace.period
+            delivered = trace.delivered(offset)
+        self.offset = offset
+        self.delivered = delivered
+
+class Shaper(object):
+    """
+    The server-wide bucket and the per-client buckets of one shaped server.
+    Client buckets are shared by all connections from the same host and are
+    swept once they are unused and full again.  With a C{clientTrace}, each
+    client follows the trace from the moment its bucket is created.
+    """
+
+    def __init__(self, rate, clientRate=None, burst=None, clientBurst=None,
+                 server=None, clientTrace=None):
+        if clientRate is None:
+            clientRate = rate
+        if clientBurst is None:
+            clientBurst = clientRate
+        if server is None:
+            server = Bucket(rate, burst)
+        self.server = server
+        self.clientRate = clientRate
+        self.clientBurst = clientBurst
+        self.clientTrace = clientTrace
+        self.clients = {}
+        # held up by client buckets swept meanwhile
+        self.sweptDelays = 0
+        self.sweptThrottled = 0.0
+
+    def bucketFor(self, host):
+        bucket = self.clients.get(host)
+        if bucket is None:
+            if self.clientTrace is not None:
+                bucket = TracedBucket(self.clientTrace, self.clientBurst,
+                                      self.server)
+            else:
+                bucket = Bucket(self.clientRate, self.clientBurst,
+                                self.server)
+            self.clients[host] = bucket
+        bucket.connections += 1
+        return bucket
+
+    def releaseBucket(self, bucket):
+        bucket.connections -= 1
+
+    def refill(self, elapsed):
+        self.server.refill(elapsed)
+        unused = None
+        for host in self.clients:
+            bucket = self.clients[host]
+            bucket.refill(elapsed)
+            if not bucket.connections and bucket.tokens >= bucket.burst:
+                if unused is None:
+                    unused = []
+                unused.append(host)
+        if unused:
+            for host in unused:
+                bucket = self.clients.pop(host)
+                self.sweptDelays += bucket.delays
+                self.sweptThrottled += bucket.throttled
+
+class Scheduler(object):
+    """
+    Refill the buckets of all registered L{Shaper}s in one pass per tick and
+    release the data queued on shaped transports waiting for tokens.  The
+    tick only runs while somebody is waiting.
+    """
+
+    interval = 0.01
+
+    def __init__(self, interval=None, clock=None):
+        if interval is not None:
+            self.interval = interval
+        self._clock = clock
+        self.shapers = []
+        self.pending = []
+        self.waiting = []
+        self.lastRefill = None
+        self.turn = 0
+        self.loop = None
+
+    @property
+    def clock(self):
+        # the module-wide scheduler must not install the default reactor on
+        # import, before twistd or a worker installed the one to run
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def addShaper(self, shaper):
+        self.shapers.append(shaper)
+
+    def removeShaper(self, shaper):
+        if shaper in self.shapers:
+            self.shapers.remove(shaper)
+
+    def refill(self):
+        now = self.clock.seconds()
+        if self.lastRefill is None:
+            # buckets start full
+            self.lastRefill = now
+            return
+        elapsed = now - self.lastRefill
+        if elapsed <= 0:
+            return
+        self.lastRefill = now
+        for shaper in self.shapers:
+            shaper.refill(elapsed)
+
+    def refresh(self):
+        """Refill the buckets, if no tick did so recently."""
+        if self.lastRefill is None or \
+                self.clock.seconds() - self.lastRefill >= self.interval:
+            self.refill()
+
+    def schedule(self, transport):
+        """Release the data queued on C{transport} with the next tick."""
+        if not transport.scheduled:
+            transport.scheduled = True
+            self.pending.append(transport)
+            self._start()
+
+    def wait(self, callback):
+        """Call C{callback} once with the next tick."""
+        self.waiting.append(callback)
+        self._start()
+
+    def _start(self):
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.tick)
+            self.loop.clock = self.clock
+            self.loop.start(self.interval, now=False)
+
+    def tick(self):
+        self.refill()
+
+        pending, self.pending = self.pending, []
+        if pending:
+            # take turns on who is served first, the server-wide bucket
+            # might not suffice for everybody
+            start = self.turn % len(pending)
+            self.turn += 1
+            for transport in pending[start:] + pending[:start]:
+                transport.scheduled = False
+                transport.release()
+
+        waiting, self.waiting = self.waiting, []
+        for callback in waiting:
+            callback()
+
+        if not self.pending and not self.waiting:
+            self.loop.stop()
+            self.loop = None
+
+scheduler = Scheduler()
+
+@interface.implementer(interfaces.IPullProducer)
+class _TransportDrain(object):
+    """
+    Pull producer registered with the transport below a L{ShapedTransport},
+    to learn when the transport's buffer has been drained.
+    """
+
+    def __init__(self, shaped):
+        self.shaped = shaped
+
+    def resumeProducing(self):
+        self.shaped.drained()
+
+    def stopProducing(self):
+        self.shaped.stopped()
+
+@interface.implementer(interfaces.ITransport, interfaces.IConsumer,
+                       interfaces.IPushProducer)
+class ShapedTransport(object):
+    """
+    Wraps a transport, queueing everything written and releasing it to the
+    transport as fast as the bucket allows.  Towards the protocol and the
+    producers registered with it, it behaves like the wrapped transport.
+    """
+
+    # pause streaming producers above this amount of queued bytes
+    highWater = 2 ** 16
+
+    def __init__(self, transport, bucket, scheduler=scheduler):
+        self.transport = transport
+        self.bucket = bucket
+        self.scheduler = scheduler
+        self.queue = deque()
+        self.queued = 0
+        self.writable = True
+        self.scheduled = False
+        self.disconnecting = False
+        self.producer = None
+        self.streamingProducer = False
+        self.producerPaused = False
+        # the bucket holding us up and since when
+        self.limitedBy = None
+        self.limitedSince = None
+        # seconds spent waiting and bytes taken once the bucket refilled
+        self.throttled = 0.0
+        self.throttledBytes = 0
+        # how L{ShapingProfiles} classified the connection, if at all
+        self.classification = None
+        # the L{traces.Recording} of the bytes sent, if recorded
+        self.recording = None
+        transport.registerProducer(_TransportDrain(self), False)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def take(self, amount):
+        """
+        Take up to C{amount} tokens from the bucket, in multiples of its
+        L{quantum<Bucket.quantum>} unless all of C{amount} is allowed.
+        """
+        self.scheduler.refresh()
+        bucket = self.bucket
+        allowed = min(amount, bucket.available())
+        if allowed < amount:
+            # a burst below QUANTUM would never allow a full one
+            allowed -= allowed % bucket.quantum()
+        if allowed > 0:
+            if self.limitedBy is not None:
+                self._unthrottle()
+                self.throttledBytes += allowed
+            bucket.consume(allowed)
+            return allowed
+        if self.limitedBy is None:
+            self.limitedBy = bucket.limiting()
+            self.limitedBy.delays += 1
+            self.limitedSince = self.scheduler.clock.seconds()
+        return 0
+
+    def _unthrottle(self):
+        throttled = self.scheduler.clock.seconds() - self.limitedSince
+        self.limitedBy.throttled += throttled
+        self.throttled += throttled
+        self.limitedBy = self.limitedSince = None
+
+    def throttledTime(self):
+        """Return the seconds spent waiting for tokens so far."""
+        if self.limitedBy is None:
+            return self.throttled
+        return (self.throttled + self.scheduler.clock.seconds() -
+                self.limitedSince)
+
+    def switchBucket(self, bucket):
+        """Take the tokens from C{bucket} from now on, return the old one."""
+        if self.limitedBy is not None:
+            self._unthrottle()
+        previous, self.bucket = self.bucket, bucket
+        return previous
+
+    def refund(self, amount):
+        """Give back tokens taken with L{take}, but not used after all."""
+        if amount > 0:
+            self.bucket.refund(amount)
+
+    def sent(self, amount):
+        """
+        Count C{amount} bytes sent with tokens taken with L{take}, also by
+        whoever writes around the queue, like sendfile(2).
+        """
+        if self.recording is not None:
+            self.recording.add(self.scheduler.clock.seconds(), amount)
+
+    def waitForTokens(self, callback):
+        """Call C{callback} once the bucket has been refilled."""
+        self.scheduler.wait(callback)
+
+    def write(self, data):
+        if not data or self.disconnecting:
+            return
+        self.queue.append(data)
+        self.queued += len(data)
+        self._flush()
+        if (self.streamingProducer and not self.producerPaused and
+            self.queued > self.highWater):
+            self.producerPaused = True
+            self.producer.pauseProducing()
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def _dequeue(self, amount):
+        chunks = []
+        while amount > 0:
+            data = self.queue.popleft()
+            if len(data) > amount:
+                self.queue.appendleft(data[amount:])
+                data = data[:amount]
+            chunks.append(data)
+            amount -= len(data)
+            self.queued -= len(data)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def _flush(self):
+        if not (self.queued and self.writable):
+            return
+        amount = self.take(self.queued)
+        if amount:
+            # wait for the transport to drain before writing again
+            self.writable = False
+            self.transport.write(self._dequeue(amount))
+            self.sent(amount)
+        else:
+            self.scheduler.schedule(self)
+
+    def _demand(self):
+        if self.queued:
+            return
+        if self.disconnecting:
+            self._loseConnection()
+            return
+        producer = self.producer
+        if producer is None:
+            return
+        if not self.streamingProducer:
+            producer.resumeProducing()
+        elif self.producerPaused:
+            self.producerPaused = False
+            producer.resumeProducing()
+
+    def release(self):
+        """Called by the scheduler, after the bucket has been refilled."""
+        self._flush()
+        self._demand()
+
+    def drained(self):
+        """Called by the wrapped transport, once its buffer is empty."""
+        self.writable = True
+        self._flush()
+        self._demand()
+
+    def stopped(self):
+        """Called by the wrapped transport, if the connection is gone."""
+        if self.producer is not None:
+            self.producer.stopProducing()
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.transport.stopProducing()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streamingProducer = streaming
+        self.producerPaused = False
+        if not streaming:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        if not self.queued:
+            self._loseConnection()
 
-    # Web service is also limited per-host:
-    class WebClientBucket(htb.Bucket):
-        maxburst = int(client_burst)
-        rate = int(client_rate)
+    def _loseConnection(self):
+        # the transport won't disconnect while a producer is registered
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
 
-    return WebClientBucket
+    def connectionLost(self):
+        if self.limitedBy is not None:
+            self._unthrottle()
+        self.queue.clear()
+        self.queued = 0
+        self.producer = None
+
+class ShapedProtocolFactory(object):
+    """
+    Wraps a protocol factory (or class), so that the transports of all the
+    protocols it creates are shaped by the buckets of C{shaper}.
+    """
+
+    def __init__(self, protocol, shaper, scheduler=scheduler):
+        self.protocol = protocol
+        self.shaper = shaper
+        self.scheduler = scheduler
+        scheduler.addShaper(shaper)
+
+    def __call__(self, *a, **kw):
+        proto = self.protocol(*a, **kw)
+        origMakeConnection = proto.makeConnection
+        origConnectionLost = proto.connectionLost
+        shaper = self.shaper
+        scheduler = self.scheduler
+        # the shaped transport once connected
+        connected = [None]
+
+        def makeConnection(transport):
+            bucket = shaper.bucketFor(getattr(transport.getPeer(), 'host',
+                                              None))
+            connected[0] = ShapedTransport(transport, bucket, scheduler)
+            return origMakeConnection(connected[0])
+
+        def connectionLost(reason):
+            shaped, connected[0] = connected[0], None
+            if shaped is not None:
+                shaped.connectionLost()
+                shaper.releaseBucket(shaped.bucket)
+            return origConnectionLost(reason)
+
+        # set here, not when connected, so that the wrappers of other
+        # factories around this one still see the connection getting lost
+        proto.makeConnection = makeConnection
+        proto.connectionLost = connectionLost
+        return proto
+
+    def shapers(self):
+        return [('', self.shaper)]
+
+def _addressBits(address):
+    """
+    Return the family, the integer value and the number of bits of the IP
+    address C{address}, or C{None} if it is none.
+    """
+    if address.startswith('::ffff:') and '.' in address:
+        # ipv4 mapped to ipv6 by dual-stack sockets
+        address = address[7:]
+    for family, length in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return family, int(binascii.hexlify(packed), 16), length
+    return None
+
+class NetworkTrie(object):
+    """
+    A binary trie of CIDR networks, looked up with the most specific
+    network first.
+    """
+
+    def __init__(self):
+        # by address family, nodes are [zero, one, value]
+        self.roots = {}
+
+    def setdefault(self, network, value):
+        """
+        Return the value of C{network}, setting it to C{value} if it has
+        none yet.
+        """
+        address, slash, prefix = network.partition('/')
+        parsed = _addressBits(address)
+        if parsed is None:
+            raise ValueError("invalid network: %s" % network)
+        family, bits, length = parsed
+        try:
+            prefix = int(prefix) if slash else length
+        except ValueError:
+            prefix = -1
+        if not 0 <= prefix <= length:
+            raise ValueError("invalid network: %s" % network)
+        node = self.roots.setdefault(family, [None, None, None])
+        for shift in range(length - 1, length - 1 - prefix, -1):
+            bit = (bits >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = value
+        return node[2]
+
+    def lookup(self, address):
+        """
+        Return the values of all networks containing C{address}, most
+        specific first.
+        """
+        parsed = _addressBits(address) if address else None
+        if parsed is None:
+            return []
+        family, bits, length = parsed
+        found = []
+        node = self.roots.get(family)
+        shift = length
+        while node is not None:
+            if node[2] is not None:
+                found.append(node[2])
+            shift -= 1
+            if shift < 0:
+                break
+            node = node[(bits >> shift) & 1]
+        found.reverse()
+        return found
+
+class PathPrefixes(object):
+    """
+    Values of path prefixes, looked up with the longest prefix first.  A
+    prefix ending in a slash matches everything below that directory, any
+    other the very path and everything below it.  The empty prefix matches
+    every path.
+    """
+
+    def __init__(self):
+        self.prefixes = {}
+
+    def setdefault(self, prefix, value):
+        if prefix and not prefix.startswith('/'):
+            raise ValueError("invalid path prefix: %s" % prefix)
+        if prefix and not prefix.endswith('/'):
+            self.prefixes.setdefault(prefix, value)
+            prefix += '/'
+        return self.prefixes.setdefault(prefix, value)
+
+    def lookup(self, path):
+        prefixes = self.prefixes
+        value = prefixes.get(path)
+        if value is not None:
+            return value
+        end = len(path)
+        while end > 0:
+            end = path.rfind('/', 0, end)
+            if end < 0:
+                break
+            value = prefixes.get(path[:end + 1])
+            if value is not None:
+                return value
+        return prefixes.get('')
+
+def _trace(name, steps):
+    """Validate the (seconds, rate) steps of a trace of class C{name}."""
+    if not steps:
+        return ()
+    try:
+        steps = tuple((float(seconds), int(rate)) for seconds, rate in steps)
+    except (TypeError, ValueError):
+        steps = ()
+    if not steps or min(min(step) for step in steps) <= 0:
+        raise ValueError("invalid trace of traffic class %s" % name)
+    return steps
+
+def warnSmallBurst(what, burst):
+    """
+    Log that the burst of C{what} is below a L{QUANTUM}, so that its data is
+    released in packets of at most C{burst} bytes.
+    """
+    if burst is not None and burst < QUANTUM:
+        log.msg("%s has a burst of %d bytes, below a full TCP segment of %d "
+                "bytes, and sends smaller packets" % (what, burst, QUANTUM))
+
+def _replayed(name, path, directory):
+    """Read the trace file of class C{name} its clients replay, if any."""
+    if not path:
+        return None
+    try:
+        return traces.Trace.fromFile(os.path.join(directory, path))
+    except (IOError, TypeError, ValueError) as e:
+        raise ValueError("invalid client trace file of traffic class %s: %s"
+                         % (name, e))
+
+class TrafficClass(object):
+    """
+    A traffic class of a L{Profile}: a L{Shaper} whose server-wide bucket
+    is drawn from the bucket of the C{parent} class as well.  The rate of
+    the class and of each client may follow a C{trace} of (seconds, rate)
+    steps, played over and over.  Instead, each client may replay the
+    L{traces.Trace} C{replayed} on its own, from the moment it connects.
+    Unless given, bursts follow the rates and the rate of a class follows
+    its trace or, without one, that of the parent bucket when built.
+    """
+
+    keys = frozenset(['rate', 'burst', 'client-rate', 'client-burst',
+                      'parent', 'trace', 'client-trace', 'client-trace-file'])
+
+    def __init__(self, name, rate, clientRate=None, burst=None,
+                 clientBurst=None, parent=None, trace=(), clientTrace=(),
+                 replayed=None):
+        self.name = name
+        self.burst = burst
+        self.clientBurst = clientBurst
+        self.trace = trace
+        self.clientTrace = clientTrace
+        self.shaper = Shaper(rate, clientRate, burst, clientBurst,
+                             Bucket(rate, burst, parent), replayed)
+        self.calls = {}
+
+    @classmethod
+    def fromConfig(cls, name, config, parent=None, directory=''):
+        """
+        Build the class C{name} from its C{config}, with a client trace file
+        relative to C{directory}.
+        """
+        if not isinstance(config, dict) or set(config) - cls.keys:
+            raise ValueError("invalid traffic class %s" % name)
+        trace = _trace(name, config.get('trace'))
+        clientTrace = _trace(name, config.get('client-trace'))
+        replayed = _replayed(name, config.get('client-trace-file'), directory)
+        if clientTrace and replayed is not None:
+            raise ValueError("traffic class %s has both a client trace and "
+                             "a client trace file" % name)
+        try:
+            rate = int(config.get('rate') or (trace and trace[0][1]) or
+                       (parent and parent.rate))
+            clientRate = config.get('client-rate') or \
+                (clientTrace and clientTrace[0][1]) or \
+                (replayed and replayed.rate) or None
+            limits = [clientRate, config.get('burst'),
+                      config.get('client-burst')]
+            limits = [limit if limit is None else int(limit)
+                      for limit in limits]
+        except (IndexError, TypeError, ValueError):
+            rate = 0
+        if rate <= 0 or any(limit is not None and limit <= 0
+                            for limit in limits):
+            raise ValueError("invalid rates of traffic class %s" % name)
+        clientRate, burst, clientBurst = limits
+        # unless given, bursts follow the rates, also those of the traces
+        warnSmallBurst("traffic class %s" % name, burst or
+                       min([rate] + [step[1] for step in trace]))
+        warnSmallBurst("each client of traffic class %s" % name, clientBurst or
+                       min([int(clientRate or rate)] +
+                           [step[1] for step in clientTrace]))
+        return cls(name, rate, clientRate, burst, clientBurst, parent,
+                   trace, clientTrace, replayed)
+
+    def setRate(self, rate):
+        bucket = self.shaper.server
+        bucket.rate = rate
+        if self.burst is None:
+            bucket.burst = rate
+            bucket.tokens = min(bucket.tokens, rate)
+
+    def setClientRate(self, rate):
+        shaper = self.shaper
+        shaper.clientRate = rate
+        if self.clientBurst is None:
+            shaper.clientBurst = rate
+        for bucket in shaper.clients.values():
+            bucket.rate = rate
+            bucket.burst = shaper.clientBurst
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    def start(self, clock):
+        if self.trace:
+            self._follow(clock, 'rate', self.trace, self.setRate, 0)
+        if self.clientTrace:
+            self._follow(clock, 'client-rate', self.clientTrace,
+                         self.setClientRate, 0)
+
+    def _follow(self, clock, key, trace, setRate, index):
+        seconds, rate = trace[index]
+        setRate(rate)
+        self.calls[key] = clock.callLater(seconds, self._follow, clock, key,
+                                          trace, setRate,
+                                          (index + 1) % len(trace))
+
+    def stop(self):
+        for call in self.calls.values():
+            if call.active():
+                call.cancel()
+        self.calls.clear()
+
+class Profile(object):
+    """
+    The traffic L{classes<TrafficClass>} by name and the rules assigning
+    requests to them.  The rules for the requested vhost are matched before
+    those for any vhost, then the rules for the most specific network of
+    the client before those for less specific or any networks, and of those
+    the rule with the longest matching path prefix.  Requests matching no
+    rule end up in the C{default} class.  The bytes sent on connections are
+    recorded by the L{traces.Recorder} C{recorder}, if given.
+    """
+
+    keys = frozenset(['vhost', 'network', 'path', 'class'])
+
+    def __init__(self, classes, default, recorder=None):
+        self.classes = classes
+        self.default = classes[default]
+        self.recorder = recorder
+        # by vhost, None for any, a NetworkTrie and the rules for any network
+        self.vhosts = {}
+
+    @classmethod
+    def fromFile(cls, path, root=None):
+        """
+        Read a profile from the JSON file at C{path}, with the top-level
+        classes drawn from the bucket C{root} as well, eg.::
+
+            {"classes": {"all": {"rate": 2500000, "client-rate": 500000},
+                         "low": {"parent": "all", "client-rate": 100000},
+                         "3g": {"parent": "all",
+                                "client-trace": [[5, 250000], [5, 60000]]},
+                         "lte": {"parent": "all", "rate": 2500000,
+                                 "client-burst": 14480,
+                                 "client-trace-file": "traces/lte.down"}},
+             "rules": [{"path": "/live/low/", "class": "low"},
+                       {"network": "10.3.0.0/16", "class": "3g"},
+                       {"network": "10.4.0.0/16", "class": "lte"}],
+             "default": "all",
+             "record": "recorded"}
+
+        Trace files, which each client replays on its own, and the directory
+        the connections are recorded into are relative to the profile.
+        """
+        with open(path) as f:
+            try:
+                config = json.load(f)
+            except ValueError as e:
+                raise ValueError("%s: %s" % (path, e))
+        if not isinstance(config, dict):
+            raise ValueError("%s: not a shaping profile" % path)
+        specs = config.get('classes') or {}
+        if not isinstance(specs, dict):
+            raise ValueError("%s: invalid traffic classes" % path)
+        directory = os.path.dirname(os.path.abspath(path))
+
+        classes = {}
+
+        def build(name, children=()):
+            if name in classes:
+                return classes[name]
+            if name in children or name not in specs:
+                raise ValueError("%s: unknown or circular parent of traffic "
+                                 "class %s" % (path, children[-1]))
+            spec = specs[name]
+            parent = root
+            if isinstance(spec, dict) and spec.get('parent') is not None:
+                parent = build(spec['parent'], children + (name,))
+                parent = parent.shaper.server
+            classes[name] = TrafficClass.fromConfig(name, spec, parent,
+                                                    directory)
+            return classes[name]
+
+        for name in specs:
+            build(name)
+        if config.get('default') not in classes:
+            raise ValueError("%s: missing or unknown default traffic class" %
+                             path)
+        recorder = None
+        if config.get('record'):
+            record = os.path.join(directory, config['record'])
+            if not os.path.isdir(record):
+                raise ValueError("%s: no directory to record into: %s" %
+                                 (path, record))
+            recorder = traces.Recorder(record)
+        profile = cls(classes, config['default'], recorder)
+        for rule in config.get('rules') or ():
+            if (not isinstance(rule, dict) or set(rule) - cls.keys or
+                rule.get('class') not in classes):
+                raise ValueError("%s: invalid rule %r" % (path, rule))
+            profile.addRule(classes[rule['class']], rule.get('vhost'),
+                            rule.get('network'), rule.get('path') or '')
+        return profile
+
+    def addRule(self, trafficClass, vhost=None, network=None, path=''):
+        if vhost:
+            vhost = vhost.lower()
+        rules = self.vhosts.get(vhost or None)
+        if rules is None:
+            rules = self.vhosts[vhost or None] = (NetworkTrie(),
+                                                  PathPrefixes())
+        networks, anywhere = rules
+        prefixes = anywhere
+        if network:
+            prefixes = networks.setdefault(network, PathPrefixes())
+        # the first rule for the same vhost, network and prefix wins
+        prefixes.setdefault(path, trafficClass)
+
+    def tables(self, vhost, address):
+        """
+        Return the L{PathPrefixes} of the rules for C{vhost} and the client
+        C{address}, in the order they are matched.
+        """
+        tables = []
+        for key in (vhost, None):
+            rules = self.vhosts.get(key)
+            if rules is not None:
+                networks, anywhere = rules
+                tables.extend(networks.lookup(address))
+                tables.append(anywhere)
+        return tables
+
+    def classify(self, tables, path):
+        for prefixes in tables:
+            trafficClass = prefixes.lookup(path)
+            if trafficClass is not None:
+                return trafficClass
+        return self.default
+
+    def start(self, scheduler):
+        for trafficClass in self.classes.values():
+            scheduler.addShaper(trafficClass.shaper)
+            trafficClass.start(scheduler.clock)
+
+    def stop(self, scheduler):
+        for trafficClass in self.classes.values():
+            trafficClass.stop()
+            scheduler.removeShaper(trafficClass.shaper)
+
+class _Classification(object):
+    """How a connection has been classified by L{ShapingProfiles}."""
+
+    __slots__ = ('host', 'vhost', 'path', 'profile', 'tables',
+                 'trafficClass', 'recorder')
+
+    def __init__(self, host):
+        self.host = host
+        self.vhost = None
+        self.path = ''
+        self.profile = None
+        self.tables = None
+        self.trafficClass = None
+        self.recorder = None
+
+class ShapingProfiles(service.Service):
+    """
+    Shapes connections by the classes of the L{Profile} in the file at
+    C{path}, which is reloaded on SIGHUP.  Connections are classified as
+    they connect and again with each request, by vhost and path.  Reloading
+    moves them to the classes of the new profile, and a profile which fails
+    to load leaves the current one in place.  Connections are recorded by
+    the profile loaded as they connect.  Top-level classes are drawn
+    from the bucket C{root} as well, if given.
+    """
+
+    def __init__(self, path, root=None, scheduler=scheduler):
+        self.path = path
+        self.root = root
+        self.scheduler = scheduler
+        self.profile = Profile.fromFile(path, root)
+        self.rootShaper = None
+        if root is not None:
+            self.rootShaper = Shaper(root.rate, server=root)
+        self.transports = set()
+        self.previousHandler = None
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.rootShaper is not None:
+            self.scheduler.addShaper(self.rootShaper)
+        self.profile.start(self.scheduler)
+        log.msg('shaping by the %d traffic classes of %s' %
+                (len(self.profile.classes), self.path))
+        try:
+            self.previousHandler = signal.signal(signal.SIGHUP,
+                                                 self._reloadSignalled)
+        except (AttributeError, ValueError):
+            # no SIGHUP or not the main thread
+            pass
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.previousHandler is not None:
+            signal.signal(signal.SIGHUP, self.previousHandler)
+            self.previousHandler = None
+        self.profile.stop(self.scheduler)
+        if self.rootShaper is not None:
+            self.scheduler.removeShaper(self.rootShaper)
+
+    def _reloadSignalled(self, signum, frame):
+        self.scheduler.clock.callFromThread(self.reload)
+        if callable(self.previousHandler):
+            # other hosts' profiles
+            self.previousHandler(signum, frame)
+
+    def reload(self):
+        try:
+            profile = Profile.fromFile(self.path, self.root)
+        except (IOError, ValueError) as e:
+            log.msg('keeping the shaping profile, reloading failed: %s' % e)
+            return
+        previous, self.profile = self.profile, profile
+        profile.start(self.scheduler)
+        for transport in self.transports:
+            self._classify(transport)
+        previous.stop(self.scheduler)
+        log.msg('reloaded the %d traffic classes of %s' %
+                (len(profile.classes), self.path))
+
+    def connect(self, transport, host):
+        """Classify the new connection of L{ShapedTransport} C{transport}."""
+        classification = transport.classification = _Classification(host)
+        self.transports.add(transport)
+        self._classify(transport)
+        recorder = self.profile.recorder
+        if recorder is not None:
+            classification.recorder = recorder
+            transport.recording = recorder.start(
+                host, self.scheduler.clock.seconds())
+
+    def disconnect(self, transport):
+        self.transports.discard(transport)
+        classification = transport.classification
+        classification.trafficClass.shaper.releaseBucket(transport.bucket)
+        if classification.recorder is not None:
+            classification.recorder.stop(transport.recording)
+
+    def classify(self, transport, vhost, path):
+        """Classify the connection again for a request of C{path}."""
+        classification = transport.classification
+        if vhost:
+            vhost = vhost.lower()
+        if vhost != classification.vhost:
+            classification.vhost = vhost
+            classification.tables = None
+        classification.path = path
+        self._classify(transport)
+
+    def _classify(self, transport):
+        classification = transport.classification
+        profile = self.profile
+        if classification.tables is None or \
+           classification.profile is not profile:
+            classification.profile = profile
+            classification.tables = profile.tables(classification.vhost,
+                                                   classification.host)
+        trafficClass = profile.classify(classification.tables,
+                                        classification.path)
+        if trafficClass is classification.trafficClass:
+            return
+        bucket = trafficClass.shaper.bucketFor(classification.host)
+        previous = transport.switchBucket(bucket)
+        if classification.trafficClass is not None:
+            classification.trafficClass.shaper.releaseBucket(previous)
+        classification.trafficClass = trafficClass
+
+    def shapers(self):
+        return [(name, trafficClass.shaper) for name, trafficClass
+                in sorted(self.profile.classes.items())]
+
+class ProfiledProtocolFactory(object):
+    """
+    Wraps a protocol factory (or class), so that the transports of all the
+    protocols it creates are shaped by the classes of L{ShapingProfiles}.
+    """
+
+    def __init__(self, protocol, profiles, scheduler=scheduler):
+        self.protocol = protocol
+        self.profiles = profiles
+        self.scheduler = scheduler
+
+    def __call__(self, *a, **kw):
+        proto = self.protocol(*a, **kw)
+        origMakeConnection = proto.makeConnection
+        origConnectionLost = proto.connectionLost
+        profiles = self.profiles
+        scheduler = self.scheduler
+        connected = [None]
+
+        def makeConnection(transport):
+            connected[0] = ShapedTransport(transport, None, scheduler)
+            profiles.connect(connected[0], getattr(transport.getPeer(),
+                                                   'host', None))
+            return origMakeConnection(connected[0])
+
+        def connectionLost(reason):
+            shaped, connected[0] = connected[0], None
+            if shaped is not None:
+                shaped.connectionLost()
+                profiles.disconnect(shaped)
+            return origConnectionLost(reason)
+
+        proto.makeConnection = makeConnection
+        proto.connectionLost = connectionLost
+        return proto
+
+    def shapers(self):
+        return self.profiles.shapers()
+
+class ClassifyingResource(resource.Resource):
+    """
+    Wraps the root resource of a site, classifying the connection of each
+    request with L{ShapingProfiles} before it is served.
+    """
+
+    def __init__(self, wrapped, profiles):
+        resource.Resource.__init__(self)
+        self.wrapped = wrapped
+        self.profiles = profiles
+        self.isLeaf = wrapped.isLeaf
+
+    def _classify(self, request):
+        shaped = unwrapTransport(request.transport)[1]
+        if shaped is not None and shaped.classification is not None:
+            host, path = request.getRequestHostname(), request.path
+            if not isinstance(path, str):
+                # bytes with python 3, the rules are text
+                host, path = host.decode('latin-1'), path.decode('latin-1')
+            self.profiles.classify(shaped, host, path)
+
+    def getChildWithDefault(self, path, request):
+        self._classify(request)
+        return self.wrapped.getChildWithDefault(path, request)
+
+    def render(self, request):
+        self._classify(request)
+        return self.wrapped.render(request)
 
 def gen_token_bucket(protocol, server_rate,       client_rate=None,
-                               server_burst=None, client_burst=None):
+                               server_burst=None, client_burst=None,
+                               server_bucket=None):
 
     if client_rate is None:
         client_rate = server_rate
+    if server_burst is None:
+        server_burst = server_rate
+    if client_burst is None:
+        client_burst = client_rate
 
-    serverFilter = gen_server_wide_token_bucket(server_rate, server_burst)
+    log.msg('server-wide bandwidth limit: %s bytes per second' % server_rate)
+    log.msg('server-wide initial burst: %s bytes' % server_burst)
+    log.msg('per-client bandwidth limit: %s bytes per second' % client_rate)
+    log.msg('per-client initial burst: %s bytes' % client_burst)
 
-    webFilter = htb.FilterByHost(serverFilter)
-    # for picklability
-    # webFilter.bucketFactory = shaper.gen_per_client_token_bucket(client_rate, client_burst)
-    webFilter.bucketFactory = gen_per_client_token_bucket(client_rate, client_burst)
+    return ShapedProtocolFactory(protocol,
+                                 Shaper(int(server_rate), int(client_rate),
+                                        int(server_burst), int(client_burst),
+                                        server_bucket))
 
-    return htb.ShapedProtocolFactory(protocol, webFilter)
+def unwrapTransport(transport):
+    """
+    Return the transport below a shaped transport and the shaped transport,
+    or the given transport and C{None} if it is not shaped at all.
+    """
+    if isinstance(transport, ShapedTransport):
+        return transport.transport, transport
+    return transport, None
 
 if __name__ == "__main__":
     import sys, os
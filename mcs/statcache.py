@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Shared cache of file metadata for conditional requests.
+
+Players revalidate segments and playlists all the time, and each
+revalidation used to stat every directory on the way to the file, stat the
+file and open it before twisted even looked at If-Modified-Since.  The
+L{StatCache} of a host keeps the results of stat(2) for the paths below
+its roots, including those which do not exist, and L{mcs.static.File}
+takes its metadata from there.  Conditional requests are answered with a
+strong ETag derived from inode, size and modification time, before the
+file is opened.  Entries are dropped by inotify notifications where
+available and re-statted once they are older than C{ttl} seconds in any
+case.
+
+A L{ChildCache} in front of it remembers the files request paths resolve
+to, so that repeated requests skip walking the path, probing ignored
+extensions and creating the resource of the file.
+"""
+
+import os
+import stat
+import sys
+
+from collections import OrderedDict
+
+from twisted.application import service
+from twisted.python import filepath, log
+
+from mcs import cache, playlist
+
+def _native(path):
+    """Return C{path} as a native string, the way notifications carry it."""
+    if isinstance(path, str):
+        return path
+    if isinstance(path, bytes):
+        return path.decode(sys.getfilesystemencoding(), 'surrogateescape')
+    return path.encode(sys.getfilesystemencoding())
+
+def entityTag(path):
+    """Return a strong ETag of the L{filepath.FilePath} C{path}."""
+    return cache.entityTag(path.getInodeNumber(), path.getsize(),
+                           path.getModificationTime())
+
+class StatCache(service.Service):
+    """
+    Caches the stat of up to C{maxEntries} paths below the roots added, for
+    at most C{ttl} seconds each.
+    """
+
+    def __init__(self, ttl, maxEntries=65536, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.ttl = ttl
+        self.maxEntries = max(1, maxEntries)
+        self.clock = clock
+        self.roots = []
+        self.entries = OrderedDict()
+        self.notifier = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def addRoot(self, root):
+        if root not in self.roots:
+            self.roots.append(root)
+            if self.notifier is not None:
+                # added by a reloaded configuration
+                self._watch(self.notifier, root)
+
+    def _watch(self, notifier, root):
+        notifier.watch(filepath.FilePath(root), mask=playlist.WATCH_MASK,
+                       autoAdd=True, callbacks=[self.notify], recursive=True)
+
+    def stat(self, path):
+        """
+        Return the stat of C{path}, or C{None} if it does not exist.
+        """
+        path = _native(path)
+        now = self.clock.seconds()
+        entry = self.entries.pop(path, None)
+        if entry is not None and now - entry[0] < self.ttl:
+            # re-insert as the most recently used entry
+            self.entries[path] = entry
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        while len(self.entries) >= self.maxEntries:
+            self.entries.popitem(last=False)
+        self.entries[path] = (now, st)
+        return st
+
+    def restat(self, path, reraise=True):
+        """
+        Replaces L{filepath.FilePath.restat} of C{path} with a lookup.
+        """
+        st = self.stat(path.path)
+        if st is None and reraise:
+            # raise the error of stat itself
+            return filepath.FilePath.restat(path, reraise)
+        path._statinfo = st or 0
+
+    def invalidate(self, path):
+        if self.entries.pop(path, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    def notify(self, ignored, path, mask):
+        if mask & (playlist.IN_ISDIR | playlist.IN_Q_OVERFLOW):
+            # whole directories moved or events lost, start over
+            self.clear()
+        else:
+            # the directory has been modified along with its entry
+            path = _native(path.path)
+            self.invalidate(path)
+            self.invalidate(os.path.dirname(path))
+
+    def startService(self):
+        service.Service.startService(self)
+        notifier = None
+        try:
+            from twisted.internet import inotify
+            notifier = inotify.INotify()
+            notifier.startReading()
+            for root in self.roots:
+                self._watch(notifier, root)
+        except Exception as e:
+            log.msg('inotify unavailable, keeping file metadata for %s '
+                    'seconds: %s' % (self.ttl, e))
+            if notifier is not None:
+                notifier.loseConnection()
+            self.clear()
+            return
+        self.notifier = notifier
+        log.msg('watching file metadata below %s' % ', '.join(self.roots))
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'max-entries': self.maxEntries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'inotify': self.notifier is not None}
+
+class CachedPath(filepath.FilePath):
+    """
+    A L{filepath.FilePath} taking its metadata from a L{StatCache}, as the
+    children of L{mcs.static.File} are looked up.
+    """
+
+    def __init__(self, path, statCache, alwaysCreate=False):
+        filepath.FilePath.__init__(self, path, alwaysCreate)
+        self.statCache = statCache
+
+    def clonePath(self, path, alwaysCreate=False):
+        return CachedPath(path, self.statCache, alwaysCreate)
+
+    def restat(self, reraise=True):
+        self.statCache.restat(self, reraise)
+
+class Resolved(object):
+    """
+    The resource of the file a request path resolved to, and the path
+    requested if the file was found with an ignored extension.
+    """
+
+    __slots__ = ('resource', 'requested')
+
+    def __init__(self, resource, requested=None):
+        self.resource = resource
+        self.requested = requested
+
+class ChildCache(object):
+    """
+    Caches the resources of the files up to C{maxEntries} request paths
+    resolved to, as long as the L{StatCache} C{statCache} has them as
+    regular files, and no file appeared at the path requested in place of
+    one found with an ignored extension.
+    """
+
+    def __init__(self, statCache, maxEntries=4096):
+        self.statCache = statCache
+        self.maxEntries = max(1, maxEntries)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Return the resource resolved for C{key}, or C{None}."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            st = self.statCache.stat(entry.resource.path)
+            if st is not None and stat.S_ISREG(st.st_mode) and \
+                    (entry.requested is None or
+                     self.statCache.stat(entry.requested) is None):
+                # re-insert as the most recently used entry
+                self.entries[key] = entry
+                self.hits += 1
+                return entry.resource
+            self.invalidations += 1
+        self.misses += 1
+        return None
+
+    def put(self, key, resource, requested=None):
+        self.entries.pop(key, None)
+        while len(self.entries) >= self.maxEntries:
+            self.entries.popitem(last=False)
+        self.entries[key] = Resolved(resource, requested)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'max-entries': self.maxEntries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations}
@@ -2,9 +2,14 @@
 # © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
 # See LICENSE for details.
 
-from twisted.web import static
+import os
+import stat
 
-from mcs import mediatypes
+from twisted.python import filepath
+from twisted.web import http, static
+
+from mcs import cache, compression, listing, mediatypes, playlist, ranges, \
+    sendfile, statcache
 
 Data = static.Data
 
@@ -17,6 +22,19 @@ class File(static.File):
     contentTypes = static.File.contentTypes
     contentTypes.update(mediatypes.VIDEO_MIME_TYPES)
 
+    useSendfile = True
+    segmentCache = None
+    playlistCache = None
+    descriptorPool = None
+    movieIndex = None
+    directoryCache = None
+    variantCache = None
+    statCache = None
+    childCache = None
+    readahead = None
+    # compressed body sent instead of the file's
+    variant = None
+
     def __init__(self, path, defaultType=mediatypes.DEFAULT_MIME_TYPE,
                  ignoredExts=(), registry=None, allowExt=0):
         """Create a file with the given path.
@@ -25,6 +43,375 @@ class File(static.File):
                              ignoredExts=ignoredExts, registry=registry,
                              allowExt=allowExt)
 
+    def createSimilarFile(self, path):
+        f = static.File.createSimilarFile(self, path)
+        f.useSendfile = self.useSendfile
+        f.segmentCache = self.segmentCache
+        f.playlistCache = self.playlistCache
+        f.descriptorPool = self.descriptorPool
+        f.movieIndex = self.movieIndex
+        f.directoryCache = self.directoryCache
+        f.variantCache = self.variantCache
+        f.statCache = self.statCache
+        f.childCache = self.childCache
+        f.readahead = self.readahead
+        return f
+
+    def restat(self, reraise=True):
+        stats = self.statCache
+        if stats is None:
+            return static.File.restat(self, reraise)
+        stats.restat(self, reraise)
+
+    def clonePath(self, path, alwaysCreate=False):
+        """
+        Let children looked up by twisted share the stat cache.
+        """
+        stats = self.statCache
+        if stats is None:
+            return filepath.FilePath(path, alwaysCreate)
+        return statcache.CachedPath(path, stats, alwaysCreate)
+
+    def getChild(self, path, request):
+        """
+        Answer cached playlists anywhere below this directory right away,
+        without walking and statting the path, and park blocking playlist
+        reloads until the playlist is updated.  Other files are looked up
+        in the stat cache at once, rather than directory by directory, or
+        taken from the child cache.
+        """
+        playlists = self.playlistCache
+        if playlists is not None and request is not None:
+            segments = [path] + request.postpath
+            if b'_HLS_msn' in request.args:
+                playlistPath = playlists.pathFor(self.path, segments)
+                if playlistPath is not None:
+                    return playlist.BlockingPlaylistResource(playlists,
+                        playlistPath, self.variantCache)
+            entry = playlists.lookupSegments(self.path, segments)
+            if entry is not None:
+                if self.readahead is not None:
+                    self.readahead.playlist(entry.path, entry.data)
+                return playlist.PlaylistResource(entry, self.variantCache)
+        if self.statCache is not None and request is not None:
+            child = self._resolve([path] + request.postpath)
+            if child is not None:
+                request.prepath.extend(request.postpath)
+                del request.postpath[:]
+                return child
+        return static.File.getChild(self, path, request)
+
+    def _resolve(self, segments):
+        """
+        Return the file C{segments} lead to, or C{None}.  With a child cache
+        it is resolved along with its content type once and then reused.
+        """
+        children = self.childCache
+        if children is not None:
+            key = (self.path, self.defaultType, tuple(self.ignoredExts),
+                   tuple(segments))
+            child = children.get(key)
+            if child is not None:
+                return child
+        path = self._pathOf(segments)
+        if path is None:
+            return None
+        child = self._lookupCached(path)
+        if child is not None and children is not None:
+            child.type, child.encoding = static.getTypeAndEncoding(
+                child.basename(), self.contentTypes, self.contentEncodings,
+                self.defaultType)
+            children.put(key, child, path if child.path != path else None)
+        return child
+
+    def _pathOf(self, segments):
+        """
+        Return the path C{segments} lead to below this directory, or C{None}
+        if they are left to twisted.
+        """
+        try:
+            segments = [segment.decode('utf-8')
+                        if isinstance(segment, bytes) else segment
+                        for segment in segments]
+            for segment in segments:
+                if segment in ('', '.', '..') or '/' in segment or \
+                        '\0' in segment:
+                    return None
+            return os.path.join(self.path, *segments)
+        except UnicodeError:
+            # left to twisted, which logs it
+            return None
+
+    def _lookupCached(self, path):
+        st = self.statCache.stat(path)
+        if st is None and self.ignoredExts:
+            path = self._probe(path)
+            st = path is not None and self.statCache.stat(path) or None
+        if st is None or not stat.S_ISREG(st.st_mode) or \
+                os.path.splitext(path)[1] in self.processors:
+            return None
+        return self.createSimilarFile(path)
+
+    def _probe(self, path):
+        """
+        Return the path of the file found for the missing C{path} with one
+        of the ignored extensions, like L{static.File.getChild} does, but
+        through the stat cache.
+        """
+        for ext in self.ignoredExts:
+            if ext == '*':
+                found = filepath.FilePath(path).siblingExtensionSearch(ext)
+                if found is not None:
+                    return found.path
+            elif ext and self.statCache.stat(path + ext) is not None:
+                return path + ext
+        return None
+
+    def childSearchPreauth(self, *paths):
+        """
+        Look up the index file of this directory in the directory cache.
+        """
+        directories = self.directoryCache
+        if directories is None:
+            return static.File.childSearchPreauth(self, *paths)
+        return directories.index(self, paths)
+
+    def directoryListing(self):
+        """
+        List this directory off the reactor thread, if a directory cache is
+        configured.
+        """
+        directories = self.directoryCache
+        if directories is None:
+            return static.File.directoryListing(self)
+        path = self.path
+        if not isinstance(path, str):
+            # list in terms of native strings, as twisted does
+            path = self.asBytesMode().path
+        return listing.DirectoryListing(path, self.getModificationTime(),
+                                        directories, self.contentTypes,
+                                        self.contentEncodings,
+                                        self.defaultType)
+
+    def render_GET(self, request):
+        """
+        Send playlists and manifests compressed to clients accepting it,
+        preferring precompressed files next to them, and read ahead what
+        players are going to request next.
+        """
+        if self.readahead is not None and self.variant is None:
+            self.readahead.served(self.path)
+        variants = self.variantCache
+        if variants is None or self.variant is not None or \
+                not variants.cacheable(self.path):
+            return self._renderFile(request)
+        request.setHeader('vary', 'accept-encoding')
+        accepted = compression.acceptedEncodings(
+            request.getHeader('accept-encoding'))
+        self.restat(False)
+        if not accepted or not self.isfile():
+            return self._renderFile(request)
+        if self.type is None:
+            self.type, self.encoding = static.getTypeAndEncoding(
+                self.basename(), self.contentTypes, self.contentEncodings,
+                self.defaultType)
+        encoded = self._precompressed(accepted, variants) or \
+                  self._compressed(request, accepted, variants)
+        if encoded is None:
+            return self._renderFile(request)
+        return encoded.render_GET(request)
+
+    render_HEAD = render_GET
+
+    def _renderFile(self, request):
+        if self._notModified(request):
+            return b''
+        return static.File.render_GET(self, request)
+
+    def _notModified(self, request):
+        """
+        Answer conditional requests from the stat cache before opening the
+        file, tagging the response with an ETag of the file.  Playlists the
+        playlist cache keeps are tagged without a stat cache as well, the
+        way it answers them later.
+        """
+        playlists = self.playlistCache
+        if self.statCache is None and (playlists is None or
+                                       not playlists.cacheable(self.path)):
+            return False
+        self.restat(False)
+        if not self.isfile():
+            return False
+        etag = statcache.entityTag(self)
+        if self.variant is not None:
+            etag = '%s-%s"' % (etag[:-1], self.encoding)
+        # compared here, twisted compares bytes to it with python 3
+        request.setHeader('etag', etag)
+        tags = request.getHeader('if-none-match')
+        if tags is None:
+            return request.setLastModified(self.getModificationTime()) is \
+                http.CACHED
+        if cache.entityTagMatches(tags, etag):
+            request.setResponseCode(http.NOT_MODIFIED)
+            return True
+        # If-Modified-Since only counts without If-None-Match, also when
+        # twisted renders the file
+        request.requestHeaders.removeHeader(b'if-modified-since')
+        return False
+
+    def _precompressed(self, accepted, variants):
+        for encoding in accepted:
+            sibling = self.createSimilarFile(self.path +
+                                             compression.SUFFIXES[encoding])
+            if sibling.isfile() and sibling.getModificationTime() >= \
+                    self.getModificationTime():
+                sibling.type, sibling.encoding = self.type, encoding
+                variants.sent(self.getsize(), sibling.getsize(), True)
+                return sibling
+        return None
+
+    def _compressed(self, request, accepted, variants):
+        if self.getsize() > variants.maxEntrySize or \
+                not set(accepted) & set(variants.encodings):
+            return None
+        try:
+            fileForReading = self.openForReading()
+        except IOError:
+            # let twisted respond to it
+            return None
+        try:
+            data = fileForReading.read()
+        finally:
+            fileForReading.close()
+        version = self._version()
+        if len(data) != version[1]:
+            return None
+        encoding, data = variants.negotiate(request, self.path, version, data)
+        if encoding is None:
+            return None
+        f = self.createSimilarFile(self.path)
+        f.type, f.encoding = self.type, encoding
+        f.variant = data
+        return f
+
+    def getFileSize(self):
+        if self.variant is not None:
+            return len(self.variant)
+        return static.File.getFileSize(self)
+
+    def openForReading(self):
+        """
+        Return the cached body of segments and playlists, reading and caching
+        it on misses or after the file has been modified.
+        """
+        if self.variant is not None:
+            return cache.CachedFile(self.path, self.variant)
+        playlists = self.playlistCache
+        if playlists is not None and playlists.cacheable(self.path):
+            fileForReading = static.File.openForReading(self)
+            try:
+                data = fileForReading.read()
+            finally:
+                fileForReading.close()
+            playlists.store(self.path, data, self.getModificationTime(),
+                            self.getsize(), self.getInodeNumber())
+            return cache.CachedFile(self.path, data)
+
+        segments = self.segmentCache
+        if segments is None or not segments.cacheable(self.path):
+            return self._openPooled()
+        version = self._version()
+        data = segments.get(self.path, version)
+        if data is not None:
+            return cache.CachedFile(self.path, data)
+        fileForReading = self._openPooled()
+        if version[1] > segments.maxEntrySize:
+            return fileForReading
+        try:
+            data = fileForReading.read()
+        finally:
+            fileForReading.close()
+        if len(data) == version[1]:
+            segments.put(self.path, version, data)
+        return cache.CachedFile(self.path, data)
+
+    def _version(self):
+        return (self.getModificationTime(), self.getsize())
+
+    def _openPooled(self):
+        """
+        Return the file from the descriptor pool, if it has been requested in
+        ranges recently.
+        """
+        pool = self.descriptorPool
+        if pool is not None:
+            fileForReading = pool.open(self.path, self._version())
+            if fileForReading is not None:
+                return fileForReading
+        return static.File.openForReading(self)
+
+    def _parseRangeHeader(self, range):
+        """
+        Coalesce overlapping and adjacent ranges, so that several parts of a
+        multipart response never send the same bytes twice and requests for
+        contiguous ranges get a single-range response.
+        """
+        byteRanges = static.File._parseRangeHeader(self, range)
+        if len(byteRanges) < 2:
+            return byteRanges
+        offsets = []
+        for start, end in byteRanges:
+            offset, size = self._rangeToOffsetAndSize(start, end)
+            if offset < 0:
+                # a suffix range longer than the file
+                offset, size = 0, size + offset
+            if size > 0:
+                offsets.append((offset, size))
+        if not offsets:
+            # let twisted respond with 416
+            return byteRanges
+        return [(offset, offset + size - 1)
+                for offset, size in ranges.coalesce(offsets)]
+
+    def makeProducer(self, request, fileForReading):
+        """
+        Write cached bodies at once and hand other whole-file and single-range
+        responses to the kernel with sendfile(2), if available.  Ranges within
+        the index of an MP4 file are written from memory, files requested in
+        ranges are kept open for the following ones.
+        """
+        producer = static.File.makeProducer(self, request, fileForReading)
+        if isinstance(fileForReading, cache.CachedFile):
+            return cache.fromStaticProducer(producer) or producer
+        if request.getHeader('range') is not None:
+            pool = self.descriptorPool
+            if pool is not None and \
+                    not isinstance(fileForReading, ranges.PooledFile):
+                pool.add(self.path, self._version(), fileForReading)
+            if isinstance(producer, static.SingleRangeStaticProducer):
+                producer = self._makeIndexedProducer(producer) or producer
+        if self.useSendfile:
+            return sendfile.fromStaticProducer(producer) or producer
+        return producer
+
+    def _makeIndexedProducer(self, producer):
+        """
+        Return a producer writing the single range of C{producer} from the
+        cached index of an MP4 file, or C{None}.
+        """
+        movies = self.movieIndex
+        if movies is None or producer.size <= 0 or \
+                not movies.cacheable(self.path):
+            return None
+        index = movies.lookup(self.path, self._version(), producer.fileObject)
+        data, offset = index.find(producer.offset, producer.size)
+        if data is None:
+            return None
+        producer.fileObject.close()
+        return cache.CachedProducer(producer.request,
+                                    cache.CachedFile(self.path, data),
+                                    offset, producer.size)
+
     def upgradeToVersion2(self):
         self.defaultType = mediatypes.DEFAULT_MIME_TYPE
 
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs}, run with C{trial mcs}.
+"""
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.accesslog}.
+"""
+
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from mcs import accesslog
+
+class AccessLogTests(unittest.TestCase):
+
+    def test_reopen(self):
+        """
+        Lines buffered when the file is reopened end up in the old file, the
+        following ones in the new file.
+        """
+        path = self.mktemp()
+        accessLog = accesslog.AccessLog(path, interval=60, clock=task.Clock())
+        accessLog.startService()
+        accessLog.write(b'before\n')
+        os.rename(path, path + '.1')
+        accessLog.reopen()
+        accessLog.write(b'after\n')
+        accessLog.stopService()
+        with open(path + '.1', 'rb') as f:
+            self.assertEqual(f.read(), b'before\n')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'after\n')
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.compression}.
+"""
+
+from twisted.trial import unittest
+
+from mcs import compression
+
+class AcceptedEncodingsTests(unittest.TestCase):
+
+    def test_none(self):
+        self.assertEqual(compression.acceptedEncodings(None), [])
+        self.assertEqual(compression.acceptedEncodings('identity'), [])
+
+    def test_preference(self):
+        """Codings of equal quality come in the order of PREFERENCE."""
+        self.assertEqual(compression.acceptedEncodings('gzip, deflate, br'),
+                         ['br', 'gzip'])
+
+    def test_quality(self):
+        """
+        Codings come in the order of their quality, those of quality zero
+        not at all.
+        """
+        self.assertEqual(compression.acceptedEncodings('br;q=0.5, GZIP'),
+                         ['gzip', 'br'])
+        self.assertEqual(compression.acceptedEncodings('br;q=0, gzip'),
+                         ['gzip'])
+        self.assertEqual(compression.acceptedEncodings('gzip;q=x'), [])
+
+    def test_aliasAndWildcard(self):
+        """x-gzip is gzip, and * accepts all codings not named."""
+        self.assertEqual(compression.acceptedEncodings('x-gzip'), ['gzip'])
+        self.assertEqual(compression.acceptedEncodings('*;q=0.5, gzip'),
+                         ['gzip', 'br'])
+        self.assertEqual(compression.acceptedEncodings('*, br;q=0'),
+                         ['gzip'])
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.configfile}.
+"""
+
+import json
+
+from twisted.trial import unittest
+
+from mcs import configfile, server
+
+class ArgumentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.known = configfile.knownOptions(server.Options())
+
+    def arguments(self, document):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            json.dump(document, f)
+        return configfile.arguments(path, self.known)
+
+    def test_hosts(self):
+        """
+        The first host gives the --port, the others a --host each, with
+        their own options and vhosts following them.
+        """
+        self.assertEqual(
+            self.arguments({'logfile': 'access.log',
+                            'hosts': [{'port': 8080, 'path': '/srv/a',
+                                       'cache': [1024, 512]},
+                                      {'port': 'tcp:8081', 'path': '/srv/b',
+                                       'vhosts': [{'fqdn': '*.Example',
+                                                   'path': '/srv/c'}]}]}),
+            ['--logfile=access.log',
+             '--port=tcp:8080', '--path=/srv/a', '--cache=1024,512',
+             '--host=tcp:8081', '--path=/srv/b',
+             '--vhost=*.example', '--path=/srv/c'])
+
+    def test_repeatedAndFlags(self):
+        """
+        Lists of repeatable options give the option once per item, mappings
+        give key,value items and true gives a flag.
+        """
+        self.assertEqual(
+            self.arguments({'hosts': [{'port': 8080, 'path': '/srv',
+                                       'index': ['index.m3u8', 'index.html'],
+                                       'alias': {'live': 'hls/live'},
+                                       'allow-ignore-ext': True,
+                                       'user': False}]}),
+            ['--port=tcp:8080', '--path=/srv', '--alias=live,hls/live',
+             '--allow-ignore-ext', '--index=index.m3u8',
+             '--index=index.html'])
+
+    def test_invalid(self):
+        """
+        Files without hosts, with unknown or misplaced options and with a
+        port or vhost defined twice are rejected.
+        """
+        for document in [{'hosts': []},
+                         {'hosts': [{'port': 8080, 'no-such-option': 1}]},
+                         {'hosts': [{'port': 8080, 'logfile': 'x.log'}]},
+                         {'hosts': [{'port': 8080}, {'port': 'tcp:8080'}]},
+                         {'hosts': [{'port': 8080,
+                                     'vhosts': [{'fqdn': 'a'},
+                                                {'fqdn': 'A'}]}]},
+                         {'hosts': [{'port': 8080,
+                                     'allow-ignore-ext': 'yes'}]}]:
+            self.assertRaises(ValueError, self.arguments, document)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.metrics}.
+"""
+
+from twisted.internet import protocol, task
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
+from twisted.trial import unittest
+
+from mcs import metrics, shaper
+
+class ConnectionCounterTests(unittest.TestCase):
+
+    def connections(self, factory):
+        """
+        Return the open connections counted by a L{metrics.ConnectionCounter}
+        around C{factory}, while two protocols are connected and once they
+        are lost again.
+        """
+        hostMetrics = metrics.HostMetrics('tcp:8080')
+        counter = metrics.ConnectionCounter(factory, hostMetrics)
+        protos = [counter() for i in range(2)]
+        for proto in protos:
+            proto.makeConnection(StringTransport())
+        counted = [hostMetrics.connections]
+        for proto in protos:
+            proto.connectionLost(failure.Failure(Exception('closed')))
+        counted.append(hostMetrics.connections)
+        self.assertEqual(hostMetrics.accepted, 2)
+        return counted
+
+    def test_connections(self):
+        """Connections are counted while they are open."""
+        self.assertEqual(self.connections(protocol.Protocol), [2, 0])
+
+    def test_shapedConnections(self):
+        """
+        Connections of a L{shaper.ShapedProtocolFactory} are no longer
+        counted once they are lost.
+        """
+        shaped = shaper.ShapedProtocolFactory(
+            protocol.Protocol, shaper.Shaper(100000),
+            shaper.Scheduler(clock=task.Clock()))
+        self.assertEqual(self.connections(shaped), [2, 0])
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.playlist}.
+"""
+
+import os
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import http, server
+from twisted.web.test.requesthelper import DummyChannel
+
+from mcs import compression, playlist, static
+
+PLAYLIST = b'#EXTM3U\n' + b'#EXTINF:4.0,\nsegment.ts\n' * 50
+
+class PlaylistResourceTests(unittest.TestCase):
+
+    def setUp(self):
+        # as the paths of files
+        self.directory = os.path.abspath(self.mktemp())
+        os.mkdir(self.directory)
+        self.path = os.path.join(self.directory, 'live.m3u8')
+        self.writePlaylist(PLAYLIST)
+        # without inotify, revalidated with stat on every hit
+        self.playlists = playlist.PlaylistCache(self.directory,
+                                                clock=task.Clock())
+        self.variants = None
+
+    def writePlaylist(self, data, mtime=1000000000.25):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        os.utime(self.path, (mtime, mtime))
+
+    def request(self, **headers):
+        request = server.Request(DummyChannel(), False)
+        request.method = b'GET'
+        request.clientproto = b'HTTP/1.1'
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'),
+                                                 [value])
+        return request
+
+    def miss(self, **headers):
+        """Render the playlist as L{static.File}, caching it."""
+        f = static.File(self.path)
+        f.playlistCache = self.playlists
+        f.variantCache = self.variants
+        f.useSendfile = False
+        request = self.request(**headers)
+        f.render(request)
+        return request
+
+    def hit(self, **headers):
+        """Render the cached playlist."""
+        entry = self.playlists.lookup(self.path)
+        self.assertNotIdentical(entry, None)
+        request = self.request(**headers)
+        request.write(playlist.PlaylistResource(entry,
+                                                self.variants).render(request))
+        return request
+
+    def etag(self, request):
+        return request.responseHeaders.getRawHeaders('etag')[0]
+
+    def test_etag(self):
+        """
+        Hits carry the ETag of the miss and are revalidated with it, even
+        when If-Modified-Since alone would not do.
+        """
+        etag = self.etag(self.miss())
+        self.assertEqual(self.etag(self.hit()), etag)
+        request = self.hit(if_none_match=etag, if_modified_since=b'garbage')
+        self.assertEqual(request.code, http.NOT_MODIFIED)
+        self.assertEqual(self.etag(request), etag)
+
+    def test_etagModified(self):
+        """
+        A playlist rewritten within the same second gets a new ETag, and a
+        stale one is not answered with a 304 by If-Modified-Since.
+        """
+        etag = self.etag(self.miss())
+        self.writePlaylist(PLAYLIST + b'#EXTINF:4.0,\nnext.ts\n',
+                           1000000000.75)
+        self.miss()
+        request = self.hit(if_none_match=etag,
+                           if_modified_since=http.datetimeToString(time.time()))
+        self.assertEqual(request.code, http.OK)
+        self.assertNotEqual(self.etag(request), etag)
+
+    def test_etagCompressed(self):
+        """Compressed variants of hits are tagged as those of misses."""
+        self.variants = compression.VariantCache(1 << 20)
+        etag = self.etag(self.miss(accept_encoding='gzip'))
+        self.assertTrue(etag.endswith('-gzip"'))
+        request = self.hit(accept_encoding='gzip')
+        self.assertEqual(self.etag(request), etag)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-encoding'), ['gzip'])
+        request = self.hit(accept_encoding='gzip', if_none_match=etag)
+        self.assertEqual(request.code, http.NOT_MODIFIED)
+        request = self.hit(if_none_match=etag)
+        self.assertEqual(request.code, http.OK)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.proxycache}.
+"""
+
+import os
+
+from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import client, http_headers
+from twisted.web.test.requesthelper import DummyRequest
+
+from mcs import proxycache
+
+class FakeResponse(object):
+
+    phrase = b'OK'
+
+    def __init__(self, headers, length, code=200):
+        self.code = code
+        self.headers = http_headers.Headers(headers)
+        self.length = length
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        self.transport = StringTransport()
+        protocol.makeConnection(self.transport)
+
+    def body(self, *chunks):
+        for chunk in chunks:
+            self.protocol.dataReceived(chunk)
+        self.protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+class FakeAgent(object):
+    """Answers the first request once L{respond} is called."""
+
+    def __init__(self, response):
+        self.response = response
+        self.responded = defer.Deferred()
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        return self.responded
+
+    def respond(self):
+        self.responded.callback(self.response)
+
+class ProducingRequest(DummyRequest):
+    """A L{DummyRequest} keeping the push producer registered with it."""
+
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+class ProxyCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = proxycache.ProxyCache(self.mktemp(), 1000,
+                                           clock=task.Clock())
+        self.cache.startService()
+
+    def fetch(self, response, *requests):
+        """
+        Fetch C{response} for two clients at once, attaching C{requests} to
+        what they get, and return that.
+        """
+        agent = FakeAgent(response)
+        results = []
+
+        def received(result, request):
+            results.append(result)
+            if request is not None:
+                result.attach(request)
+
+        for request in requests or (None, None):
+            self.cache.fetch(agent, 'http://upstream/a.ts',
+                             http_headers.Headers()).addCallback(received,
+                                                                 request)
+        agent.respond()
+        return results
+
+    def test_passThroughNoStore(self):
+        """
+        A response which must not be stored is streamed to all clients
+        waiting for it as it arrives, without touching the disk.
+        """
+        response = FakeResponse({b'cache-control': [b'no-store']}, 6)
+        requests = [ProducingRequest([b'']), ProducingRequest([b''])]
+        results = self.fetch(response, *requests)
+        self.assertIsInstance(results[0], proxycache.PassThrough)
+        self.assertIdentical(results[0], results[1])
+        response.body(b'abc', b'def')
+        for request in requests:
+            self.assertEqual(request.written, [b'abc', b'def'])
+            self.assertEqual(request.finished, 1)
+        self.assertEqual(os.listdir(self.cache.directory), [])
+        self.assertEqual(self.cache.stats()['passed'], 1)
+
+    def test_passThroughTooLarge(self):
+        """
+        A response whose Content-Length exceeds the largest entry is passed
+        through instead of being downloaded first.
+        """
+        response = FakeResponse({b'cache-control': [b'max-age=60']}, 2000)
+        results = self.fetch(response)
+        self.assertIsInstance(results[0], proxycache.PassThrough)
+
+    def test_stored(self):
+        """A cacheable response is downloaded and stored."""
+        response = FakeResponse({b'cache-control': [b'max-age=60']}, 6)
+        results = self.fetch(response)
+        self.assertEqual(results, [])
+        response.body(b'abcdef')
+        self.assertIsInstance(results[0], proxycache.Entry)
+        self.assertEqual(results[0].size, 6)
+
+    def test_backpressure(self):
+        """
+        The upstream pauses while any client can not keep up, and stops once
+        all clients went away.
+        """
+        response = FakeResponse({b'cache-control': [b'private']}, 6)
+        requests = [ProducingRequest([b'']), ProducingRequest([b''])]
+        passThrough = self.fetch(response, *requests)[0]
+        transport = response.transport
+        requests[0].producer.pauseProducing()
+        requests[1].producer.pauseProducing()
+        requests[0].producer.resumeProducing()
+        self.assertEqual(transport.producerState, 'paused')
+        requests[1].producer.resumeProducing()
+        self.assertEqual(transport.producerState, 'producing')
+        passThrough.detach(requests[0])
+        self.assertEqual(transport.producerState, 'producing')
+        passThrough.detach(requests[1])
+        self.assertEqual(transport.producerState, 'stopped')
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.ranges}.
+"""
+
+from twisted.trial import unittest
+
+from mcs import ranges
+
+class CoalesceTests(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(ranges.coalesce([]), [])
+
+    def test_disjoint(self):
+        """Disjoint ranges are kept, in ascending order."""
+        self.assertEqual(ranges.coalesce([(100, 10), (0, 10)]),
+                         [(0, 10), (100, 10)])
+
+    def test_overlapping(self):
+        """Overlapping ranges are merged."""
+        self.assertEqual(ranges.coalesce([(0, 10), (5, 10)]), [(0, 15)])
+
+    def test_adjacent(self):
+        """Ranges where the one before ends are merged."""
+        self.assertEqual(ranges.coalesce([(10, 5), (0, 10)]), [(0, 15)])
+
+    def test_contained(self):
+        """A range within another one does not shorten it."""
+        self.assertEqual(ranges.coalesce([(0, 100), (10, 5), (200, 1)]),
+                         [(0, 100), (200, 1)])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.reverse}.
+"""
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import http_headers
+from twisted.web.test.requesthelper import DummyRequest
+
+from mcs import reverse
+
+class ForwardHeadersTests(unittest.TestCase):
+
+    def test_hopByHop(self):
+        """
+        Neither the hop-by-hop headers nor those named by the Connection
+        header are forwarded.
+        """
+        source = http_headers.Headers({
+            b'connection': [b'close, X-Hop'], b'keep-alive': [b'timeout=5'],
+            b'x-hop': [b'1'], b'accept': [b'*/*']})
+        destination = http_headers.Headers()
+        reverse.forwardHeaders(source, destination)
+        self.assertEqual(list(destination.getAllRawHeaders()),
+                         [(b'Accept', [b'*/*'])])
+
+    def test_upstreamHeaders(self):
+        """
+        The headers sent upstream have the upstream's host and no
+        content-length, which the agent sets for the body it sends.
+        """
+        request = DummyRequest([b''])
+        request.requestHeaders.setRawHeaders(b'host', [b'proxy.example'])
+        request.requestHeaders.setRawHeaders(b'content-length', [b'7'])
+        request.requestHeaders.setRawHeaders(b'content-type', [b'text/plain'])
+        resource = reverse.ReverseProxyResource('upstream.example', 8080, '',
+                                                clock=task.Clock())
+        headers = resource.upstreamHeaders(request)
+        self.assertEqual(headers.getRawHeaders(b'host'),
+                         [b'upstream.example:8080'])
+        self.assertIdentical(headers.getRawHeaders(b'content-length'), None)
+        self.assertEqual(headers.getRawHeaders(b'content-type'),
+                         [b'text/plain'])
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.shaper}.
+"""
+
+import json
+import os
+
+from twisted.internet import protocol, task
+from twisted.internet.testing import StringTransport
+from twisted.python import failure
+from twisted.trial import unittest
+
+from mcs import connections, shaper
+
+class BucketTests(unittest.TestCase):
+
+    def test_quantum(self):
+        """
+        Tokens are taken in full TCP segments, unless a bucket of the chain
+        holds less than one.
+        """
+        server = shaper.Bucket(100000)
+        self.assertEqual(shaper.Bucket(100000, None, server).quantum(),
+                         shaper.QUANTUM)
+        self.assertEqual(shaper.Bucket(1000, None, server).quantum(), 1000)
+        self.assertEqual(shaper.Bucket(100000, None,
+                                       shaper.Bucket(500)).quantum(), 500)
+
+class ShapedTransportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = shaper.Scheduler(clock=self.clock)
+
+    def shaped(self, *limits):
+        """
+        Return a transport and the one shaping it with the buckets of a
+        L{shaper.Shaper} with C{limits}.
+        """
+        shape = shaper.Shaper(*limits)
+        self.scheduler.addShaper(shape)
+        self.scheduler.refill()
+        transport = StringTransport()
+        return transport, shaper.ShapedTransport(
+            transport, shape.bucketFor('10.0.0.1'), self.scheduler)
+
+    def advance(self, shaped, seconds):
+        """Advance the clock tick by tick, draining the transport each."""
+        for tick in range(int(round(seconds / self.scheduler.interval))):
+            self.clock.advance(self.scheduler.interval)
+            shaped.drained()
+
+    def test_takeQuanta(self):
+        """
+        Less than asked for is taken in multiples of L{shaper.QUANTUM}, all
+        of it if the bucket allows.
+        """
+        transport, shaped = self.shaped(10000)
+        self.assertEqual(shaped.take(20000), 6 * shaper.QUANTUM)
+        self.assertEqual(shaped.take(20000), 0)
+        self.advance(shaped, 1)
+        self.assertEqual(shaped.take(5000), 5000)
+
+    def test_takeSmallBurst(self):
+        """
+        A bucket whose burst is below L{shaper.QUANTUM} releases its whole
+        burst, instead of nothing ever.
+        """
+        transport, shaped = self.shaped(1000)
+        self.assertEqual(shaped.take(3000), 1000)
+        self.assertEqual(shaped.take(3000), 0)
+
+    def test_writeSmallBurst(self):
+        """
+        A write larger than a burst below L{shaper.QUANTUM} is sent
+        completely, at the rate of the bucket.
+        """
+        transport, shaped = self.shaped(1000)
+        shaped.write(b'x' * 3000)
+        self.assertEqual(len(transport.value()), 1000)
+        self.advance(shaped, 1.5)
+        self.assertEqual(len(transport.value()), 2000)
+        self.advance(shaped, 1)
+        self.assertEqual(transport.value(), b'x' * 3000)
+
+    def test_writeSmallParentBurst(self):
+        """
+        The burst of the server-wide bucket limits the quantum of its client
+        buckets as well.
+        """
+        transport, shaped = self.shaped(100000, 100000, 1000)
+        shaped.write(b'x' * 3000)
+        self.advance(shaped, 2.5)
+        self.assertEqual(transport.value(), b'x' * 3000)
+
+class FakePort(object):
+    """The listening port of a connection, paused and resumed."""
+
+    connected = True
+    reading = True
+
+    def stopReading(self):
+        self.reading = False
+
+    def startReading(self):
+        self.reading = True
+
+    def getHost(self):
+        return 'port'
+
+class ProtocolFactoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = shaper.Scheduler(clock=task.Clock())
+
+    def connect(self, factory, port):
+        """Connect a new protocol of C{factory} accepted on C{port}."""
+        proto = factory()
+        transport = StringTransport()
+        transport.server = port
+        proto.makeConnection(transport)
+        return proto
+
+    def assertConnectionsReleased(self, shaped):
+        """
+        Connections shaped by the factory C{shaped} still release their
+        limits of open connections when lost.
+        """
+        limits = connections.ConnectionLimits(shaped, maxConnections=2)
+        port = FakePort()
+        protos = [self.connect(limits, port) for i in range(2)]
+        self.assertFalse(port.reading)
+        for proto in protos:
+            proto.connectionLost(failure.Failure(Exception('closed')))
+        self.assertEqual(limits.connections, 0)
+        self.assertTrue(port.reading)
+        self.assertEqual(self.connect(limits, port).transport.__class__,
+                         shaper.ShapedTransport)
+
+    def test_shapedConnectionLimits(self):
+        """
+        L{shaper.ShapedProtocolFactory} keeps the C{connectionLost} of the
+        wrappers around it.
+        """
+        shaped = shaper.ShapedProtocolFactory(
+            protocol.Protocol, shaper.Shaper(100000, 10000), self.scheduler)
+        self.assertConnectionsReleased(shaped)
+        self.assertEqual([bucket.connections for bucket
+                          in shaped.shaper.clients.values()], [1])
+
+    def test_profiledConnectionLimits(self):
+        """
+        L{shaper.ProfiledProtocolFactory} keeps the C{connectionLost} of the
+        wrappers around it.
+        """
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            json.dump({'classes': {'all': {'rate': 100000}},
+                       'default': 'all'}, f)
+        profiles = shaper.ShapingProfiles(path, scheduler=self.scheduler)
+        self.assertConnectionsReleased(
+            shaper.ProfiledProtocolFactory(protocol.Protocol, profiles,
+                                           self.scheduler))
+        self.assertEqual(len(profiles.transports), 1)
+
+class ProfileTests(unittest.TestCase):
+
+    def test_fromFileExample(self):
+        """
+        The example profile of L{shaper.Profile.fromFile} loads, with the
+        class without a rate of its own limited to the rate of its parent.
+        """
+        example = shaper.Profile.fromFile.__doc__.split('::')[1]
+        example = example.split('Trace files')[0]
+        directory = self.mktemp()
+        os.makedirs(os.path.join(directory, 'traces'))
+        os.mkdir(os.path.join(directory, 'recorded'))
+        with open(os.path.join(directory, 'traces', 'lte.down'), 'w') as f:
+            f.write('\n'.join(str(ms) for ms in range(1, 1001)) + '\n')
+        path = os.path.join(directory, 'profile.json')
+        with open(path, 'w') as f:
+            f.write(example)
+        profile = shaper.Profile.fromFile(path)
+        self.assertEqual(sorted(profile.classes),
+                         ['3g', 'all', 'low', 'lte'])
+        low = profile.classes['low'].shaper
+        self.assertEqual(low.server.rate, 2500000)
+        self.assertEqual(low.clientRate, 100000)
+        self.assertIs(low.server.parent, profile.classes['all'].shaper.server)
+
+    def test_fromFileNoRate(self):
+        """A top-level class needs a rate or a trace."""
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            json.dump({'classes': {'all': {'client-rate': 100000}},
+                       'default': 'all'}, f)
+        self.assertRaises(ValueError, shaper.Profile.fromFile, path)
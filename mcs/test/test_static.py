@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.static}.
+"""
+
+import os
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+from twisted.web import http, server
+from twisted.web.test.requesthelper import DummyChannel
+
+from mcs import compression, static, statcache
+
+class ConditionalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.path = os.path.join(self.directory, 'segment.ts')
+        self.writeFile(b'x' * 100)
+        # re-statted on every request
+        self.statCache = statcache.StatCache(0, clock=task.Clock())
+        self.variantCache = None
+
+    def writeFile(self, data, mtime=1000000000):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        os.utime(self.path, (mtime, mtime))
+
+    def get(self, **headers):
+        """Render the file for a GET request with C{headers}."""
+        f = static.File(self.path)
+        f.statCache = self.statCache
+        f.variantCache = self.variantCache
+        f.useSendfile = False
+        request = server.Request(DummyChannel(), False)
+        request.method = b'GET'
+        request.clientproto = b'HTTP/1.1'
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name.replace('_', '-'),
+                                                 [value])
+        f.render(request)
+        return request
+
+    def etag(self, request):
+        return request.responseHeaders.getRawHeaders('etag')[0]
+
+    def test_ifNoneMatch(self):
+        """
+        Requests listing the ETag of the file in If-None-Match, weak or
+        not, get a 304 with the ETag.
+        """
+        etag = self.etag(self.get())
+        for tags in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+            request = self.get(if_none_match=tags)
+            self.assertEqual(request.code, http.NOT_MODIFIED)
+            self.assertEqual(self.etag(request), etag)
+
+    def test_ifNoneMatchModified(self):
+        """
+        A stale ETag in If-None-Match gets the file, even though the
+        If-Modified-Since sent along still matches.
+        """
+        etag = self.etag(self.get())
+        self.writeFile(b'y' * 200)
+        request = self.get(if_none_match=etag,
+                           if_modified_since=http.datetimeToString(time.time()))
+        self.assertEqual(request.code, http.OK)
+        self.assertNotEqual(self.etag(request), etag)
+
+    def test_ifModifiedSince(self):
+        """Without If-None-Match, If-Modified-Since is answered."""
+        request = self.get(if_modified_since=http.datetimeToString(
+            time.time()))
+        self.assertEqual(request.code, http.NOT_MODIFIED)
+
+    def test_ifNoneMatchCompressed(self):
+        """
+        Compressed variants are revalidated by their own ETag, which the
+        uncompressed file does not match.
+        """
+        self.path = os.path.join(self.directory, 'live.m3u8')
+        self.writeFile(b'#EXTINF:4.0,\nsegment.ts\n' * 50)
+        self.variantCache = compression.VariantCache(1 << 20)
+        plain = self.etag(self.get())
+        request = self.get(accept_encoding='gzip')
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+            'content-encoding'), ['gzip'])
+        etag = self.etag(request)
+        self.assertEqual(etag, plain[:-1] + '-gzip"')
+        request = self.get(accept_encoding='gzip', if_none_match=etag)
+        self.assertEqual(request.code, http.NOT_MODIFIED)
+        self.assertEqual(self.etag(request), etag)
+        request = self.get(accept_encoding='gzip', if_none_match=plain)
+        self.assertEqual(request.code, http.OK)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Tests for L{mcs.vhosts}.
+"""
+
+from twisted.trial import unittest
+
+from mcs import vhosts
+
+class HostIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = vhosts.HostIndex()
+
+    def test_exact(self):
+        """Exact names are looked up case-insensitively, without the root."""
+        self.index.add('Media.Example.', 'media')
+        self.assertEqual(self.index.get('media.example'), 'media')
+        self.assertIdentical(self.index.get('other.example'), None)
+
+    def test_wildcard(self):
+        """
+        A wildcard matches the names below its domain, however deep, but
+        not the domain itself.
+        """
+        self.index.add('*.example', 'any')
+        self.assertEqual(self.index.get('a.example'), 'any')
+        self.assertEqual(self.index.get('a.b.example'), 'any')
+        self.assertEqual(self.index.get('example', 'default'), 'default')
+
+    def test_mostSpecific(self):
+        """
+        Exact names come before wildcards, and longer wildcards before
+        shorter ones.
+        """
+        self.index.add('*.example', 'any')
+        self.index.add('*.tenant.example', 'tenant')
+        self.index.add('www.tenant.example', 'www')
+        self.assertEqual(self.index.get('www.tenant.example'), 'www')
+        self.assertEqual(self.index.get('cdn.tenant.example'), 'tenant')
+        self.assertEqual(self.index.get('other.example'), 'any')
+
+    def test_replace(self):
+        """Adding a name again replaces its value."""
+        self.index.add('*.example', 'old')
+        self.index.add('*.example', 'new')
+        self.assertEqual(self.index.get('a.example'), 'new')
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Throughput traces of network links in the format of mahimahi: one line per
+packet of L{PACKET} bytes the link delivers, holding the milliseconds since
+the start of the trace it is delivered by.  A trace is played over and over,
+the last delivery marking its end.
+
+A L{Trace} is resampled into the bytes delivered by the end of each slot of
+a fixed length, so how much it delivers between two points in time is found
+in constant time, whatever the number of clients following it.
+L{Recorder} writes the bytes actually sent on connections in the same
+format, so that they can be replayed later.
+"""
+
+import itertools
+import math
+import os
+import time
+
+from array import array
+
+from twisted.internet import threads
+from twisted.python import log
+
+# mahimahi's packets are full ethernet frames
+PACKET = 1500
+
+class Trace(object):
+    """
+    The bytes a link delivers, resampled into slots of C{resolution}
+    seconds.  C{cumulative} holds the bytes delivered by the start of each
+    slot and, last, by the end of the trace.  Within a slot, the bytes are
+    delivered at an even rate.
+    """
+
+    __slots__ = ('cumulative', 'resolution', 'period', 'total')
+
+    def __init__(self, cumulative, resolution):
+        self.cumulative = cumulative
+        self.resolution = resolution
+        self.period = (len(cumulative) - 1) * resolution
+        self.total = cumulative[-1]
+
+    @classmethod
+    def fromFile(cls, path, resolution=0.01):
+        """Read a mahimahi trace from the file at C{path}."""
+        slots = array('d')
+        last = 0
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    ms = int(line)
+                except ValueError:
+                    ms = -1
+                if ms < last:
+                    raise ValueError("%s:%d: invalid delivery time %s" %
+                                     (path, number, line))
+                last = ms
+                # delivered during the millisecond ending at ms
+                slot = int(max(ms - 1, 0) / 1000.0 / resolution)
+                if slot >= len(slots):
+                    slots.extend([0.0] * (slot + 1 - len(slots)))
+                slots[slot] += PACKET
+        if last <= 0:
+            raise ValueError("%s: empty trace" % path)
+        count = max(int(math.ceil(last / 1000.0 / resolution)), len(slots))
+        slots.extend([0.0] * (count - len(slots)))
+        cumulative = array('d', [0.0])
+        total = 0.0
+        for delivered in slots:
+            total += delivered
+            cumulative.append(total)
+        return cls(cumulative, resolution)
+
+    @property
+    def rate(self):
+        """The average rate in bytes per second."""
+        return self.total / self.period
+
+    def delivered(self, seconds):
+        """Return the bytes delivered within C{seconds} from the start."""
+        if seconds < self.period:
+            repeats, offset = 0, seconds
+        else:
+            repeats, offset = divmod(seconds, self.period)
+        position = offset / self.resolution
+        slot = int(position)
+        cumulative = self.cumulative
+        if slot >= len(cumulative) - 1:
+            # rounded up to the end of the trace
+            return (repeats + 1) * self.total
+        below = cumulative[slot]
+        return (repeats * self.total + below +
+                (cumulative[slot + 1] - below) * (position - slot))
+
+    def between(self, start, end):
+        """Return the bytes delivered from C{start} to C{end} seconds."""
+        return self.delivered(end) - self.delivered(start)
+
+class Recording(object):
+    """
+    The packets sent on one connection, as runs of packets delivered by the
+    same millisecond since the recording started.
+    """
+
+    __slots__ = ('path', 'started', 'times', 'counts', 'carry')
+
+    def __init__(self, path, started):
+        self.path = path
+        self.started = started
+        self.times = array('l')
+        self.counts = array('l')
+        # bytes sent short of a full packet
+        self.carry = 0
+
+    def add(self, now, amount):
+        """Record C{amount} bytes sent at C{now}."""
+        packets, self.carry = divmod(self.carry + amount, PACKET)
+        if packets:
+            self._append(int((now - self.started) * 1000) + 1, packets)
+
+    def _append(self, ms, packets):
+        times = self.times
+        if times and times[-1] >= ms:
+            self.counts[-1] += packets
+        else:
+            times.append(ms)
+            self.counts.append(packets)
+
+    def finish(self):
+        """Count what is left short of a packet as one packet."""
+        if self.carry:
+            self.carry = 0
+            self._append(self.times[-1] if self.times else 1, 1)
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            for ms, packets in zip(self.times, self.counts):
+                f.write(('%d\n' % ms) * packets)
+
+class Recorder(object):
+    """
+    Records the bytes sent on each connection into a trace file of its own
+    in C{directory}, named by the time it was opened, the client and the
+    process, written from a thread once the connection is gone.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.numbers = itertools.count(1)
+        self.recorded = 0
+
+    def start(self, host, now):
+        """Start recording a connection from C{host} opened at C{now}."""
+        name = '%s-%s-%d-%d.trace' % (time.strftime('%Y%m%dT%H%M%S'),
+                                      str(host).replace(':', '_'),
+                                      os.getpid(), next(self.numbers))
+        return Recording(os.path.join(self.directory, name), now)
+
+    def stop(self, recording):
+        recording.finish()
+        if not recording.times:
+            return
+        self.recorded += 1
+        d = threads.deferToThread(recording.write)
+        d.addErrback(log.err, 'writing trace %s failed' % recording.path)
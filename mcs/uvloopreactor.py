@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+twisted's asyncio reactor running on the event loop of uvloop, installed
+with C{twistd --reactor=uvloop}.  Requires Python 3 and uvloop.
+"""
+
+def install():
+    import uvloop
+
+    from twisted.internet import asyncioreactor
+
+    asyncioreactor.install(uvloop.new_event_loop())
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Dispatch requests to hundreds of vhosts, including wildcard ones.
+
+A L{HostIndex} looks host names up in a dict of the exact names and else
+in a trie of the reversed labels of wildcard names like C{*.example.com},
+which match any name below C{example.com}, the longest one winning.  The
+L{VirtualHostIndex} serving vhosts and the metrics of L{mcs.metrics} both
+use one.
+"""
+
+from twisted.web import resource, vhost
+
+def hostName(hostHeader):
+    """
+    Return the lower-case name of the Host header C{hostHeader}, without
+    its port or trailing dot.
+    """
+    host = hostHeader.lower()
+    if host.startswith('['):
+        # ipv6 literal
+        return host[:host.find(']') + 1]
+    return host.split(':', 1)[0].rstrip('.')
+
+class _Node(object):
+    """A label of the wildcard names of a L{HostIndex}."""
+
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+class HostIndex(object):
+    """
+    Values of exact host names and of wildcard names, C{*.} followed by the
+    domain they match names below of.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.wildcards = _Node()
+
+    def add(self, name, value):
+        """Add C{name}, replacing its value if it has been added before."""
+        name = name.lower().rstrip('.')
+        if not name.startswith('*.'):
+            self.exact[name] = value
+            return
+        node = self.wildcards
+        for label in reversed(name[2:].split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        node.value = value
+
+    def get(self, name, default=None):
+        """Return the value of the host C{name}, which must be lower-case."""
+        value = self.exact.get(name)
+        if value is not None:
+            return value
+        node = self.wildcards
+        labels = name.split('.')
+        # a wildcard matches one label at least
+        for index in range(len(labels) - 1, 0, -1):
+            node = node.children.get(labels[index])
+            if node is None:
+                break
+            if node.value is not None:
+                default = node.value
+        return default
+
+class VirtualHostIndex(vhost.NameVirtualHost):
+    """
+    A L{vhost.NameVirtualHost} looking its hosts up in a L{HostIndex}.  The
+    resources of up to C{maxResolved} Host headers are remembered as they
+    were sent, so most requests take a single dict lookup.
+    """
+
+    maxResolved = 4096
+
+    def __init__(self):
+        vhost.NameVirtualHost.__init__(self)
+        self.index = HostIndex()
+        self.resolved = {}
+
+    def addHost(self, name, resrc):
+        vhost.NameVirtualHost.addHost(self, name, resrc)
+        self.index.add(name, resrc)
+        self.resolved.clear()
+
+    def removeHost(self, name):
+        vhost.NameVirtualHost.removeHost(self, name)
+        self.index = HostIndex()
+        for name, resrc in self.hosts.items():
+            self.index.add(name, resrc)
+        self.resolved.clear()
+
+    def _getResourceForRequest(self, request):
+        hostHeader = request.getHeader('host')
+        if hostHeader is None:
+            return self.default or resource.NoResource()
+        resrc = self.resolved.get(hostHeader)
+        if resrc is None:
+            host = hostName(hostHeader)
+            resrc = (self.index.get(host, self.default) or
+                     resource.NoResource("host %s not in vhost map" %
+                                         repr(host)))
+            if len(self.resolved) >= self.maxResolved:
+                # made up host names must not grow it without bounds
+                self.resolved.clear()
+            self.resolved[hostHeader] = resrc
+        return resrc
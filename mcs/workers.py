@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
+# See LICENSE for details.
+
+"""
+Serve from several worker processes, each running its own reactor.
+
+The parent process creates the listening sockets of all hosts, registers
+the mDNS services and spawns the workers, which inherit the listening
+sockets and accept connections from them in turn.  The server-wide buckets
+of shaped hosts live in a small memory-mapped file shared by all workers,
+so that C{--shape} limits still hold for the whole server.  SIGHUP and
+SIGUSR1 sent to the parent are passed on to the workers, which run the
+same kind of reactor as the parent.
+"""
+
+import fcntl
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from twisted.application import service
+from twisted.internet import protocol
+from twisted.python import log, reflect, usage
+
+from mcs import shaper
+
+class SharedMemory(object):
+    """
+    Slots of two doubles (a bucket's level and the time of its last update)
+    in a memory-mapped file, guarded by an exclusive lock on the file.
+    """
+
+    slotFormat = struct.Struct('dd')
+
+    def __init__(self, path, slots=None):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+        if slots is not None:
+            os.ftruncate(self.fd, max(1, slots) * self.slotFormat.size)
+        self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+
+    @classmethod
+    def create(cls, slots):
+        directory = None
+        if os.path.isdir('/dev/shm'):
+            directory = '/dev/shm'
+        fd, path = tempfile.mkstemp(prefix='mediacastserver-',
+                                    dir=directory)
+        os.close(fd)
+        return cls(path, slots)
+
+    def lock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def unlock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def read(self, slot):
+        return self.slotFormat.unpack_from(self.map,
+                                           slot * self.slotFormat.size)
+
+    def write(self, slot, tokens, last):
+        self.slotFormat.pack_into(self.map, slot * self.slotFormat.size,
+                                  tokens, last)
+
+    def bucket(self, slot, shape):
+        """
+        Return the L{shaper.SharedBucket} in C{slot} for the server-wide
+        rate and burst of a C{--shape} limit.
+        """
+        rate = int(shape[0])
+        burst = rate
+        if len(shape) > 2:
+            burst = int(shape[2])
+        return shaper.SharedBucket(self, slot, rate, burst)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def unlink(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def reactorModule():
+    """
+    Return the name of the module installing the kind of reactor running,
+    for the workers to install it as well.
+    """
+    from twisted.internet import reactor
+    loop = getattr(reactor, '_asyncioEventloop', None)
+    if loop is not None and type(loop).__module__.startswith('uvloop'):
+        return 'mcs.uvloopreactor'
+    return type(reactor).__module__
+
+def parsePort(description):
+    """
+    Return the port number, interface and backlog of a TCP strports
+    description like C{tcp:8080:interface=127.0.0.1:backlog=50}.
+    """
+    parts = str(description).split(':')
+    if parts[0] == 'tcp':
+        parts = parts[1:]
+    elif not parts[0].isdigit():
+        raise usage.UsageError("Only tcp ports can be shared by workers: %s"
+                               % description)
+    options = {'interface': '', 'backlog': 50}
+    for part in parts[1:]:
+        key, value = part.split('=', 1)
+        options[key] = value
+    return int(parts[0]), options['interface'], int(options['backlog'])
+
+def listen(description):
+    """Create a listening socket for a TCP strports description."""
+    port, interface, backlog = parsePort(description)
+    family = socket.AF_INET
+    if ':' in interface:
+        family = socket.AF_INET6
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+class AdoptedPortService(service.Service):
+    """
+    Listens on an inherited listening socket, like the services created by
+    L{twisted.application.strports.service} listen on a new one.
+    """
+
+    def __init__(self, fileno, family, factory):
+        self.fileno = fileno
+        self.family = family
+        self.factory = factory
+        self.port = None
+
+    def startService(self):
+        from twisted.internet import reactor
+        service.Service.startService(self)
+        self.port = reactor.adoptStreamPort(self.fileno, self.family,
+                                            self.factory)
+        os.close(self.fileno)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+
+class WorkerProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, pool, number):
+        self.pool = pool
+        self.number = number
+
+    def outReceived(self, data):
+        self.errReceived(data)
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            if not isinstance(line, str):
+                # bytes with python 3
+                line = line.decode('utf-8', 'replace')
+            log.msg('[worker %d] %s' % (self.number, line))
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+
+class WorkerPool(service.Service):
+    """
+    Spawns C{count} worker processes serving the sockets of all hosts added
+    with L{addHost}, and restarts those which die unexpectedly.
+    """
+
+    restartDelay = 1.0
+
+    # reloading shaping profiles and reopening the access log
+    forwardedSignals = ('SIGHUP', 'SIGUSR1')
+
+    def __init__(self, count, argv):
+        self.count = count
+        self.argv = argv
+        self.sockets = []
+        self.shapes = []
+        self.memory = None
+        self.workers = {}
+        self.previousHandlers = {}
+
+    def addHost(self, host_config):
+        self.sockets.append(listen(host_config['port']))
+        self.shapes.append(host_config['shape'])
+
+    def startService(self):
+        service.Service.startService(self)
+        self.memory = SharedMemory.create(len(self.shapes))
+        now = time.time()
+        for slot, shape in enumerate(self.shapes):
+            if shape is not None:
+                self.memory.write(slot, self.memory.bucket(slot, shape).burst,
+                                  now)
+        for number in range(self.count):
+            self.spawn(number)
+        for name in self.forwardedSignals:
+            signum = getattr(signal, name, None)
+            if signum is not None:
+                self.previousHandlers[signum] = signal.signal(signum,
+                                                              self.forward)
+
+    def forward(self, signum, frame):
+        for worker in self.workers.values():
+            try:
+                os.kill(worker.transport.pid, signum)
+            except Exception:
+                pass
+        previous = self.previousHandlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+
+    def spawn(self, number):
+        from twisted.internet import reactor
+        childFDs = {0: 'w', 1: 'r', 2: 'r'}
+        args = [sys.executable, '-m', 'mcs.workers', reactorModule(),
+                self.memory.path, str(number)]
+        for sock in self.sockets:
+            childFDs[sock.fileno()] = sock.fileno()
+            args.append('%d:%d' % (sock.fileno(), sock.family))
+        args.append('--')
+        args.extend(self.argv)
+        worker = WorkerProtocol(self, number)
+        self.workers[number] = worker
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                             childFDs=childFDs)
+        log.msg('spawned worker %d' % number)
+
+    def workerEnded(self, worker, reason):
+        del self.workers[worker.number]
+        log.msg('worker %d ended: %s' % (worker.number,
+                                         reason.getErrorMessage()))
+        if self.running:
+            from twisted.internet import reactor
+            reactor.callLater(self.restartDelay, self.spawn, worker.number)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for signum, previous in self.previousHandlers.items():
+            if previous is not None:
+                signal.signal(signum, previous)
+        self.previousHandlers.clear()
+        for worker in self.workers.values():
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception:
+                pass
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+def main(argv):
+    """
+    Run a worker: C{reactor-module shared-memory-path number fileno:family...
+    -- options}.
+    """
+    # before anything imports the default reactor
+    reflect.namedModule(argv.pop(0)).install()
+    from twisted.internet import reactor
+
+    from mcs import server
+
+    separator = argv.index('--')
+    memory = SharedMemory(argv[0])
+    sockets = []
+    for spec in argv[2:separator]:
+        fileno, family = spec.split(':')
+        sockets.append((int(fileno), int(family)))
+
+    config = server.Options()
+    config.parseOptions(argv[separator + 1:])
+    config['workers'] = 0
+    config['worker'] = {'memory': memory, 'sockets': sockets,
+                        'number': int(argv[1])}
+
+    # unless the services of the worker handle them
+    for name in WorkerPool.forwardedSignals:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+
+    log.startLogging(sys.stderr)
+    application = service.Application('mediacastserver-worker')
+    server.makeService(config).setServiceParent(application)
+    service.IService(application).startService()
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  service.IService(application).stopService)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
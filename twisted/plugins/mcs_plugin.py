@@ -2,6 +2,7 @@
 # © copyright 2011-2013 Stephan Jorek <stephan.jorek@gmail.com>.
 # See LICENSE for details.
 
+from twisted.application.reactors import Reactor
 from twisted.application.service import ServiceMaker
 
 TwistedMCS = ServiceMaker(
@@ -9,3 +10,7 @@ TwistedMCS = ServiceMaker(
     "mcs.server",
     "A general-purpose web server, intended to serve from a filesystem.",
     "mediacastserver")
+
+uvloop = Reactor(
+    "uvloop", "mcs.uvloopreactor",
+    "asyncio reactor running on uvloop (Python 3, requires uvloop).")